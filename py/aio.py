@@ -0,0 +1,248 @@
+"""
+Running Forp programs inside an event loop
+
+A `Task` runs a program on its VM a slice at a time, as callbacks on an
+event loop, so the loop serves its other work in between: a slice ends
+after `budget` instructions, or after `interval` seconds, whichever comes
+first. While every fiber of the program waits on futures returned by
+asynchronous stdlib functions (see `stdlib.asynchronous`), the task does
+not run at all, until a future's callback schedules it again. Many tasks,
+each on a VM of its own, can share one loop.
+
+The loop needs the `call_soon`, `call_soon_threadsafe` and `call_later`
+methods of an asyncio loop. Python 2 has no asyncio, so `Loop` is a
+minimal one; it is also the loop `vm.run` runs while it waits on futures.
+
+    python aio.py [--budget N] [--interval MICROSECONDS] file.forp ...
+"""
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+import vm
+
+# Instructions between checks of the clock, for a task with an `interval`
+CHECK_EVERY = 100
+
+# The loop the running task is on, and the one to use outside tasks
+running = None
+default = None
+
+class Future(object):
+    """
+    A result that is not there yet, with the methods of an asyncio or
+    `concurrent.futures` future that `vm` uses; it may be completed from
+    any thread
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.finished = False
+        self.value = self.error = None
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        if not self.finished:
+            raise RuntimeError("The future has not completed")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def set_result(self, value):
+        self.complete(value, None)
+
+    def set_exception(self, error):
+        self.complete(None, error)
+
+    def complete(self, value, error):
+        with self.lock:
+            if self.finished:
+                raise RuntimeError("The future has already completed")
+            self.value, self.error, self.finished = value, error, True
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        with self.lock:
+            if not self.finished:
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+class Loop(object):
+    """
+    A minimal event loop of callbacks, run in order, and timers
+    """
+
+    def __init__(self):
+        self.ready = collections.deque()
+        self.timers = []
+        # Orders timers due at the same time
+        self.count = itertools.count()
+        self.wakeup = threading.Condition()
+
+    def call_soon(self, fn, *args):
+        self.ready.append((fn, args))
+
+    def call_soon_threadsafe(self, fn, *args):
+        with self.wakeup:
+            self.ready.append((fn, args))
+            self.wakeup.notify()
+
+    def call_later(self, delay, fn, *args):
+        heapq.heappush(self.timers, (time.time() + delay, next(self.count), fn, args))
+
+    def run_once(self):
+        """
+        Run the callbacks that are ready and the timers that are due,
+        first waiting for one if there are none
+        """
+
+        with self.wakeup:
+            if not self.ready:
+                timeout = None
+                if self.timers:
+                    timeout = max(0, self.timers[0][0] - time.time())
+                self.wakeup.wait(timeout)
+            ready, self.ready = self.ready, collections.deque()
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, _, fn, args = heapq.heappop(self.timers)
+            ready.append((fn, args))
+        for fn, args in ready:
+            fn(*args)
+
+    def run_until_complete(self, future):
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+def get_loop():
+    """
+    The loop of the running task, if any, or else the default `Loop`
+    """
+
+    global default
+    if running is not None:
+        return running
+    if default is None:
+        default = Loop()
+    return default
+
+def sleep(seconds):
+    future = Future()
+    get_loop().call_later(seconds, future.set_result, None)
+    return future
+
+def read_file(path):
+    """
+    A future of the contents of the file at `path`, read on a thread of
+    its own
+    """
+
+    future = Future()
+    def read():
+        try:
+            with open(path) as f:
+                future.set_result(f.read())
+        except (IOError, OSError) as e:
+            future.set_exception(e)
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    return future
+
+class Task(object):
+    """
+    Runs the program at `state` on `machine` as callbacks on `loop`, in
+    slices of `budget` instructions, by default `vm.BUDGET`; `future`
+    completes with its final frames, or with the exception that stopped it
+    """
+
+    def __init__(self, machine, state, loop=None, budget=None, interval=None):
+        self.machine, self.state = machine, state
+        self.loop = loop or get_loop()
+        self.budget, self.interval = budget or vm.BUDGET, interval
+        self.future = Future()
+        self.scheduled = False
+        machine.waker = lambda: self.loop.call_soon_threadsafe(self.schedule)
+        self.schedule()
+
+    def schedule(self):
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.step)
+
+    def step(self):
+        global running
+        self.scheduled = False
+        machine = self.machine
+        machine.resumed()
+        if self.future.done() or (self.state is None and not machine.fibers and machine.awaiting):
+            return
+
+        running = self.loop
+        try:
+            self.state = self.run()
+        except vm.Idle:
+            self.state = None
+            return
+        except vm.HALT as e:
+            self.future.set_result(e.args[0])
+            return
+        except Exception as e:
+            self.future.set_exception(e)
+            return
+        finally:
+            running = None
+        self.schedule()
+
+    def run(self):
+        """
+        Run one slice; returns the state to go on with
+        """
+
+        if self.interval is None:
+            return vm.run_slice(self.machine, self.state, self.budget)
+        deadline = time.time() + self.interval
+        state, left = self.state, self.budget
+        while left > 0 and time.time() < deadline:
+            state = vm.run_slice(self.machine, state, min(left, CHECK_EVERY))
+            left -= CHECK_EVERY
+        return state
+
+def run_files(paths, budget=None, interval=None):
+    """
+    Run the programs in `paths` concurrently, on one loop
+    """
+
+    import cache
+
+    loop = get_loop()
+    tasks = []
+    for path in paths:
+        n, bytecodes, consts = cache.load(path)
+        machine = vm.VM(bytecodes, consts)
+        tasks.append(Task(machine, machine.mk_state(n), loop, budget, interval))
+    for task in tasks:
+        loop.run_until_complete(task.future)
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser(description="Run Forp programs concurrently on one event loop")
+    argp.add_argument("files", nargs="+")
+    argp.add_argument("--budget", type=int, help="instructions per slice (default %d)" % vm.BUDGET)
+    argp.add_argument("--interval", type=int, help="microseconds per slice")
+    args = argp.parse_args()
+
+    # As the module stdlib imports, whose loop its functions use
+    import aio
+    aio.run_files(args.files, args.budget, args.interval and args.interval / 1e6)
@@ -0,0 +1,102 @@
+"""
+How each front-end stage scales with program size
+
+For every family of programs in `synth`, and growing sizes, times
+`lexer.tokenize`, `parser.parse` and `compiler.Compiler.compile`
+separately. The `k` columns estimate each stage's growth exponent between
+consecutive sizes (time ~ size**k): about 1 is linear, and 2 or more marks
+super-linear behaviour worth looking into; the first size has none and
+shows `-`.
+
+Much of the apparent super-linearity on large inputs is Python's cyclic
+garbage collector walking the growing token and AST lists; `--no-gc`
+turns it off to separate that from the stages' own cost.
+
+    python bench/frontend.py [--quick] [--no-gc] [--layout paren|arrow|block] [family ...]
+"""
+
+import gc
+import math
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import compiler
+import lexer
+import parser
+import synth
+
+SIZES = {
+    "straight": [1000, 2000, 4000, 8000, 16000],
+    "long-names": [1000, 2000, 4000, 8000],
+    "nested-if": [50, 100, 200, 400],
+    "nested-fn": [50, 100, 200, 400],
+    "arrays": [250, 500, 1000, 2000],
+    "hashes": [250, 500, 1000, 2000],
+    "library": [250, 500, 1000, 2000],
+}
+
+REPEAT = 3
+
+def timed(fn, *args):
+    """
+    Call `fn` `REPEAT` times; returns its result and the best time
+    """
+
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        result = fn(*args)
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return result, best
+
+def stages(src, level=0):
+    """
+    Time each front-end stage on `src`; returns `(lex, parse, compile)`
+    seconds
+    """
+
+    tokens, lex = timed(lexer.tokenize, src, "<synth>")
+    ast, parse = timed(parser.parse, tokens, "<synth>")
+    _, comp = timed(lambda: compiler.Compiler("<synth>", level=level).compile(ast))
+    return lex, parse, comp
+
+def exponent(t0, t1, s0, s1):
+    if not t0 or not t1:
+        return None
+    return math.log(t1 / t0) / math.log(float(s1) / s0)
+
+def fmt(value, spec):
+    return "-".rjust(len(spec % 0)) if value is None else spec % value
+
+def report(family, sizes, layout):
+    print "%s (%s)" % (family, layout)
+    print "%8s %9s %9s %5s %9s %5s %9s %5s" % ("size", "bytes", "lex", "k", "parse", "k", "compile", "k")
+    prev = None
+    for size in sizes:
+        src = synth.FAMILIES[family](size, layout)
+        times = stages(src)
+        ks = [exponent(prev[1][i], times[i], prev[0], size) if prev else None for i in range(3)]
+        print "%8d %9d %s" % (size, len(src), " ".join(
+            fmt(t, "%8.4fs") + " " + fmt(k, "%5.2f") for t, k in zip(times, ks)))
+        sys.stdout.flush()
+        prev = size, times
+    print
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser(description="Time the Forp front end on growing synthetic programs")
+    argp.add_argument("families", nargs="*", default=sorted(SIZES))
+    argp.add_argument("--layout", choices=synth.LAYOUTS, default="paren")
+    argp.add_argument("--quick", action="store_true", help="only the two smallest sizes")
+    argp.add_argument("--no-gc", action="store_true", help="disable the cyclic garbage collector")
+    args = argp.parse_args()
+
+    if args.no_gc:
+        gc.disable()
+    sys.setrecursionlimit(100000)
+    for family in args.families:
+        report(family, SIZES[family][:2] if args.quick else SIZES[family], args.layout)
@@ -0,0 +1,474 @@
+"""
+End-to-end runtime benchmarks of the VM against equivalent Python
+
+Each benchmark is a Forp program together with a hand-written Python
+function computing the same thing, at one or more sizes. Every run happens
+in its own subprocess, so peak memory is per benchmark. For each run we
+record wall time (best of `--repeat`), instructions executed,
+instructions per second, peak RSS and the ratio of Forp to Python time.
+`--vm pygen` runs the programs through the Python code generation
+backend instead of a VM class; it has no instruction counts, and
+programs using call/cc or fibers still run on the VM.
+
+Results are written as JSON (`--out`); `--compare old.json` reports the
+change in wall time against an earlier run and exits non-zero if any
+benchmark got slower than `--threshold`.
+
+The `examples/project-euler` programs use syntax the compiler does not
+support yet, so they are run in adapted form (`euler1` to `euler3`), and
+the originals are recorded as skipped with their compile error.
+
+    python bench/runtime.py [--quick] [--vm MutableVM] [-O2] [--out results.json]
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import compiler
+import jit
+import parser
+import pygen
+import stdlib
+import vm
+
+FACTORIAL = """
+@:declare factl
+
+set! factl <- fn (n) <-
+    if (= n 0) 1 <-
+        * n <- factl <- - n 1
+
+print <- factl %(n)d
+"""
+
+def py_factorial(n):
+    acc = 1
+    for i in range(1, n + 1):
+        acc *= i
+    return acc
+
+FACTORIAL_TRO = """
+@:declare factl%% repeat
+
+set! factl%% <- fn (n acc) <-
+    if (= n 0) acc <-
+        factl%% (- n 1) (* acc n)
+
+set! repeat <- fn (k last) <-
+    if (= k 0) last <-
+        repeat (- k 1) (factl%% 20 1)
+
+print <- repeat %(n)d 0
+"""
+
+def py_factorial_tro(n):
+    last = 0
+    for k in range(n):
+        acc = 1
+        for i in range(20, 0, -1):
+            acc *= i
+        last = acc
+    return last
+
+CONTINUATIONS = """
+@:declare escape loop
+
+set! escape <- fn (return) <-
+    return 2
+
+set! loop <- fn (k acc) <-
+    if (= k 0) acc <-
+        loop (- k 1) (+ acc <- @:call/cc escape)
+
+print <- loop %(n)d 0
+"""
+
+class Escape(Exception): pass
+
+def py_continuations(n):
+    def escape(ret):
+        ret(2)
+    def ret(value):
+        raise Escape(value)
+    acc = 0
+    for k in range(n):
+        try:
+            value = escape(ret)
+        except Escape as e:
+            value = e.args[0]
+        acc += value
+    return acc
+
+ARITH = """
+@:declare loop
+
+set! loop <- fn (k acc) <-
+    if (= k 0) acc <-
+        loop (- k 1) (- (+ acc (* k 3)) (/ k 2))
+
+print <- loop %(n)d 0
+"""
+
+def py_arith(n):
+    acc = 0
+    for k in range(n, 0, -1):
+        acc = acc + k * 3 - k / 2
+    return acc
+
+DIVIDES = """
+set! divides? <- fn (d n) <-
+    = n <- * d <- / n d
+"""
+
+EULER1 = """
+@:declare divides? euler1
+""" + DIVIDES + """
+set! euler1 <- fn (n acc) <-
+    if (= n 0) acc <-
+        euler1 (- n 1) <-
+            if (divides? 3 n) (+ acc n) <-
+                if (divides? 5 n) (+ acc n) acc
+
+print <- euler1 (- %(n)d 1) 0
+"""
+
+def py_euler1(n):
+    return sum(i for i in range(1, n) if i % 3 == 0 or i % 5 == 0)
+
+# Euler 1 with the collection functions, filtering through a closure
+EULER1_COLLECTIONS = """
+@:declare divides? my-test
+""" + DIVIDES + """
+set! my-test <- fn (n) <-
+    if (divides? 3 n) #t (divides? 5 n)
+
+print <- sum <- filter my-test <- range %(n)d
+"""
+
+# The collection functions with a stdlib predicate, which has a kernel
+SUM_EVENS = """
+print <- sum <- filter even? <- range %(n)d
+"""
+
+def py_sum_evens(n):
+    return sum(i for i in range(n) if i % 2 == 0)
+
+# Sums the even values among the first n Fibonacci numbers; the first 33
+# are the ones not exceeding four million
+EULER2 = """
+@:declare even? euler2
+
+set! even? <- fn (n) <-
+    = n <- * 2 <- / n 2
+
+set! euler2 <- fn (k a b acc) <-
+    if (= k 0) acc <-
+        euler2 (- k 1) (+ a b) a <-
+            if (even? a) (+ acc a) acc
+
+print <- euler2 %(n)d 1 0 0
+"""
+
+def py_euler2(n):
+    a, b, acc = 1, 0, 0
+    for k in range(n):
+        if a % 2 == 0:
+            acc += a
+        a, b = a + b, a
+    return acc
+
+# Euler 2 over a stream of Fibonacci pairs, as one fused pass
+EULER2_STREAMS = """
+@:declare fibs
+
+set! fibs <- map (fn (p) (p 0)) <- iterate (fn (p) [(+ (p 0) (p 1)) (p 0)]) [1 0]
+
+print <- sum <- filter even? <- take %(n)d fibs
+"""
+
+EULER3 = """
+@:declare divides? euler3
+""" + DIVIDES + """
+set! euler3 <- fn (n d) <-
+    if (= n 1) d <-
+        if (divides? d n) (euler3 (/ n d) d) <-
+            euler3 n (+ d 1)
+
+print <- euler3 %(n)d 2
+"""
+
+def py_euler3(n):
+    d = 2
+    while n != 1:
+        if n % d == 0:
+            n /= d
+        else:
+            d += 1
+    return d
+
+# Spawns n fibers that each send their number over a channel, and sums
+# them as they arrive
+FIBERS = """
+@:declare results spawner collect
+
+set! results <- chan
+set! spawner <- fn (i) <-
+    if (= i 0) #0 <-
+        (fn (ignored) (spawner (- i 1))) (spawn (fn () (send results i)))
+
+set! collect <- fn (k acc) <-
+    if (= k 0) acc <-
+        collect (- k 1) (+ acc (recv results))
+
+spawner %(n)d
+print <- collect %(n)d 0
+"""
+
+def py_fibers(n):
+    return sum(range(1, n + 1))
+
+def source(path):
+    return lambda n: open(os.path.join(ROOT, path)).read()
+
+def template(text):
+    return lambda n: text.lstrip() % {"n": n}
+
+# name -> (make source from size, Python equivalent, sizes, quick sizes)
+BENCHMARKS = [
+    ("test/factorial", source("test/factorial.forp"), py_factorial, [10000], [10000]),
+    ("test/factorial-tro", source("test/factorial-tro.forp"), lambda n: py_factorial(6), [1], [1]),
+    ("factorial", template(FACTORIAL), py_factorial, [2000, 20000], [2000]),
+    ("factorial-tro", template(FACTORIAL_TRO), py_factorial_tro, [1000, 10000], [1000]),
+    ("continuations", template(CONTINUATIONS), py_continuations, [10000, 100000], [10000]),
+    ("arith", template(ARITH), py_arith, [10000, 100000], [10000]),
+    ("euler1", template(EULER1), py_euler1, [1000, 100000], [1000]),
+    ("euler1-collections", template(EULER1_COLLECTIONS), py_euler1, [1000, 100000], [1000]),
+    ("sum-evens", template(SUM_EVENS), py_sum_evens, [100000, 1000000], [100000]),
+    ("euler2", template(EULER2), py_euler2, [33, 5000], [33]),
+    ("euler2-streams", template(EULER2_STREAMS), py_euler2, [33, 5000], [33]),
+    ("euler3", template(EULER3), py_euler3, [600851475143, 600851475143 * 99991], [600851475143]),
+    ("fibers", template(FIBERS), py_fibers, [10000, 100000], [10000]),
+]
+
+# Original programs that do not compile yet
+SKIPPED = ["../examples/project-euler/%d.forp" % i for i in (1, 2, 3)]
+
+def count(machine, state):
+    """
+    Run `state` like `vm.run`, returning the number of instructions
+    """
+
+    code, table, fibers = machine.code, machine.table, machine.fibers
+    n = 0
+    with stdlib.invoked_by(machine.apply):
+        while True:
+            try:
+                if state is None:
+                    state = machine.next_fiber()
+                while True:
+                    for i in xrange(vm.BUDGET):
+                        op, a, b = code[state.car.pc]
+                        state = table[op](state.car, state, a, b)
+                        n += 1
+                    if fibers:
+                        fibers.append(state)
+                        state = fibers.popleft()
+            except vm.Switch as e:
+                n += 1
+                state = e.args[0]
+            except vm.HALT as e:
+                n += 1
+                if not machine.finished(e.args[0]):
+                    return n
+                state = None
+
+def redirected(out, fn, *args):
+    """
+    Call `fn` with stdout sent to the file descriptor `out`, returning its
+    result and the time it took
+    """
+
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(out, 1)
+    try:
+        start = time.time()
+        result = fn(*args)
+        return result, time.time() - start
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def quiet(fn, *args):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        return redirected(devnull, fn, *args)
+    finally:
+        os.close(devnull)
+
+def output(fn, *args):
+    """
+    Call `fn`, returning its result and the last line it printed
+    """
+
+    with tempfile.TemporaryFile() as f:
+        result, _ = redirected(f.fileno(), fn, *args)
+        f.seek(0)
+        lines = f.read().splitlines()
+    return result, lines[-1] if lines else None
+
+def run_one(name, size, vmclass, level, repeat):
+    """
+    Benchmark one program at one size in this process, returning a result
+    dictionary
+    """
+
+    make, py, sizes, quick = dict((b[0], b[1:]) for b in BENCHMARKS)[name]
+    sys.setrecursionlimit(100000)
+    ast = parser.from_str(make(size))
+    start = time.time()
+    program = pygen.load(ast, "<%s>" % name) if vmclass == "pygen" and not pygen.needs_vm(ast) else None
+    if program is not None:
+        compile_time = time.time() - start
+        instructions = None
+        _, printed = output(pygen.in_thread, program)
+        forp = min(quiet(pygen.in_thread, program)[1] for i in range(repeat))
+    else:
+        c = compiler.Compiler("<%s>" % name, level=level)
+        insts = c.compile(ast)
+        compile_time = time.time() - start
+        # pygen runs programs using call/cc, or nested too deeply, on the VM
+        machine_class = getattr(vm, vmclass, None) or getattr(jit, vmclass, vm.VM)
+
+        def fresh(machine_class=machine_class):
+            machine = machine_class(insts, c.consts)
+            return machine, machine.mk_state(len(c.symbol_table[0]))
+
+        # Count on the plain VM: JitVM runs part of the program as traces
+        instructions, _ = quiet(count, *fresh(vm.VM))
+        _, printed = output(vm.run, *fresh())
+        forp = min(quiet(vm.run, *fresh())[1] for i in range(repeat))
+    python = min(quiet(py, size)[1] for i in range(repeat))
+
+    return {
+        "correct": printed == str(py(size)),
+        "compile": compile_time,
+        "wall": forp,
+        "instructions": instructions,
+        "ips": instructions / forp if forp and instructions else None,
+        "python": python,
+        "ratio": forp / python if python else None,
+        "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def run_all(args):
+    results = {}
+    for name, make, py, sizes, quick in BENCHMARKS:
+        for size in (quick if args.quick else sizes):
+            key = "%s/%d" % (name, size)
+            cmd = [sys.executable, os.path.abspath(__file__), "--one", name, "--size", str(size),
+                   "--vm", args.vm, "-O%d" % args.level, "--repeat", str(args.repeat)]
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            if proc.returncode:
+                results[key] = {"error": err.strip().splitlines()[-1] if err.strip() else "exit %d" % proc.returncode}
+            else:
+                results[key] = json.loads(out)
+            print_result(key, results[key])
+
+    for path in SKIPPED:
+        try:
+            compiler.Compiler(path).compile(parser.from_file(os.path.join(ROOT, path)))
+        except Exception as e:
+            results[path] = {"skipped": "%s: %s" % (type(e).__name__, e)}
+            print_result(path, results[path])
+    return results
+
+def print_result(key, result):
+    if "wall" in result:
+        print "%-28s %9.4fs %12s %10.0f/s %7.1fx %8d KB%s" % (
+            key, result["wall"], result["instructions"] or "-", result["ips"] or 0,
+            result["ratio"] or 0, result["maxrss_kb"], "" if result["correct"] else "  WRONG OUTPUT")
+    else:
+        print "%-28s %s" % (key, result.get("error") or result.get("skipped"))
+    sys.stdout.flush()
+
+def compare(old, new, threshold):
+    """
+    Print the change in wall time of each benchmark in both runs; returns
+    the keys that got slower by more than `threshold`
+    """
+
+    slower = []
+    print
+    print "%-28s %10s %10s %8s" % ("benchmark", "old", "new", "change")
+    for key in sorted(new):
+        if "wall" not in new[key] or "wall" not in old.get(key, {}):
+            continue
+        change = new[key]["wall"] / old[key]["wall"] - 1
+        flag = ""
+        if change > threshold:
+            slower.append(key)
+            flag = "  REGRESSION"
+        print "%-28s %9.4fs %9.4fs %+7.1f%%%s" % (key, old[key]["wall"], new[key]["wall"], 100 * change, flag)
+    return slower
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.PIPE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser(description="Benchmark the Forp VM against Python")
+    argp.add_argument("--vm", default="VM", help="VM class to run (VM, MutableVM, ArrayVM or JitVM), or pygen")
+    argp.add_argument("-O", dest="level", type=int, default=1, help="optimization level")
+    argp.add_argument("--repeat", type=int, default=3, help="runs per benchmark; the best is kept")
+    argp.add_argument("--quick", action="store_true", help="only run the smallest sizes")
+    argp.add_argument("--out", help="write results to this JSON file")
+    argp.add_argument("--compare", help="compare against results in this JSON file")
+    argp.add_argument("--threshold", type=float, default=0.10, help="slowdown reported as a regression")
+    argp.add_argument("--one", help=argparse.SUPPRESS)
+    argp.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = argp.parse_args()
+
+    if args.one:
+        print json.dumps(run_one(args.one, args.size, args.vm, args.level, args.repeat))
+        sys.exit(0)
+
+    print "%-28s %10s %12s %12s %8s %11s" % ("benchmark", "wall", "insts", "insts/sec", "vs py", "peak rss")
+    results = run_all(args)
+    data = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "vm": args.vm,
+            "level": args.level,
+            "repeat": args.repeat,
+            "compiler": compiler.VERSION,
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for key in ("vm", "level"):
+            if old["meta"].get(key) != data["meta"][key]:
+                print "warning: comparing %s %s against %s" % (key, data["meta"][key], old["meta"].get(key))
+        if compare(old["results"], results, args.threshold):
+            sys.exit(1)
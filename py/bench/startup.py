@@ -0,0 +1,91 @@
+"""
+How long a program takes to start after a prelude
+
+For growing `synth.library` preludes, times running a one-line program
+after the prelude three ways: compiling the prelude and the program from
+source together, loading their compiled code from the `cache` and running
+it, and loading a prelude image saved by `image.save` and compiling only
+the program against it. Output is discarded.
+
+    python bench/startup.py [--quick] [size ...]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cache
+import compiler
+import image
+import parser
+import runtime
+import synth
+import vm
+
+SIZES = [100, 1000, 5000]
+REPEAT = 5
+
+PROGRAM = "print <- v0-x 1\n"
+
+def best(fn, *args):
+    """
+    The best time of `REPEAT` quiet calls of `fn`
+    """
+
+    return min(runtime.quiet(fn, *args)[1] for i in range(REPEAT))
+
+def from_source(path):
+    c = compiler.Compiler(path)
+    insts = c.compile(parser.from_file(path))
+    machine = vm.VM(insts, c.consts)
+    vm.run(machine, machine.mk_state(len(c.symbol_table[0])))
+
+def from_cache(path, entries):
+    n, code, consts = cache.Cache(entries).load(path)
+    machine = vm.VM(code, consts)
+    vm.run(machine, machine.mk_state(n))
+
+def from_image(path, program):
+    c, machine, frames = image.load(path, program)
+    image.extend(c, machine, frames, parser.from_file(program))
+
+def report(size, directory):
+    prelude = os.path.join(directory, "prelude-%d.forp" % size)
+    program = os.path.join(directory, "program.forp")
+    whole = os.path.join(directory, "whole-%d.forp" % size)
+    saved = os.path.join(directory, "prelude-%d.forpi" % size)
+    entries = os.path.join(directory, "cache")
+
+    source = synth.library(size)
+    with open(prelude, "w") as f:
+        f.write(source)
+    with open(program, "w") as f:
+        f.write(PROGRAM)
+    with open(whole, "w") as f:
+        f.write(source + PROGRAM)
+    image.save(saved, [prelude])
+    cache.Cache(entries).load(whole)
+
+    times = [best(from_source, whole), best(from_cache, whole, entries), best(from_image, saved, program)]
+    print "%6d %9d %8.4fs %8.4fs %8.4fs %6.1fx" % (
+        size, os.path.getsize(saved), times[0], times[1], times[2], times[0] / times[2])
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser(description="Time Forp startup after a prelude, with and without an image")
+    argp.add_argument("sizes", nargs="*", type=int, default=SIZES)
+    argp.add_argument("--quick", action="store_true", help="only the smallest size")
+    args = argp.parse_args()
+
+    sys.setrecursionlimit(100000)
+    directory = tempfile.mkdtemp()
+    try:
+        print "%6s %9s %9s %9s %9s %7s" % ("size", "bytes", "source", "cache", "image", "gain")
+        for size in args.sizes[:1] if args.quick else args.sizes:
+            report(size, directory)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,136 @@
+"""
+Synthetic Forp programs for front-end benchmarks
+
+Each generator takes a size and returns Forp source text; all of them
+are deterministic for a given `seed`. Run as a script to print one:
+
+    python bench/synth.py straight 1000
+    python bench/synth.py nested-if 50 --layout block
+"""
+
+import random
+
+LAYOUTS = ["paren", "arrow", "block"]
+
+def name(i, length):
+    """
+    A symbol `length` characters long, distinct for distinct `i`
+    """
+
+    base = "v%d" % i
+    return base + "-" * (length > len(base)) + "x" * max(0, length - len(base) - 1)
+
+def literal(rng):
+    kind = rng.randrange(4)
+    if kind == 0:
+        return str(rng.randrange(-1000, 100000))
+    elif kind == 1:
+        return "%d.%d" % (rng.randrange(1000), rng.randrange(1000))
+    elif kind == 2:
+        return '"%s"' % "".join(rng.choice("abcdefghij ") for i in range(rng.randrange(1, 12)))
+    else:
+        return rng.choice(["#t", "#f", "#?", "#0"])
+
+def straight(n, name_length=4, seed=0):
+    """
+    `n` top-level commands of arithmetic on a few variables
+    """
+
+    rng = random.Random(seed)
+    names = [name(i, name_length) for i in range(8)]
+    lines = ["@:declare " + " ".join(names)]
+    lines.extend("set! %s 0" % v for v in names)
+    for i in range(n):
+        target, a, b = rng.choice(names), rng.choice(names), rng.choice(names)
+        op = rng.choice("+-*")
+        lines.append("set! %s <- %s %s (* %s %d)" % (target, op, a, b, rng.randrange(1, 100)))
+    return "\n".join(lines) + "\n"
+
+def layered(depth, head, leaf, layout):
+    """
+    Nest `depth` forms, where `head(i)` is the text of form `i` before its
+    last argument and `leaf` is the innermost command. `layout` picks how
+    each last argument is attached: in parentheses, after `<-` on the same
+    line, or after `<-` as an indented block.
+    """
+
+    if layout == "paren":
+        src = "(%s)" % leaf
+        for i in reversed(range(depth)):
+            src = "(%s %s)" % (head(i), src)
+        return "print %s\n" % src
+    elif layout == "arrow":
+        return "print <- " + "".join("%s <- " % head(i) for i in range(depth)) + leaf + "\n"
+    elif layout == "block":
+        lines = ["print <-"]
+        for i in range(depth):
+            lines.append("    " * (i + 1) + head(i) + " <-")
+        lines.append("    " * (depth + 1) + leaf)
+        return "\n".join(lines) + "\n"
+    raise ValueError("Unknown layout %s" % layout)
+
+def nested_if(depth, layout="paren", name_length=1):
+    x = name(0, name_length)
+    return "@:declare %s\nset! %s 7\n" % (x, x) + layered(
+        depth, lambda i: "if (= %s %d) %d" % (x, i, i), "+ %s 0" % x, layout)
+
+def nested_fn(depth, layout="paren", name_length=1):
+    x = name(0, name_length)
+    return "@:declare %s\n" % x + layered(
+        depth, lambda i: "fn (%s)" % name(i + 1, name_length), "+ %s %s" % (x, name(depth, name_length)), layout)
+
+def literals(n, kind="array", per_line=20, seed=0):
+    """
+    `n` commands each printing an array or hash of `per_line` literals
+    """
+
+    rng = random.Random(seed)
+    lines = []
+    for i in range(n):
+        if kind == "array":
+            lines.append("print [%s]" % " ".join(literal(rng) for j in range(per_line)))
+        else:
+            lines.append("print {%s}" % " ".join("%d %s" % (j, literal(rng)) for j in range(per_line)))
+    return "\n".join(lines) + "\n"
+
+def long_names(n, name_length=64, seed=0):
+    return straight(n, name_length, seed)
+
+def library(n, per_table=20, seed=0):
+    """
+    `n` top-level functions, each calling the one before, and a table of
+    literals for every ten of them: a prelude that only defines things
+    """
+
+    rng = random.Random(seed)
+    fns = [name(i, 4) for i in range(n)]
+    tables = ["t%d" % i for i in range(0, n, 10)]
+    lines = ["@:declare " + " ".join(fns + tables), "set! %s <- fn (x) <- + x 1" % fns[0]]
+    for i in range(1, n):
+        lines.append("set! %s <- fn (x) <- if (< x %d) (%s (+ x %d)) (* x %d)" % (
+            fns[i], rng.randrange(1000), fns[i - 1], rng.randrange(1, 10), rng.randrange(1, 10)))
+    for table in tables:
+        lines.append("set! %s [%s]" % (table, " ".join(literal(rng) for j in range(per_table))))
+    return "\n".join(lines) + "\n"
+
+# name -> function of (size, layout)
+FAMILIES = {
+    "straight": lambda n, layout: straight(n),
+    "long-names": lambda n, layout: long_names(n),
+    "nested-if": lambda n, layout: nested_if(n, layout),
+    "nested-fn": lambda n, layout: nested_fn(n, layout),
+    "arrays": lambda n, layout: literals(n, "array"),
+    "hashes": lambda n, layout: literals(n, "hash"),
+    "library": lambda n, layout: library(n),
+}
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    argp = argparse.ArgumentParser(description="Print a synthetic Forp program")
+    argp.add_argument("family", choices=sorted(FAMILIES))
+    argp.add_argument("size", type=int)
+    argp.add_argument("--layout", choices=LAYOUTS, default="paren")
+    args = argp.parse_args()
+    sys.stdout.write(FAMILIES[args.family](args.size, args.layout))
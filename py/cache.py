@@ -0,0 +1,151 @@
+"""
+On-disk cache of compiled Forp programs
+
+Compiled code for `dir/name.forp` is kept in `dir/__forpcache__/` as
+`name-<key>.forpc`, where `key` hashes the source text together with the
+compiler and .forpc versions and the optimization level. Editing the source or upgrading the
+compiler changes the key, so stale entries are never read; they are
+deleted when the new entry is written. Entries kept in one directory for
+sources from many are named `name-<path>-<key>.forpc`, where `path`
+hashes the source's absolute path, so sources of the same name do not
+replace each other's entries.
+"""
+
+import hashlib
+import os
+import StringIO
+
+import compiler
+import forpc
+import parser
+
+DIRNAME = "__forpcache__"
+
+def path_key(path):
+    return hashlib.sha1(os.path.abspath(path)).hexdigest()[:8]
+
+def source_key(source, level):
+    h = hashlib.sha1()
+    h.update("compiler %d forpc %d level %d\n" % (compiler.VERSION, forpc.VERSION, level))
+    h.update(source)
+    return h.hexdigest()[:16]
+
+class Cache(object):
+    """
+    Compile Forp files through the cache, counting hits and misses
+
+    If `directory` is given, all entries go there instead of into a
+    `__forpcache__` directory next to each source file. `level` is the
+    optimization level to compile at.
+    """
+
+    def __init__(self, directory=None, level=1):
+        self.directory = directory
+        self.level = level
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    def entry(self, path, source):
+        """
+        Return the directory, name and path of the entry for the source
+        file at `path`, whose text is `source`:
+
+        >>> import shutil, tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> cache = Cache(os.path.join(root, "cache"))
+        >>> paths = [os.path.join(root, d, "test.forp") for d in "ab"]
+        >>> for path, value in zip(paths, [1, 2]):
+        ...     os.mkdir(os.path.dirname(path))
+        ...     with open(path, "w") as f:
+        ...         f.write("print %d\\n" % value)
+        >>> [len(cache.load(path)[1]) for path in paths + paths]
+        [4, 4, 4, 4]
+        >>> cache.stats()
+        {'hits': 2, 'misses': 2}
+        >>> shutil.rmtree(root)
+        """
+
+        directory = self.directory or os.path.join(os.path.dirname(path), DIRNAME)
+        name = os.path.splitext(os.path.basename(path))[0]
+        if self.directory:
+            name += "-" + path_key(path)
+        return directory, name, os.path.join(directory, "%s-%s.forpc" % (name, source_key(source, self.level)))
+
+    def load(self, path):
+        """
+        Return `(n, code, consts)` for the Forp source file at `path`,
+        compiling it only if no up-to-date entry exists. A truncated or
+        corrupt entry is compiled over:
+
+        >>> import shutil, tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> cache = Cache(directory)
+        >>> path = os.path.join(os.path.dirname(__file__), "test", "factorial.forp")
+        >>> compiled = cache.load(path)
+        >>> entry = cache.entry(path, open(path).read())[2]
+        >>> size = os.path.getsize(entry)
+        >>> for length in [0, 10, size // 2, size - 1]:
+        ...     with open(entry, "r+b") as f:
+        ...         f.truncate(length)
+        ...     assert cache.load(path) == compiled
+        >>> cache.load(path) == compiled
+        True
+        >>> cache.stats()
+        {'hits': 1, 'misses': 5}
+        >>> shutil.rmtree(directory)
+        """
+
+        source = open(path).read()
+        directory, name, entry = self.entry(path, source)
+
+        if os.path.exists(entry):
+            try:
+                result = forpc.load(entry)
+            except (ValueError, EnvironmentError):
+                pass # Corrupt or unreadable; recompile over it
+            else:
+                self.hits += 1
+                return result
+
+        self.misses += 1
+        c = compiler.Compiler(path, level=self.level)
+        insts = c.compile(parser.from_str(source, path))
+        buf = StringIO.StringIO()
+        forpc.dump(buf, len(c.symbol_table[0]), insts, c.consts)
+        data = buf.getvalue()
+
+        try:
+            self.store(directory, name, entry, data)
+        except EnvironmentError:
+            pass # Read-only location; run uncached
+        return forpc.loads(data, path)
+
+    def store(self, directory, name, entry, data):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmp = "%s.%d.tmp" % (entry, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.rename(tmp, entry)
+
+        for other in os.listdir(directory):
+            if other != os.path.basename(entry) and other.rsplit("-", 1)[0] == name and other.endswith(".forpc"):
+                try:
+                    os.remove(os.path.join(directory, other))
+                except EnvironmentError:
+                    pass
+
+default = Cache()
+
+def load(path):
+    return default.load(path)
+
+def stats():
+    return default.stats()
@@ -1,6 +1,182 @@
 import parser
 import common, stdlib
+import datastructs
+import optimize
 import sys
+import vm
+
+# Bump whenever the generated bytecode changes, so cached .forpc files
+# (see `cache`) are recompiled
+VERSION = 9
+
+class Label(object):
+    __slots__ = ["pc"]
+    def __init__(self):
+        self.pc = None
+
+class Emitter(object):
+    """
+    Collects the instructions of one compilation. Jump operands may be
+    `Label`s, which `code` turns into relative offsets once every label has
+    been placed.
+    """
+
+    def __init__(self):
+        self.insts = []
+
+    def label(self):
+        return Label()
+
+    def place(self, label):
+        label.pc = len(self.insts)
+
+    def emit(self, *inst):
+        self.insts.append(inst)
+        return len(self.insts) - 1
+
+    def patch(self, i, *inst):
+        self.insts[i] = inst
+
+    def code(self):
+        code = []
+        for pc, inst in enumerate(self.insts):
+            if len(inst) > 1 and isinstance(inst[1], Label):
+                inst = (inst[0], inst[1].pc - pc) + inst[2:]
+            code.append(inst)
+        return code
+
+class Scope(list):
+    """
+    The names bound at one level of the program, in slot order: the stdlib
+    (level 0), the top level (level 1), or a `fn` (level 2 and up).
+
+    A function reads enclosing functions' variables through its `captured`
+    vector of their context lists; `captures` holds the levels of those
+    scopes, in vector order.
+    """
+
+    def __init__(self, names, level):
+        list.__init__(self)
+        self.level = level
+        self.index = {}
+        self.captures = []
+        self.slots = {}
+        for name in names:
+            self.bind(name)
+
+    def bind(self, name):
+        """
+        Add `name`, returning whether it is new; a name bound twice keeps
+        its first slot
+        """
+
+        self.append(name)
+        if name in self.index:
+            return False
+        self.index[name] = len(self) - 1
+        return True
+
+    def capture(self, level):
+        if level not in self.slots:
+            self.slots[level] = len(self.captures)
+            self.captures.append(level)
+        return self.slots[level]
+
+class Pool(list):
+    """
+    The constants of one compilation, in the order `PUSH` operands index
+    them. Equal constants of the same type share one entry, and strings
+    are interned.
+    """
+
+    def __init__(self):
+        list.__init__(self)
+        self.index = {}
+
+    def add(self, value):
+        """
+        Return the index of `value`, adding it if it is new
+        """
+
+        if value.__class__ is str:
+            value = intern(value)
+        key = value.__class__, value
+        try:
+            n = self.index.get(key)
+        except TypeError: # Unhashable; never shared
+            n = key = None
+        if n is None:
+            n = len(self)
+            self.append(value)
+            if key is not None:
+                self.index[key] = n
+        return n
+
+# Levels below this are shared by the whole VM rather than captured
+VM_SCOPES = 2
+
+def is_symbol(ast, name):
+    return isinstance(ast, common.ForpObject) and isinstance(ast.obj, common.Symbol) and ast.obj.s[-1] == name
+
+def assignments(ast):
+    """
+    Map each name assigned by `set!` anywhere in `ast` to the values
+    assigned to it
+    """
+
+    names = {}
+    work = list(ast)
+    while work:
+        form = work.pop()
+        if isinstance(form, common.Form):
+            if len(form.l) == 3 and is_symbol(form.l[0], "set!") and isinstance(form.l[1].obj, common.Symbol):
+                names.setdefault(form.l[1].obj.s[0], []).append(form.l[2])
+            work.extend(form.l)
+    return names
+
+# Literals whose value is their only field
+SCALARS = set([common.Integer, common.Float, common.String, common.Bool])
+
+def quoted(ast):
+    """
+    The runtime value of the quoted datum `ast`: forms become `Cons`
+    lists, arrays and hashes `Vector`s and `HashMap`s, and symbols stay
+    `common.Symbol`s
+    """
+
+    obj = ast.obj
+    if obj.__class__ in SCALARS:
+        return vm.Q if obj[0] is common.Maybe else obj[0]
+    elif isinstance(ast, common.Form):
+        value = None
+        for item in reversed(ast.l):
+            value = datastructs.Cons(quoted(item), value)
+        return value
+    elif isinstance(obj, common.Array):
+        return datastructs.vector(*map(quoted, obj.a))
+    elif isinstance(obj, common.Hash):
+        return datastructs.hashmap(*[quoted(item) for pair in obj.d.items() for item in pair])
+    return obj
+
+def mentions(ast, name):
+    if isinstance(ast, common.Form):
+        return any(mentions(item, name) for item in ast.l)
+    return is_symbol(ast, name)
+
+def only_called(ast, name):
+    """
+    Whether the variable `name` appears in `ast` only as the function of
+    calls, outside any nested `fn`
+    """
+
+    if isinstance(ast, common.Form):
+        if not ast.l:
+            return True
+        elif is_symbol(ast.l[0], "fn"):
+            return not mentions(ast, name)
+        items = ast.l[1:] if is_symbol(ast.l[0], name) else ast.l
+        return all(only_called(item, name) for item in items)
+    return not is_symbol(ast, name)
 
 class Compiler(object):
     special_forms = {
@@ -8,16 +184,80 @@ class Compiler(object):
         "call/cc": "callcc", "quote": "quote"
     }
 
-    def __init__(self, file):
-        self.symbol_table = [[], stdlib.stdlib.keys()]
+    def __init__(self, file, level=1, incremental=False):
+        self.symbol_table = []
+        self.bindings = {} # name -> the scopes binding it, innermost last
+        self.push_scope(stdlib.stdlib.keys())
+        self.push_scope([])
         self.file = file
+        self.level = level
+        # Whether code compiled later, as in the REPL, may `set!` variables
+        # of code compiled now
+        self.incremental = incremental
+        self.assigned = {}
+        self.consts = Pool()
+
+    def push_scope(self, names):
+        self.symbol_table.insert(0, Scope([], len(self.symbol_table)))
+        for name in names:
+            self.bind(name)
+
+    def pop_scope(self):
+        scope = self.symbol_table.pop(0)
+        for name in scope.index:
+            self.bindings[name].pop()
+        return scope
+
+    def bind(self, name):
+        if self.symbol_table[0].bind(name):
+            self.bindings.setdefault(name, []).append(self.symbol_table[0])
 
     def lookup(self, ast):
-        for i, symbols in enumerate(self.symbol_table):
-            if ast.obj.s[0] in symbols:
-                return symbols.index(ast.obj.s[0]), i
+        """
+        Return the slot and the `Scope` of the variable named by `ast`
+        """
+
+        scopes = self.bindings.get(ast.obj.s[0])
+        if scopes:
+            return scopes[-1].index[ast.obj.s[0]], scopes[-1]
         raise SyntaxError("Unknown variable `%s`" % ":".join(ast.obj.s), (file, ast.meta["row"], ast.meta["col"], ":".join(ast.obj.s)))
 
+    def access(self, ast, op):
+        """
+        Emit a `GET` or `SET` (per `op`) of the variable named by `ast`
+        """
+
+        n, scope = self.lookup(ast)
+        if scope is self.symbol_table[0]:
+            self.out.emit(op + "L", n)
+        elif scope.level < VM_SCOPES:
+            self.out.emit(op + "G", n, scope.level)
+        else:
+            self.out.emit(op, n, self.symbol_table[0].capture(scope.level))
+
+    def operator(self, ast):
+        """
+        The opcode for a call `ast` of a stdlib operator, fiber primitive
+        or asynchronous function that no scope shadows, if it has the
+        arguments the opcode takes
+        """
+
+        head = ast.l[0]
+        if not isinstance(head.obj, common.Symbol) or len(head.obj.s) != 1:
+            return None
+        name = head.obj.s[0]
+        if name in vm.ARITH and len(ast.l) == 3:
+            op = vm.ARITH[name]
+        elif name in vm.FIBERS and len(ast.l) == vm.FIBERS[name][1] + 1:
+            op = vm.FIBERS[name][0]
+        elif id(stdlib.stdlib.get(name)) in stdlib.ASYNCHRONOUS:
+            op = "AWAIT"
+        else:
+            return None
+        if self.lookup(head)[1].level != 0:
+            return None
+        return op
+
     def is_native(self, ast):
         if not isinstance(ast.obj, common.Symbol):
             return False
@@ -28,34 +268,37 @@ class Compiler(object):
         else:
             return False
 
-        try:
-            self.lookup(common.ForpObject(common.Symbol(s=(name,)), col=ast.meta["col"], row=ast.meta["row"]))
-        except SyntaxError:
-            return name
-        else:
+        if self.bindings.get(name):
             return False
+        else:
+            return name
 
     def compile_expr(self, ast, tail=False):
         if isinstance(ast, common.Form):
-            return self.compile_command(ast, tail)
-        elif isinstance(ast.obj, common.Integer):
-            return [("PUSH", ast.obj.n)]
-        elif isinstance(ast.obj, common.Float):
-            return [("PUSH", ast.obj.x)]
-        elif isinstance(ast.obj, common.String):
-            return [("PUSH", '"%s"' % ast.obj.s)]
-        elif isinstance(ast.obj, common.Bool):
-            return [("PUSH", ast.obj.b)]
-        elif ast.obj is None:
-            return [("PUSH", "#0")]
+            self.compile_command(ast, tail)
+        elif ast.obj is None or ast.obj.__class__ in SCALARS:
+            self.out.emit("PUSH", self.consts.add(quoted(ast)))
         elif isinstance(ast.obj, common.Symbol):
-            n, l = self.lookup(ast)
-            return [("GET", n, l)]
+            self.access(ast, "GET")
+        elif isinstance(ast.obj, common.Array):
+            # Elements are evaluated right to left, like call arguments
+            for item in ast.obj.a[::-1]:
+                self.compile_expr(item)
+            self.out.emit("ARRAY", len(ast.obj.a))
+        elif isinstance(ast.obj, common.Hash):
+            for key, value in ast.obj.d.items()[::-1]:
+                self.compile_expr(value)
+                self.compile_expr(key)
+            self.out.emit("HASH", len(ast.obj.d))
         else:
             raise Exception(ast)
 
+    def emits_nothing(self, ast):
+        # Only `@:declare` compiles to no code at all
+        return isinstance(ast, common.Form) and bool(ast.l) and self.is_native(ast.l[0]) == "declare"
+
     def compile_quote(self, ast, tail=False):
-        return [("PUSH", ast.obj)]
+        self.out.emit("PUSH", self.consts.add(quoted(ast.l[1])))
 
     def compile_set(self, ast, tail=False):
         if len(ast.l) != 3:
@@ -63,91 +306,158 @@ class Compiler(object):
         if not isinstance(ast.l[1].obj, common.Symbol):
             raise NotImplementedError("`set!` currently only supports symbols", (file, ast.l[1].meta["row"], ast.l[1].meta["col"], ""))
 
-        n, l = self.lookup(ast.l[1])
-        return self.compile_expr(ast.l[2]) + [("SET", n, l)]
+        self.compile_expr(ast.l[2])
+        self.access(ast.l[1], "SET")
 
     def compile_declare(self, ast, tail=False):
         if any(not isinstance(arg.obj, common.Symbol) for arg in ast.l[1:]):
             raise SyntaxError("Can only `@:declare` symbols", (file, ast.l[1].meta["row"], ast.l[1].meta["col"]))
 
         for symbol in ast.l[1:]:
-            self.symbol_table[0].append(symbol.obj.s[0])
-        
-        return []
+            self.bind(symbol.obj.s[0])
 
     def compile_fn(self, ast, tail=False):
-        self.symbol_table.insert(0, [])
         assert len(ast) > 2, "At least 3 arguments to `fn` required"
 
         if any(not isinstance(arg.obj, common.Symbol) for arg in ast.l[1].l):
             raise NotImplementedError("Destructuring parameter lists not yet supported", (file, ast.l[1].meta["row"], ast.l[1].meta["col"], ""))
 
-        for symbol in ast.l[1].l:
-            self.symbol_table[0].append(symbol.obj.s[0])
+        self.push_scope(symbol.obj.s[0] for symbol in ast.l[1].l)
+
+        out = self.out
+        body, end = out.label(), out.label()
+        # The context size is only known once the body has been compiled
+        clsr = out.emit("CLSR", body, None)
+        out.emit("GOTO", end)
+        out.place(body)
+        for expr in ast.l[2:-1]:
+            self.compile_expr(expr)
+        self.compile_expr(ast.l[-1], tail=True)
+        out.emit("HALT")
 
-        body = sum(map(self.compile_expr, ast.l[2:-1]), []) + self.compile_expr(ast.l[-1], tail=True) + [("HALT",)]
-        body = [("CLSR", 2, len(self.symbol_table[0])), ("GOTO", len(body) + 1)] + body
-        del self.symbol_table[0]
-        return body
+        scope = self.pop_scope()
+        out.patch(clsr, "CLSR", body, len(scope))
+
+        # Fill the new closure's captured vector from the enclosing frame
+        out.place(end)
+        parent = self.symbol_table[0]
+        for level in scope.captures:
+            if level == parent.level:
+                out.emit("CAPL")
+            else:
+                out.emit("CAPT", parent.capture(level))
 
     def compile_if(self, ast, tail=False):
         if len(ast.l) < 3 or len(ast.l) > 5:
             raise SyntaxError("`if` statement requires at least three arguments and at most five", (file, ast.meta["row"], ast.meta["col"], "if"))
-        body = self.compile_expr(ast.l[1])
-        
-
-        trueclause  = self.compile_expr(ast.l[2], tail=tail) if len(ast.l) >= 3 else []
-        falseclause = self.compile_expr(ast.l[3], tail=tail) if len(ast.l) >= 4 else []
-        maybeclause = self.compile_expr(ast.l[4], tail=tail) if len(ast.l) >= 5 else []
-
-        if maybeclause: falseclause.append(("GOTO", len(maybeclause) + 1))
-        if falseclause: trueclause.append(("GOTO", len(falseclause) + len(maybeclause) + 1))
-
-        body += [("DUP", 1)] * (len(ast.l) - 3)
+        out = self.out
+        self.compile_expr(ast.l[1])
 
-        if len(ast.l) >= 3: body += [("IFT", len(ast.l)-1)]
-        if len(ast.l) >= 4: body += [("IFF", len(ast.l)-2 + len(trueclause))]
-        if len(ast.l) >= 5: body += [("IFQ", len(ast.l)-3 + len(trueclause) + len(falseclause))]
+        clauses = [out.label() for clause in ast.l[2:]]
+        end = out.label()
 
-        body.append(("GOTO", len(trueclause) + len(falseclause) + len(maybeclause) + 1))
-        body += trueclause + falseclause + maybeclause
+        for i in range(len(ast.l) - 3):
+            out.emit("DUP", 1)
+        for test, clause in zip(("IFT", "IFF", "IFQ"), clauses):
+            out.emit(test, clause)
+        out.emit("GOTO", end)
 
-        return body
+        for i, clause in enumerate(clauses):
+            out.place(clause)
+            self.compile_expr(ast.l[2 + i], tail=tail)
+            # Jump to the end, unless no code follows
+            if any(not self.emits_nothing(later) for later in ast.l[3 + i:]):
+                out.emit("GOTO", end)
+        out.place(end)
 
     def compile_command(self, ast, tail=False):
         if not isinstance(ast, common.Form):
             raise SyntaxError("Top-level command not really a command!", (file, ast.meta["row"], ast.meta["col"], ""))
 
         name = self.is_native(ast.l[0])
+        op = self.operator(ast)
         if name and name in self.special_forms:
             func = "compile_" + self.special_forms[name]
-            return getattr(self, func)(ast, tail=tail)
+            getattr(self, func)(ast, tail=tail)
+        elif op:
+            for arg in ast.l[:0:-1]:
+                self.compile_expr(arg)
+            if op == "AWAIT":
+                self.out.emit(op, self.lookup(ast.l[0])[0], len(ast.l) - 1)
+            else:
+                self.out.emit(op, self.lookup(ast.l[0])[0])
+            if tail:
+                self.out.emit("HALT")
         else:
-            insts = sum(map(self.compile_expr, ast.l[:0:-1]), [])
-            insts += self.compile_expr(ast.l[0])
-            insts.append(("CALL" if not tail else "CALLPOP", len(ast.l) - 1))
-            return insts
+            for arg in ast.l[:0:-1]:
+                self.compile_expr(arg)
+            self.compile_expr(ast.l[0])
+            self.out.emit("CALL" if not tail else "CALLPOP", len(ast.l) - 1)
+
+    def escapes_only(self, ast):
+        """
+        Whether the function `ast` passed to `@:call/cc` can only call its
+        continuation while it runs, so the continuation can be an escape:
+        its parameter must appear only as the function of calls in its own
+        body. A variable qualifies if it is a top-level one, assigned such a
+        function by the program's only `set!` of its name.
+        """
+
+        if isinstance(ast.obj, common.Symbol) and len(ast.obj.s) == 1:
+            values = self.assigned.get(ast.obj.s[0], [])
+            if len(values) != 1 or self.lookup(ast)[1].level != 1:
+                return False
+            ast = values[0]
+        if not isinstance(ast, common.Form) or len(ast.l) < 3 or self.is_native(ast.l[0]) != "fn":
+            return False
+        params = ast.l[1].l if isinstance(ast.l[1], common.Form) else []
+        if len(params) != 1 or not isinstance(params[0].obj, common.Symbol):
+            return False
+        return all(only_called(expr, params[0].obj.s[0]) for expr in ast.l[2:])
 
     def compile_callcc(self, ast, tail=False):
         if len(ast.l) != 2:
             raise SyntaxError("`@:call/cc` takes two arguments", (file, ast.meta["row"], ast.meta["col"], "call/cc"))
-        body = self.compile_expr(ast.l[1])
-        return body + [("PUSHCC", 3), ("ROT",), ("CALL", 1)]
+        self.compile_expr(ast.l[1])
+        resume = self.out.label()
+        self.out.emit("PUSHEC" if self.escapes_only(ast.l[1]) else "PUSHCC", resume)
+        self.out.emit("ROT")
+        self.out.emit("CALL", 1)
+        self.out.place(resume)
 
     def compile(self, ast):
         """
-        Compile AST to bytecode
+        Compile AST to bytecode, optimized at `self.level` (see `optimize`).
+        `PUSH` operands index `self.consts`, a new `Pool` for each call.
         """
 
-        cmds = sum(map(self.compile_command, ast), [])
-        cmds.append(("HALT",))
-        return cmds
+        self.out = Emitter()
+        self.consts = Pool()
+        self.assigned = {} if self.incremental else assignments(ast)
+        for cmd in ast:
+            self.compile_command(cmd)
+        self.out.emit("HALT")
+        return optimize.optimize(self.out.code(), self.consts, self.level, self.incremental)
 
 if __name__ == "__main__":
-    c = Compiler(sys.argv[1])
-    insts = c.compile(parser.from_file(sys.argv[1]))
+    level = 1
+    args = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("-O"):
+            level = int(arg[2:] or 1)
+        else:
+            args.append(arg)
+
+    c = Compiler(args[0], level=level)
+    insts = c.compile(parser.from_file(args[0]))
 
-    print len(c.symbol_table[0])
-    for inst in insts:
-        print inst[0].ljust(8), " ".join(map(str, inst[1:]))
+    if len(args) > 1:
+        import forpc
+        forpc.write(args[1], len(c.symbol_table[0]), insts, c.consts)
+    else:
+        print len(c.symbol_table[0])
+        for inst in insts:
+            if inst[0] == "PUSH":
+                inst = inst[0], vm.unliteral(c.consts[inst[1]])
+            print inst[0].ljust(8), " ".join(map(str, inst[1:]))
 
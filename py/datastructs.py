@@ -1,3 +1,6 @@
+import collections
+import itertools
+
 class Cons(object):
     def __init__(self, car=None, cdr=None):
         self.car = car
@@ -20,6 +23,14 @@ class Cons(object):
             self = self.cdr
         return l
 
+    def __reduce__(self):
+        # Flat, so pickling a long list does not recurse once per cell
+        items, node = [], self
+        while node.__class__ is Cons:
+            items.append(node.car)
+            node = node.cdr
+        return unlist, (items, node)
+
     def __getitem__(self, n):
         if isinstance(n, int):
             cell = self
@@ -28,20 +39,747 @@ class Cons(object):
                 cell = cell.cdr
             return cell.car
         elif isinstance(n, slice):
-            res = []
-            i = 0
-
-            curr = self
-            while i < slice.start:
-                curr = curr.cdr
-                i += 1
-            while i < slice.end:
-                j = 0
-                while j < slice.step:
-                    curr = curr.cdr
-                    j += 1
-                res.append(curr.car)
-                i += 1 + j
-            return res
+            return self.__list__()[n]
         else:
             raise TypeError("Cons does not support nonintegral indices")
+
+def unlist(items, end=None):
+    """
+    The `Cons` list of `items`, ending in `end`
+    """
+
+    for item in reversed(items):
+        end = Cons(item, end)
+    return end
+
+class Stream(Cons):
+    """
+    A lazy `Cons`: `rest` is called for the `cdr` the first time it is
+    needed, and the result kept. A stream ends in `None`, like a `Cons`
+    list, or goes on forever; `len` of an infinite stream never returns.
+    Its `repr` computes at most the first `SHOWN` values.
+    """
+
+    def __init__(self, car, rest):
+        self.car = car
+        self.rest = rest
+        self.tail = None
+
+    @property
+    def cdr(self):
+        if self.rest is not None:
+            self.tail, self.rest = self.rest(), None
+        return self.tail
+
+    def __reduce__(self):
+        raise TypeError("Streams cannot be pickled")
+
+    def __iter__(self):
+        node = self
+        while node is not None:
+            yield node.car
+            node = node.cdr
+
+    def __repr__(self):
+        # A prefix only, as the rest may be infinite
+        items, node = [], self
+        while isinstance(node, Cons) and len(items) < SHOWN:
+            items.append(show(node.car))
+            node = node.cdr
+        if isinstance(node, Cons):
+            items.append("...")
+        elif node is not None:
+            items.append(show(node))
+        return "(" + " ".join(items) + ")"
+
+# How many values of a stream its `repr` shows
+SHOWN = 10
+
+def from_iter(it):
+    """
+    A `Stream` of what is left of the iterator `it`
+    """
+
+    for value in it:
+        return Stream(value, lambda: from_iter(it))
+    return None
+
+class Iterate(object):
+    """
+    `x`, `fn(x)`, `fn(fn(x))`, ...
+    """
+
+    def __init__(self, fn, x):
+        self.fn = fn
+        self.x = x
+
+    def __iter__(self):
+        fn, x = self.fn, self.x
+        while True:
+            yield x
+            x = fn(x)
+
+class Pipeline(Stream):
+    """
+    The stream of `source`, any iterable, put through `steps`: functions
+    like `itertools.imap`, each paired with its first argument. Adding a
+    step to a pipeline (`fuse`) makes a longer pipeline over the same
+    source, so a chain of stream functions runs as one pass over the
+    source that builds no intermediate streams, and none at all unless
+    the result's `car` or `cdr` is asked for.
+    """
+
+    def __init__(self, source, steps):
+        self.source = source
+        self.steps = steps
+        self.node = self
+
+    def force(self):
+        if self.node is self:
+            self.node = from_iter(iter(self))
+        return self.node
+
+    car = property(lambda self: self.force().car)
+    cdr = property(lambda self: self.force().cdr)
+
+    def __iter__(self):
+        it = iter(self.source)
+        for step, arg in self.steps:
+            it = step(arg, it)
+        return it
+
+def fuse(coll, step, arg):
+    """
+    The stream of `coll` put through `step`
+    """
+
+    if isinstance(coll, Pipeline):
+        return Pipeline(coll.source, coll.steps + [(step, arg)])
+    return Pipeline(coll, [(step, arg)])
+
+def show(value):
+    if isinstance(value, str):
+        return '"%s"' % value
+    return str(value)
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+class Node(object):
+    """
+    A node of a `Vector` trie: `WIDTH` children, or `WIDTH` elements at the
+    bottom level. `edit` is the token of the transient allowed to change
+    it in place, if any.
+    """
+
+    __slots__ = ["edit", "array"]
+    def __init__(self, edit, array=None):
+        self.edit = edit
+        self.array = array if array is not None else [None] * WIDTH
+
+EMPTY_NODE = Node(None)
+
+def tailoff(count):
+    """
+    The index of the first element of the tail of a vector of `count`
+    elements
+    """
+
+    if count < WIDTH:
+        return 0
+    return ((count - 1) >> BITS) << BITS
+
+class Vector(object):
+    """
+    A persistent vector: a trie of `WIDTH`-way `Node`s holding all but the
+    last (up to `WIDTH`) elements, which are kept in a separate `tail`
+    list. Lookups and updates walk one node per `BITS` bits of the index,
+    and updates copy only that path, sharing the rest with the original.
+    """
+
+    __slots__ = ["count", "shift", "root", "tail"]
+    def __init__(self, count=0, shift=BITS, root=EMPTY_NODE, tail=()):
+        self.count = count
+        self.shift = shift
+        self.root = root
+        self.tail = tail
+
+    def array_for(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError("Vector index %d out of range" % i)
+        if i >= tailoff(self.count):
+            return self.tail
+        node = self.root
+        for level in range(self.shift, 0, -BITS):
+            node = node.array[(i >> level) & MASK]
+        return node.array
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += self.count
+        return self.array_for(i)[i & MASK]
+
+    def __call__(self, i):
+        return self[i]
+
+    def __iter__(self):
+        # Every leaf before the tail is full
+        leaves = (self.array_for(start) for start in xrange(0, tailoff(self.count), WIDTH))
+        return itertools.chain(itertools.chain.from_iterable(leaves), self.tail)
+
+    def __eq__(self, other):
+        if not isinstance(other, Vector) or len(self) != len(other):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __reduce__(self):
+        return vector, tuple(self)
+
+    def __repr__(self):
+        return "[" + " ".join(map(show, self)) + "]"
+
+    def conj(self, value):
+        """
+        A vector with `value` appended
+        """
+
+        if self.count - tailoff(self.count) < WIDTH:
+            return Vector(self.count + 1, self.shift, self.root, tuple(self.tail) + (value,))
+        root, shift = push_tail(self.count, self.shift, self.root, Node(None, list(self.tail)), None)
+        return Vector(self.count + 1, shift, root, (value,))
+
+    def assoc(self, i, value):
+        """
+        A vector with element `i` replaced by `value`; `i` may be the length
+        of the vector, to append
+        """
+
+        if i == self.count:
+            return self.conj(value)
+        if not 0 <= i < self.count:
+            raise IndexError("Vector index %d out of range" % i)
+        if i >= tailoff(self.count):
+            tail = list(self.tail)
+            tail[i & MASK] = value
+            return Vector(self.count, self.shift, self.root, tuple(tail))
+        return Vector(self.count, self.shift, assoc_path(self.shift, self.root, i, value, None), self.tail)
+
+    def pop(self):
+        """
+        A vector without its last element
+        """
+
+        if self.count == 0:
+            raise IndexError("Pop from an empty vector")
+        elif self.count == 1:
+            return EMPTY_VECTOR
+        elif self.count - tailoff(self.count) > 1:
+            return Vector(self.count - 1, self.shift, self.root, self.tail[:-1])
+
+        tail = tuple(self.array_for(self.count - 2))
+        root = pop_tail(self.count, self.shift, self.root)
+        shift = self.shift
+        if root is None:
+            root = EMPTY_NODE
+        elif shift > BITS and root.array[1] is None:
+            root = root.array[0]
+            shift -= BITS
+        return Vector(self.count - 1, shift, root, tail)
+
+    def transient(self):
+        return TransientVector(self)
+
+EMPTY_VECTOR = Vector()
+
+def editable(node, edit):
+    if edit is not None and node.edit is edit:
+        return node
+    return Node(edit, list(node.array))
+
+def new_path(level, node, edit):
+    while level:
+        node = Node(edit, [node] + [None] * (WIDTH - 1))
+        level -= BITS
+    return node
+
+def push_tail(count, shift, root, tail, edit):
+    """
+    Add the full `tail` node to the trie of a vector of `count`
+    elements; returns the new root and shift
+    """
+
+    if (count >> BITS) > (1 << shift):
+        return Node(edit, [root, new_path(shift, tail, edit)] + [None] * (WIDTH - 2)), shift + BITS
+
+    def push(level, parent):
+        i = ((count - 1) >> level) & MASK
+        node = editable(parent, edit)
+        if level == BITS:
+            node.array[i] = tail
+        elif parent.array[i] is not None:
+            node.array[i] = push(level - BITS, parent.array[i])
+        else:
+            node.array[i] = new_path(level - BITS, tail, edit)
+        return node
+    return push(shift, root), shift
+
+def assoc_path(level, node, i, value, edit):
+    node = editable(node, edit)
+    if level == 0:
+        node.array[i & MASK] = value
+    else:
+        j = (i >> level) & MASK
+        node.array[j] = assoc_path(level - BITS, node.array[j], i, value, edit)
+    return node
+
+def pop_tail(count, level, node):
+    i = ((count - 2) >> level) & MASK
+    if level > BITS:
+        child = pop_tail(count, level - BITS, node.array[i])
+        if child is None and i == 0:
+            return None
+        node = Node(None, list(node.array))
+        node.array[i] = child
+        return node
+    elif i == 0:
+        return None
+    node = Node(None, list(node.array))
+    node.array[i] = None
+    return node
+
+class TransientVector(object):
+    """
+    A mutable vector for building a `Vector` in a batch: it changes the
+    nodes it has copied in place, instead of copying them on every update.
+    `persistent` ends the batch.
+    """
+
+    def __init__(self, vector=EMPTY_VECTOR):
+        self.edit = object()
+        self.count = vector.count
+        self.shift = vector.shift
+        self.root = vector.root
+        self.tail = list(vector.tail)
+
+    def check(self):
+        if self.edit is None:
+            raise ValueError("Transient used after `persistent`")
+
+    def conj(self, value):
+        self.check()
+        if self.count - tailoff(self.count) < WIDTH:
+            self.tail.append(value)
+        else:
+            self.root, self.shift = push_tail(self.count, self.shift, self.root, Node(self.edit, self.tail), self.edit)
+            self.tail = [value]
+        self.count += 1
+        return self
+
+    def assoc(self, i, value):
+        self.check()
+        if i == self.count:
+            return self.conj(value)
+        if not 0 <= i < self.count:
+            raise IndexError("Vector index %d out of range" % i)
+        if i >= tailoff(self.count):
+            self.tail[i & MASK] = value
+        else:
+            self.root = assoc_path(self.shift, self.root, i, value, self.edit)
+        return self
+
+    def extend(self, values):
+        """
+        `conj` each of `values`, a leaf's worth at a time
+        """
+
+        self.check()
+        values = list(values)
+        i = 0
+        while i < len(values):
+            room = WIDTH - (self.count - tailoff(self.count))
+            if room:
+                chunk = values[i:i + room]
+                self.tail.extend(chunk)
+            else:
+                self.root, self.shift = push_tail(self.count, self.shift, self.root, Node(self.edit, self.tail), self.edit)
+                chunk = self.tail = values[i:i + WIDTH]
+            self.count += len(chunk)
+            i += len(chunk)
+        return self
+
+    def __len__(self):
+        return self.count
+
+    def persistent(self):
+        self.check()
+        self.edit = None
+        return Vector(self.count, self.shift, self.root, tuple(self.tail))
+
+def vector(*values):
+    return TransientVector().extend(values).persistent()
+
+class Leaf(object):
+    """
+    A key and its value in a `HashMap`, with the key's hash
+    """
+
+    __slots__ = ["hash", "key", "value"]
+    def __init__(self, hash, key, value):
+        self.hash = hash
+        self.key = key
+        self.value = value
+
+class BitmapNode(object):
+    """
+    A `HashMap` trie node. Bit `i` of `bitmap` is set if some key's hash has
+    `i` as its `BITS`-bit digit at this level; `array` holds, in bit order,
+    a `Leaf` or a child node for each set bit.
+    """
+
+    __slots__ = ["edit", "bitmap", "array"]
+    def __init__(self, edit, bitmap, array):
+        self.edit = edit
+        self.bitmap = bitmap
+        self.array = array
+
+class CollisionNode(object):
+    """
+    The `Leaf`s of keys whose hashes are equal
+    """
+
+    __slots__ = ["edit", "hash", "array"]
+    def __init__(self, edit, hash, array):
+        self.edit = edit
+        self.hash = hash
+        self.array = array
+
+EMPTY_ROOT = BitmapNode(None, 0, [])
+
+def key_hash(key):
+    return hash(key) & 0xFFFFFFFF
+
+def bitpos(h, shift):
+    return 1 << ((h >> shift) & MASK)
+
+def index(bitmap, bit):
+    return bin(bitmap & (bit - 1)).count("1")
+
+def owned(node, edit):
+    """
+    `node`, or a copy of it, that the transient with token `edit` (or, if
+    `None`, nobody) may change in place
+    """
+
+    if edit is not None and node.edit is edit:
+        return node
+    if node.__class__ is CollisionNode:
+        return CollisionNode(edit, node.hash, list(node.array))
+    return BitmapNode(edit, node.bitmap, list(node.array))
+
+def merge(shift, a, b, edit):
+    """
+    A node holding the `Leaf`s `a` and `b`, at depth `shift`
+    """
+
+    if a.hash == b.hash:
+        return CollisionNode(edit, a.hash, [a, b])
+    bit_a, bit_b = bitpos(a.hash, shift), bitpos(b.hash, shift)
+    if bit_a == bit_b:
+        return BitmapNode(edit, bit_a, [merge(shift + BITS, a, b, edit)])
+    return BitmapNode(edit, bit_a | bit_b, [a, b] if bit_a < bit_b else [b, a])
+
+def node_get(node, h, key, default):
+    shift = 0
+    while True:
+        if node.__class__ is CollisionNode:
+            for leaf in node.array:
+                if leaf.key == key:
+                    return leaf.value
+            return default
+        bit = bitpos(h, shift)
+        if not node.bitmap & bit:
+            return default
+        entry = node.array[index(node.bitmap, bit)]
+        if entry.__class__ is Leaf:
+            return entry.value if entry.hash == h and entry.key == key else default
+        node, shift = entry, shift + BITS
+
+def node_assoc(node, shift, leaf, edit):
+    """
+    Add `leaf` under `node`; returns the new node and whether the key is
+    new
+    """
+
+    if node.__class__ is CollisionNode:
+        if leaf.hash != node.hash:
+            node = BitmapNode(edit, bitpos(node.hash, shift), [node])
+            return node_assoc(node, shift, leaf, edit)
+        for i, old in enumerate(node.array):
+            if old.key == leaf.key:
+                node = owned(node, edit)
+                node.array[i] = leaf
+                return node, False
+        node = owned(node, edit)
+        node.array.append(leaf)
+        return node, True
+
+    bit = bitpos(leaf.hash, shift)
+    i = index(node.bitmap, bit)
+    if not node.bitmap & bit:
+        node = owned(node, edit)
+        node.array.insert(i, leaf)
+        node.bitmap |= bit
+        return node, True
+
+    entry = node.array[i]
+    if entry.__class__ is Leaf:
+        if entry.hash == leaf.hash and entry.key == leaf.key:
+            if entry.value is leaf.value:
+                return node, False
+            entry, added = leaf, False
+        else:
+            entry, added = merge(shift + BITS, entry, leaf, edit), True
+    else:
+        child, added = node_assoc(entry, shift + BITS, leaf, edit)
+        if child is entry:
+            return node, added
+        entry = child
+    node = owned(node, edit)
+    node.array[i] = entry
+    return node, added
+
+def node_dissoc(node, shift, h, key, edit):
+    """
+    Remove `key` from under `node`; returns the new node, a lone `Leaf`
+    left over, or `None` if nothing is left
+    """
+
+    if node.__class__ is CollisionNode:
+        for i, leaf in enumerate(node.array):
+            if leaf.key == key:
+                if len(node.array) == 2:
+                    return node.array[1 - i]
+                node = owned(node, edit)
+                del node.array[i]
+                return node
+        return node
+
+    bit = bitpos(h, shift)
+    if not node.bitmap & bit:
+        return node
+    i = index(node.bitmap, bit)
+    entry = node.array[i]
+    if entry.__class__ is Leaf:
+        if entry.hash != h or entry.key != key:
+            return node
+        child = None
+    else:
+        child = node_dissoc(entry, shift + BITS, h, key, edit)
+        if child is entry:
+            return node
+        if child.__class__ is BitmapNode and len(child.array) == 1 and child.array[0].__class__ is Leaf:
+            child = child.array[0]
+
+    if child is not None:
+        node = owned(node, edit)
+        node.array[i] = child
+    elif node.bitmap == bit:
+        return None
+    else:
+        node = owned(node, edit)
+        del node.array[i]
+        node.bitmap ^= bit
+    return node
+
+def node_leaves(node):
+    work = [node]
+    while work:
+        node = work.pop()
+        for entry in reversed(node.array):
+            if entry.__class__ is Leaf:
+                yield entry
+            else:
+                work.append(entry)
+
+def root_of(node, edit):
+    """
+    Make what `node_dissoc` returned for the root into a root node
+    """
+
+    if node is None:
+        return EMPTY_ROOT
+    elif node.__class__ is Leaf:
+        return BitmapNode(edit, bitpos(node.hash, 0), [node])
+    return node
+
+MISSING = object()
+
+class HashMap(object):
+    """
+    A persistent hash map, stored as a hash array mapped trie: each level
+    of `BitmapNode`s branches on the next `BITS` bits of the keys' hashes,
+    storing only the branches in use. Updates copy the path to the
+    changed key, sharing the rest of the trie with the original.
+    """
+
+    __slots__ = ["count", "root"]
+    def __init__(self, count=0, root=EMPTY_ROOT):
+        self.count = count
+        self.root = root
+
+    def get(self, key, default=None):
+        return node_get(self.root, key_hash(key), key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __call__(self, key):
+        return self.get(key)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (leaf.key for leaf in node_leaves(self.root))
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [leaf.value for leaf in node_leaves(self.root)]
+
+    def items(self):
+        return [(leaf.key, leaf.value) for leaf in node_leaves(self.root)]
+
+    def __eq__(self, other):
+        if not isinstance(other, HashMap) or len(self) != len(other):
+            return False
+        return all(other.get(key, MISSING) == value for key, value in self.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __reduce__(self):
+        return hashmap, tuple(item for pair in self.items() for item in pair)
+
+    def __repr__(self):
+        return "{" + " ".join("%s %s" % (show(key), show(value)) for key, value in self.items()) + "}"
+
+    def assoc(self, key, value):
+        """
+        A map with `key` mapped to `value`
+        """
+
+        root, added = node_assoc(self.root, 0, Leaf(key_hash(key), key, value), None)
+        if root is self.root:
+            return self
+        return HashMap(self.count + added, root)
+
+    def dissoc(self, key):
+        """
+        A map without `key`
+        """
+
+        root = node_dissoc(self.root, 0, key_hash(key), key, None)
+        if root is self.root:
+            return self
+        return HashMap(self.count - 1, root_of(root, None))
+
+    def transient(self):
+        return TransientHashMap(self)
+
+EMPTY_HASH_MAP = HashMap()
+
+class TransientHashMap(object):
+    """
+    A mutable hash map for building a `HashMap` in a batch, like
+    `TransientVector`
+    """
+
+    def __init__(self, hashmap=EMPTY_HASH_MAP):
+        self.edit = object()
+        self.count = hashmap.count
+        self.root = hashmap.root
+
+    def check(self):
+        if self.edit is None:
+            raise ValueError("Transient used after `persistent`")
+
+    def assoc(self, key, value):
+        self.check()
+        self.root, added = node_assoc(self.root, 0, Leaf(key_hash(key), key, value), self.edit)
+        self.count += added
+        return self
+
+    def dissoc(self, key):
+        self.check()
+        h = key_hash(key)
+        # Nodes this transient owns change in place, so whether the root
+        # changed does not tell whether the key was there
+        if node_get(self.root, h, key, MISSING) is not MISSING:
+            self.root = root_of(node_dissoc(self.root, 0, h, key, self.edit), self.edit)
+            self.count -= 1
+        return self
+
+    def get(self, key, default=None):
+        return node_get(self.root, key_hash(key), key, default)
+
+    def __len__(self):
+        return self.count
+
+    def persistent(self):
+        self.check()
+        self.edit = None
+        return HashMap(self.count, self.root)
+
+def hashmap(*items):
+    """
+    A `HashMap` of the keys and values alternating in `items`
+    """
+
+    t = TransientHashMap()
+    for i in range(0, len(items), 2):
+        t.assoc(items[i], items[i + 1])
+    return t.persistent()
+
+class Channel(object):
+    """
+    A FIFO of values passed between fibers, holding at most `capacity`
+    of them; see `vm.FIBERS`. The VM parks the states of fibers blocked
+    sending to or receiving from it in `senders` and `receivers`.
+    """
+
+    __slots__ = ["capacity", "buffer", "senders", "receivers"]
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.buffer = collections.deque()
+        self.senders = collections.deque()
+        self.receivers = collections.deque()
+
+    def __reduce__(self):
+        raise TypeError("Channels cannot be pickled")
+
+    def __repr__(self):
+        return "<chan %d/%d>" % (len(self.buffer), self.capacity)
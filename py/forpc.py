@@ -0,0 +1,172 @@
+"""
+Reading and writing compiled Forp bytecode (`.forpc` files)
+
+A `.forpc` file is laid out as:
+
+  - a header: the magic string `FRPC`, a format version, the number of
+    top-level symbols, the number of constants, the number of
+    instructions and the CRC-32 of the rest of the file;
+  - the constant pool, one tagged entry per constant;
+  - the instructions, each three little-endian 32-bit integers
+    `opcode a b`, where `opcode` indexes `vm.OPCODES` and the operand of a
+    `PUSH` indexes the constant pool.
+
+All integers are little-endian.
+"""
+
+import array
+import mmap
+import struct
+import sys
+import zlib
+
+import common
+import datastructs
+import vm
+
+MAGIC   = "FRPC"
+VERSION = 4
+
+HEADER = struct.Struct("<4sHIIII")
+INT    = struct.Struct("<q")
+FLOAT  = struct.Struct("<d")
+LENGTH = struct.Struct("<I")
+INST   = struct.Struct("<iii")
+
+def encode_const(value):
+    if value is None:
+        return "n"
+    elif value is True:
+        return "t"
+    elif value is False:
+        return "f"
+    elif value is vm.Q:
+        return "q"
+    elif isinstance(value, (int, long)):
+        if -2**63 <= value < 2**63:
+            return "i" + INT.pack(value)
+        else:
+            digits = str(value)
+            return "I" + LENGTH.pack(len(digits)) + digits
+    elif isinstance(value, float):
+        return "d" + FLOAT.pack(value)
+    elif isinstance(value, str):
+        return "s" + LENGTH.pack(len(value)) + value
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+        return "u" + LENGTH.pack(len(value)) + value
+    # Quoted data; see `compiler.quoted`
+    elif isinstance(value, common.Symbol):
+        return "y" + LENGTH.pack(len(value.s)) + "".join(map(encode_const, value.s))
+    elif isinstance(value, datastructs.Cons):
+        items = value.__list__()
+        return "l" + LENGTH.pack(len(items)) + "".join(map(encode_const, items))
+    elif isinstance(value, datastructs.Vector):
+        return "v" + LENGTH.pack(len(value)) + "".join(map(encode_const, value))
+    elif isinstance(value, datastructs.HashMap):
+        items = [item for pair in value.items() for item in pair]
+        return "h" + LENGTH.pack(len(value)) + "".join(map(encode_const, items))
+    else:
+        raise ValueError("Cannot store constant `%r` in a .forpc file" % (value,))
+
+def decode_const(buf, off):
+    tag = buf[off]
+    off += 1
+    if tag in "ntfq":
+        return {"n": None, "t": True, "f": False, "q": vm.Q}[tag], off
+    elif tag == "i":
+        return INT.unpack_from(buf, off)[0], off + INT.size
+    elif tag == "d":
+        return FLOAT.unpack_from(buf, off)[0], off + FLOAT.size
+    elif tag in "Isu":
+        length, = LENGTH.unpack_from(buf, off)
+        off += LENGTH.size
+        data = buf[off:off + length]
+        value = {"I": long, "s": intern, "u": lambda s: s.decode("utf-8")}[tag](data)
+        return value, off + length
+    elif tag in "ylvh":
+        length, = LENGTH.unpack_from(buf, off)
+        off += LENGTH.size
+        items = []
+        for i in range(length * 2 if tag == "h" else length):
+            item, off = decode_const(buf, off)
+            items.append(item)
+        if tag == "y":
+            return common.Symbol(tuple(items)), off
+        elif tag == "l":
+            value = None
+            for item in reversed(items):
+                value = datastructs.Cons(item, value)
+            return value, off
+        return {"v": datastructs.vector, "h": datastructs.hashmap}[tag](*items), off
+    else:
+        raise ValueError("Unknown constant tag `%s` at offset %d" % (tag, off - 1))
+
+def dump(stream, n, insts, consts):
+    """
+    Write `n` top-level symbols, the instruction tuples `insts` and their
+    constant pool `consts` (as produced by `compiler.Compiler.compile`) to
+    `stream` in .forpc format
+    """
+
+    body = []
+    for inst in insts:
+        args = list(inst[1:]) + [0] * (3 - len(inst))
+        body.append(INST.pack(vm.OPS[inst[0]], int(args[0]), int(args[1])))
+
+    data = "".join(map(encode_const, consts)) + "".join(body)
+    stream.write(HEADER.pack(MAGIC, VERSION, n, len(consts), len(body), checksum(data)))
+    stream.write(data)
+
+def write(path, n, insts, consts):
+    with open(path, "wb") as f:
+        dump(f, n, insts, consts)
+
+def checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def loads(buf, name="<string>"):
+    """
+    Parse a .forpc image held in `buf` (a string or an mmap) and return
+    `(n, code, consts)`, ready to be passed as `vm.VM(code, consts)`.
+    Raises `ValueError` if `buf` is not a whole, valid image.
+    """
+
+    if len(buf) < HEADER.size:
+        raise ValueError("`%s` is truncated" % name)
+    magic, version, n, nconsts, ninsts, crc = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("`%s` is not a compiled Forp file" % name)
+    if version != VERSION:
+        raise ValueError("`%s` has format version %d, expected %d" % (name, version, VERSION))
+    # A buffer, so an mmap is not copied to be checked
+    if checksum(buffer(buf, HEADER.size)) != crc:
+        raise ValueError("`%s` is truncated or corrupt" % name)
+
+    off = HEADER.size
+    consts = []
+    for i in range(nconsts):
+        value, off = decode_const(buf, off)
+        consts.append(value)
+
+    words = array.array("i")
+    assert words.itemsize == 4, "32-bit array items required"
+    words.fromstring(buf[off:off + INST.size * ninsts])
+    if sys.byteorder != "little":
+        words.byteswap()
+
+    code = zip(words[0::3], words[1::3], words[2::3])
+    return n, code, consts
+
+def load(path):
+    """
+    Map the .forpc file at `path` and parse it with `loads`
+    """
+
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        return loads(buf, path)
+    finally:
+        buf.close()
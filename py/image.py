@@ -0,0 +1,174 @@
+"""
+Images of a program's state after running its prelude, for fast startup
+
+`save` compiles and runs prelude files on a fresh VM, as the REPL would
+one after another, and writes an image of the result: the VM's code and
+constants, the top-level variables' names in slot order, and the stdlib
+and top-level contexts, closures included, pickled as by `parallel`.
+`load` turns an image back into a compiler, a VM and frames ready to run
+more code against the prelude's variables, without parsing, compiling or
+running the prelude again; `run` runs a program that way.
+
+An image holds the versions of the compiler and the stdlib it was made
+with, and the hashes of its preludes' sources, so `current` can tell
+when it needs saving again. Prelude variables cannot hold values that do
+not pickle, such as streams and channels, and fibers still running when
+the preludes end are not saved.
+
+    python image.py save prelude.forpi prelude.forp ...
+    python image.py run prelude.forpi program.forp [prelude.forp ...]
+
+`run` given the preludes saves the image first if it is not current.
+"""
+
+import cPickle
+import gc
+import hashlib
+import os
+
+import compiler
+import jit
+import parallel
+import parser
+import stdlib
+import vm
+
+VERSION = 1
+
+def source_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def header(preludes, level, machine_class):
+    return {
+        "version": VERSION,
+        "compiler": compiler.VERSION,
+        "stdlib": list(stdlib.stdlib.keys()),
+        "vm": machine_class.__name__,
+        "level": level,
+        "sources": [(path, source_hash(path)) for path in preludes],
+    }
+
+def extend(c, machine, frames, ast):
+    """
+    Compile `ast` with the incremental compiler `c` and run it on
+    `machine`, in the top-level context of `frames`; returns the final
+    frames, as in `repl.eval_ast`
+    """
+
+    insts = c.compile(ast)
+    top = frames.car
+    top.context.extend([None] * (len(c.symbol_table[0]) - len(top.context)))
+    start = machine.load(insts, c.consts)
+    return vm.run(machine, vm.Cons(vm.Frame(machine.new_stack(), top.fn, start, top.context, top.captured), frames.cdr))
+
+def save(path, preludes, level=1, machine_class=vm.VM):
+    """
+    Run the files `preludes` and write their image to `path`
+    """
+
+    c = compiler.Compiler(preludes[-1] if preludes else "#?", level=level, incremental=True)
+    machine = machine_class([])
+    frames = machine.mk_state(0)
+    for prelude in preludes:
+        c.file = prelude
+        frames = extend(c, machine, frames, parser.from_file(prelude))
+
+    body = parallel.dumps({
+        "code": machine.code,
+        "consts": machine.consts,
+        "done": machine.done,
+        "names": list(c.symbol_table[0]),
+        # Together, so values shared between them stay shared
+        "contexts": machine.scopes,
+    })
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        cPickle.dump(header(preludes, level, machine_class), f, 2)
+        f.write(body)
+    os.rename(tmp, path)
+
+def read_header(f):
+    try:
+        saved = cPickle.Unpickler(f).load()
+    except (cPickle.UnpicklingError, EOFError, ValueError, KeyError, IndexError):
+        saved = None
+    if not isinstance(saved, dict) or "version" not in saved:
+        raise ValueError("`%s` is not a Forp image" % f.name)
+    return saved
+
+def current(path, preludes):
+    """
+    Whether the image at `path` exists and was saved from `preludes`, as
+    they are now, by this compiler and stdlib
+    """
+
+    try:
+        with open(path, "rb") as f:
+            saved = read_header(f)
+        return saved == header(preludes, saved["level"], machine_class(saved))
+    except (EnvironmentError, ValueError, KeyError, AttributeError):
+        return False
+
+def machine_class(saved):
+    return getattr(vm, saved["vm"], None) or getattr(jit, saved["vm"])
+
+def load(path, file="#?"):
+    """
+    Read the image at `path` back; returns `(c, machine, frames)`, the
+    compiler for the code `file` to run after the preludes, the VM and its
+    top-level frames
+    """
+
+    with open(path, "rb") as f:
+        saved = read_header(f)
+        if saved["version"] != VERSION or saved["compiler"] != compiler.VERSION:
+            raise ValueError("`%s` was saved by another version of Forp" % path)
+        elif saved["stdlib"] != list(stdlib.stdlib.keys()):
+            raise ValueError("`%s` was saved with another stdlib" % path)
+        # The collector would walk the objects over and over as they are
+        # made, though unpickling makes no garbage
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            body = parallel.loads(f.read())
+        finally:
+            if enabled:
+                gc.enable()
+
+    c = compiler.Compiler(file, level=saved["level"], incremental=True)
+    for name in body["names"]:
+        c.bind(name)
+    machine = machine_class(saved)(body["code"], [])
+    machine.consts = body["consts"]
+    machine.done = body["done"]
+
+    frames = machine.mk_state(len(body["names"]))
+    machine.scopes = body["contexts"]
+    frames.cdr.car.context, frames.car.context = machine.scopes
+    return c, machine, frames
+
+def run(path, program, preludes=None):
+    """
+    Run the file `program` after the preludes in the image at `path`,
+    saving it first from `preludes`, if given, unless it is current;
+    returns the final frames
+    """
+
+    if preludes is not None and not current(path, preludes):
+        save(path, preludes)
+    c, machine, frames = load(path, program)
+    return extend(c, machine, frames, parser.from_file(program))
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 4 or sys.argv[1] not in ("save", "run"):
+        print "Usage: python image.py save image.forpi prelude.forp ..."
+        print "       python image.py run image.forpi program.forp [prelude.forp ...]"
+        sys.exit(1)
+
+    if sys.argv[1] == "save":
+        save(sys.argv[2], sys.argv[3:])
+    else:
+        run(sys.argv[2], sys.argv[3], sys.argv[4:] or None)
@@ -0,0 +1,298 @@
+"""
+Tracing JIT for self tail-recursive loops
+
+`JitVM` counts tail calls (`CALLPOP`) into each function. Once a function
+has been tail-called `THRESHOLD` times, the VM records one pass through
+it, from its entry to the tail call back to itself, and compiles the
+recorded path into a Python function. Later tail calls into the function
+run that function, which loops until a guard fails:
+
+  - a conditional jump going the other way than when recorded,
+  - a called stdlib function not being the one recorded,
+  - an operand of an inlined arithmetic operator changing type, or
+  - the tail call going to a different function.
+
+On a failed guard the frame is rebuilt as the interpreter would have left
+it at that instruction, and interpretation resumes there.
+
+Paths containing anything but stack, variable and jump instructions,
+calls of stdlib functions and the closing tail call (closures, other
+calls, `call/cc`) are not traced. Such functions are not retried.
+
+The compiler never emits backward jumps, so self tail calls are the only
+loops there are.
+"""
+
+import operator
+
+from datastructs import Cons
+import vm
+
+THRESHOLD = 50
+MAX_TRACE = 500
+
+OPS = vm.OPS
+# Instructions a trace may contain, besides `CALL` and `CALLPOP`
+TRACEABLE = set(OPS[name] for name in ("NOOP", "POP", "PUSH", "ROT", "DUP", "GETL", "SETL", "GET",
+                                       "SET", "GETG", "SETG", "GOTO", "IFT", "IFF", "IFQ"))
+BRANCHES = set(OPS[name] for name in ("IFT", "IFF", "IFQ"))
+OPERATORS = set(OPS[name] for name in vm.ARITH.values())
+# Specialized call instructions are recorded as the generic ones
+GENERIC = dict((OPS[name], OPS[generic]) for name, generic in vm.SPECIALIZED.items())
+INLINE = {operator.add: "+", operator.sub: "-", operator.mul: "*", operator.div: "/", operator.eq: "=="}
+NUMBERS = (int, long, float)
+
+def type_guard(value, cls):
+    """
+    A Python test that `value` still has the recorded class `cls`; ints
+    and longs count as one type, since ints overflow into longs
+    """
+
+    if cls in (int, long):
+        return "(%s.__class__ is int or %s.__class__ is long)" % (value, value)
+    return "%s.__class__ is %s" % (value, cls.__name__)
+
+class TraceCompiler(object):
+    """
+    Compile a recorded path, a list of `(pc, op, a, b, info)` entries, to
+    the source of a function `trace(vm, frame, frames)`
+    """
+
+    def __init__(self, machine, entry, path):
+        self.machine = machine
+        self.entry = entry
+        self.path = path
+        self.lines = []
+        self.count = 0
+        self.env = {"Cons": Cons, "Func": vm.Func, "Q": vm.Q}
+        self.bools = set()
+
+    def fresh(self):
+        self.count += 1
+        return "t%d" % self.count
+
+    def line(self, text, depth=2):
+        self.lines.append("    " * depth + text)
+
+    def value(self, obj):
+        """
+        Name a Python object the trace refers to
+        """
+
+        name = "k%d" % len(self.env)
+        self.env[name] = obj
+        return name
+
+    def exit(self, pc, stack, depth=3):
+        """
+        Leave the trace at `pc` with the symbolic `stack`, bottom first
+        """
+
+        materialized = "base"
+        for item in stack:
+            materialized = "Cons(%s, %s)" % (item, materialized)
+        self.line("frame.context, frame.captured = ctx, captured", depth)
+        self.line("frame.stack, frame.pc = %s, %d" % (materialized, pc), depth)
+        self.line("return frames", depth)
+
+    def slot(self, name, n, k):
+        """
+        The variable the `GET` or `SET` family instruction `name` reads or
+        writes
+        """
+
+        if name.endswith("L"):
+            return "ctx[%d]" % n
+        elif name.endswith("G"):
+            return "scopes[%d][%d]" % (k, n)
+        return "captured[%d][%d]" % (k, n)
+
+    def compile(self):
+        self.line("ctx, captured, base = frame.context, frame.captured, frame.stack", 1)
+        self.line("scopes = vm.scopes", 1)
+        self.line("while True:", 1)
+
+        stack = []
+        for pc, op, a, b, info in self.path:
+            name = vm.OPCODES[op]
+            if name == "PUSH":
+                stack.append(self.value(self.machine.consts[a]))
+            elif name in ("GETL", "GET", "GETG"):
+                t = self.fresh()
+                self.line("%s = %s" % (t, self.slot(name, a, b)))
+                stack.append(t)
+            elif name in ("SETL", "SET", "SETG"):
+                self.line("%s = %s" % (self.slot(name, a, b), stack.pop()))
+            elif name == "POP":
+                stack.pop()
+            elif name == "DUP":
+                stack.append(stack[-1])
+            elif name == "ROT":
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            elif op in BRANCHES:
+                self.branch(pc, op, a, info, stack)
+            elif name == "CALL":
+                self.call(pc, a, info, stack)
+            elif op in OPERATORS:
+                self.operator(pc, a, info, stack)
+            elif name == "CALLPOP":
+                self.loop(pc, a, stack)
+        return "def trace(vm, frame, frames):\n" + "\n".join(self.lines) + "\n"
+
+    def branch(self, pc, op, delta, taken, stack):
+        c = stack.pop()
+        if op == OPS["IFT"]:
+            test = c if c in self.bools else "%s and %s != Q" % (c, c)
+        elif op == OPS["IFF"]:
+            test = "not " + c if c in self.bools else "not %s and %s != Q" % (c, c)
+        else:
+            test = "%s == Q" % c
+        self.line("if %s(%s):" % ("not " if taken else "", test))
+        self.exit(pc + 1 if taken else pc + delta, stack)
+
+    def call(self, pc, n, (fn, classes), stack):
+        before = list(stack)
+        f = stack.pop()
+        args = [stack.pop() for i in range(n)]
+        self.line("if %s is not %s:" % (f, self.value(fn)))
+        self.exit(pc, before)
+        stack.append(self.apply(pc, f, fn, args, classes, before))
+
+    def operator(self, pc, n, (fn, classes), stack):
+        before = list(stack)
+        args = [stack.pop(), stack.pop()]
+        f = self.value(fn)
+        self.line("if scopes[0][%d] is not %s:" % (n, f))
+        self.exit(pc, before)
+        stack.append(self.apply(pc, f, fn, args, classes, before))
+
+    def apply(self, pc, f, fn, args, classes, before):
+        """
+        Call `fn`, named `f`, on `args`, inline if it is an arithmetic
+        operator and the arguments are numbers; returns the result's name
+        """
+
+        t = self.fresh()
+        if fn in INLINE and len(args) == 2 and all(cls in NUMBERS for cls in classes):
+            guards = [type_guard(arg, cls) for arg, cls in zip(args, classes) if arg.startswith("t")]
+            if guards:
+                self.line("if not (%s):" % " and ".join(guards))
+                self.exit(pc, before)
+            self.line("%s = %s %s %s" % (t, args[0], INLINE[fn], args[1]))
+            if fn is operator.eq:
+                self.bools.add(t)
+        else:
+            self.line("%s = %s(%s)" % (t, f, ", ".join(args)))
+        return t
+
+    def loop(self, pc, n, stack):
+        before = list(stack)
+        f = stack.pop()
+        args = [stack.pop() for i in range(n)]
+        self.line("if not (%s.__class__ is Func and %s.continuation is None and %s.frame.pc == %d):" % (f, f, f, self.entry))
+        self.exit(pc, before)
+
+        # What `MutableVM.hCALLPOP` does to the caller's frame
+        remaining = "base"
+        for item in stack:
+            remaining = "Cons(%s, %s)" % (item, remaining)
+        self.line("rest = frames.cdr")
+        self.line("if rest.car.shared:")
+        self.line("    rest = Cons(rest.car.copy(), rest.cdr)")
+        self.line("    frames = Cons(frame, rest)")
+        self.line("rest.car.stack = %s" % remaining)
+        self.line("fr = %s.frame" % f)
+        self.line("ctx = [%s] + fr.context[%d:]" % ("".join(arg + ", " for arg in args), n))
+        self.line("captured, base = fr.captured, fr.stack")
+
+class JitVM(vm.MutableVM):
+    def __init__(self, bytecode, consts=None):
+        self.counts = {}
+        self.traces = {}
+        self.blacklist = set()
+        vm.MutableVM.__init__(self, bytecode, consts)
+
+    def hCALLPOP(self, frame, frames, n, generic=None):
+        fn = frame.stack.car
+        return self.tail_call(fn, vm.MutableVM.hCALLPOP(self, frame, frames, n, generic))
+
+    def hCALLPOPF(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        return self.tail_call(fn, vm.MutableVM.hCALLPOPF(self, frame, frames, n))
+
+    def tail_call(self, fn, frames):
+        """
+        Count a tail call of `fn`, which has just been made, and run or
+        record its trace once it is hot
+        """
+
+        if fn.__class__ is not vm.Func or fn.continuation is not None:
+            return frames
+
+        entry = fn.frame.pc
+        trace = self.traces.get(entry)
+        if trace is not None:
+            return trace(self, frames.car, frames)
+        if entry in self.blacklist:
+            return frames
+        count = self.counts.get(entry, 0) + 1
+        self.counts[entry] = count
+        if count >= THRESHOLD:
+            return self.record(entry, frames)
+        return frames
+
+    def record(self, entry, frames):
+        """
+        Interpret one pass through the function at `entry`, recording it;
+        if it ends in a tail call back to the function, compile a trace
+        """
+
+        code, table = self.code, self.table
+        frame = frames.car
+        path = []
+        while len(path) < MAX_TRACE:
+            pc = frame.pc
+            op, a, b = code[pc]
+            recorded = GENERIC.get(op, op)
+            if recorded == OPS["CALLPOP"]:
+                fn = frame.stack.car
+                if fn.__class__ is vm.Func and fn.continuation is None and fn.frame.pc == entry:
+                    path.append((pc, recorded, a, b, None))
+                    self.compile(entry, path)
+                    return frames
+                break
+            elif recorded == OPS["CALL"]:
+                fn = frame.stack.car
+                if fn.__class__ is vm.Func or not callable(fn):
+                    break
+                info = fn, [arg.__class__ for arg in vm.pop(frame.stack.cdr, a)[0]]
+            elif op in OPERATORS:
+                fn = self.scopes[0][a]
+                if fn.__class__ is vm.Func or not callable(fn):
+                    break
+                info = fn, [arg.__class__ for arg in vm.pop(frame.stack, 2)[0]]
+            elif op in TRACEABLE:
+                info = None
+            else:
+                break
+            frames = table[op](frame, frames, a, b)
+            if op in BRANCHES:
+                info = frame.pc != pc + 1
+            path.append((pc, recorded, a, b, info))
+        self.blacklist.add(entry)
+        return frames
+
+    def compile(self, entry, path):
+        compiler = TraceCompiler(self, entry, path)
+        source = compiler.compile()
+        env = dict(compiler.env)
+        exec compile(source, "<trace %d>" % entry, "exec", 0, True) in env
+        self.traces[entry] = env["trace"]
+
+if __name__ == "__main__":
+    import sys
+    import cache
+
+    n, bytecodes, consts = cache.load(sys.argv[1])
+    machine = JitVM(bytecodes, consts)
+    vm.run(machine, machine.mk_state(n))
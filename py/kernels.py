@@ -0,0 +1,72 @@
+"""
+Vectorized stdlib kernels over whole arrays
+
+The collection functions in `stdlib` hand the elements of an array to
+these, when the function they apply to each element is a stdlib
+primitive with a kernel here, instead of calling it once per element.
+Kernels run on NumPy arrays, so they are only used when NumPy is
+installed, and only on arrays of plain ints or of floats large enough to
+pay for the conversion; `apply` returns `None` otherwise, and the caller
+falls back to calling the primitive in a loop.
+"""
+
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Arrays shorter than this are cheaper to loop over in Python
+MIN_SIZE = 1000
+
+# stdlib name -> kernel taking a NumPy array to an array of results
+UNARY = {
+    "even?": lambda a: a % 2 == 0,
+    "odd?": lambda a: a % 2 != 0,
+    "true?": lambda a: a != 0,
+}
+
+def array(values):
+    """
+    The list `values` as a NumPy array, if they are all ints (not longs or
+    bools) or all floats; otherwise `None`
+    """
+
+    if numpy is None or len(values) < MIN_SIZE:
+        return None
+    types = set(map(type, values))
+    if types == set([int]):
+        return numpy.array(values, dtype=numpy.int64)
+    elif types == set([float]):
+        return numpy.array(values, dtype=numpy.float64)
+    return None
+
+def apply(kernel, values):
+    """
+    `kernel` applied to the list `values`, as a list of Python values, or
+    `None` if they cannot be vectorized. The results are those of the
+    primitive, values and types alike (without NumPy, there are none to
+    check):
+
+    >>> import stdlib
+    >>> def agrees(name, values):
+    ...     results, expected = apply(UNARY[name], values), map(stdlib.stdlib[name], values)
+    ...     return numpy is None or (results == expected and map(type, results) == map(type, expected))
+    >>> ints = range(-MIN_SIZE, MIN_SIZE) + [sys.maxint, -sys.maxint - 1]
+    >>> floats = [n / 4.0 for n in ints] + [float("inf"), -float("inf"), float("nan"), -0.0]
+    >>> all(agrees(name, values) for name in sorted(UNARY) for values in [ints, floats])
+    True
+
+    Longs, bools and arrays of mixed types are left to the primitive:
+
+    >>> [apply(UNARY["even?"], values) for values in [ints + [sys.maxint + 1], [True] * MIN_SIZE, ints + [0.5]]]
+    [None, None, None]
+    """
+
+    a = array(values)
+    if a is None:
+        return None
+    # As in Python, `inf % 2` is `nan`, without a warning
+    with numpy.errstate(invalid="ignore"):
+        return kernel(a).tolist()
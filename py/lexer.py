@@ -1,6 +1,8 @@
 # WARNING: this module contains ugly and boring code. The tests here should
 # cover most of it. Do not modify if one does not have to.
 
+import re
+
 import common # Need these for data types
 
 # How to call SyntaxError::
@@ -288,6 +290,31 @@ def parse_whitespace(stream, (file, char, row, col)):
 
     return None, (file, char, row, col)
 
+# Every token form that `tokenize` can lex without falling back to the
+# `parse_*` functions above, together with the spaces that follow it.
+# Anything else (radix integers, malformed numbers and strings, bad
+# characters) goes through the slow path, which also raises the errors.
+TOKEN = re.compile(r"""
+    (?P<punct>[(\[{)\]}~|`'.,&])[ ]*
+  | (?P<arrow>->|<-)[ ]*
+  | (?P<newline>\n(?:[ ]*\n)*)(?P<indent>[ ]*)
+  | (?P<string>(?P<prefix>[a-z]?)"(?P<body>(?:[^"\\\n]|\\[^\n])*)")[ ]*
+  | (?P<special>-\#(?:inf|max|min|eps)|\#(?:inf|max|min|eps|t|f|\?|0))[ ]*
+  | (?P<float>(?P<sign>-?)(?:(?P<whole>\d+)(?=[.e])|(?=\.))
+               (?:\.(?P<frac>\d*))?(?:e(?P<esign>[-+]?)(?P<exp>\d*))?)[ ]*
+  | (?P<int>-?\d+)(?![.e\#r\d])[ ]*
+  | (?P<symbol>(?![a-z]?"|-[\d.\#])[a-z!@$%^*_\-?=+/\\<>][A-Za-z\d!@$%^*_\-?=+/\\<>]*
+                (?::[A-Za-z\d!@$%^*_\-?=+/\\<>]*)*)[ ]*
+""", re.VERBOSE)
+SPECIALS = {
+    "-#inf": common.Float(-common.inf), "#inf": common.Float(common.inf),
+    "-#max": common.Float(-common.max), "#max": common.Float(common.max),
+    "-#min": common.Float(-common.min), "#min": common.Float(common.min),
+    "-#eps": common.Float(-common.eps), "#eps": common.Float(common.eps),
+    "#t": common.Bool(True), "#f": common.Bool(False),
+    "#?": common.Bool(common.Maybe), "#0": common.nil,
+}
+
 def tokenize(stream, file):
     r"""
     Tokenizes Forp source code
@@ -296,53 +323,136 @@ def tokenize(stream, file):
     [Symbol(s=('print',)), String(s='asdf', prefix=''), Integer(n=1), '->', Symbol(s=('+',)), Integer(n=4), Integer(n=3), 'EOF']
     >>> [tok.obj for tok in tokenize("if (= a b) ->\n    just a\n    print\n        'a\n        'b", 0)]
     [Symbol(s=('if',)), '(', Symbol(s=('=',)), Symbol(s=('a',)), Symbol(s=('b',)), ')', '->', '\n', 'INDENT', Symbol(s=('just',)), Symbol(s=('a',)), '\n', Symbol(s=('print',)), '\n', 'INDENT', "'", Symbol(s=('a',)), '\n', "'", Symbol(s=('b',)), 'DEDENT', 'DEDENT', 'EOF']
+    >>> [tok.obj for tok in tokenize('-2.5e3 -#inf #? 16r1f a:b-c p"q"', 0)] # doctest: +ELLIPSIS
+    [Float(x=-2500.0), Float(x=-inf), Bool(b=<object object at ...>), Integer(n=31), Symbol(s=('a', 'b-c')), String(s='q', prefix='p'), 'EOF']
+    >>> [(tok.obj, tok.meta["row"], tok.meta["col"]) for tok in tokenize("a\n\n  b\nc", 0)]
+    [(Symbol(s=('a',)), 0, 0), ('\n', 0, 1), ('INDENT', 2, 1), (Symbol(s=('b',)), 2, 3), ('\n', 2, 4), ('DEDENT', 3, 1), (Symbol(s=('c',)), 3, 1), ('EOF', 4, 2)]
     """
-    
+
+    return list(iter_tokens([stream], file))
+
+def iter_tokens(chunks, file):
+    r"""
+    Tokenizes Forp source code read piece by piece from `chunks`, such as a
+    file object, yielding tokens as soon as they are complete. Only the
+    current line and the blank lines after it are kept in memory.
+
+    >>> [tok.obj for tok in iter_tokens(["if #t\n", "\n", "    1\n", "2"], 0)]
+    [Symbol(s=('if',)), Bool(b=True), '\n', 'INDENT', Integer(n=1), '\n', 'DEDENT', Integer(n=2), 'EOF']
+    """
+
+    match = TOKEN.match
+    ForpObject = common.ForpObject
+    chunks = iter(chunks)
+    more = True
+
+    # Text already dropped from the front of `stream`, for the final position
+    dropped_rows = dropped_col = 0
+
+    stream = ""
+    while more and "\n" not in stream:
+        try:
+            stream += next(chunks)
+        except StopIteration:
+            more = False
+    end = len(stream)
+
     indent_stack = [0]
     _, (file, char, row, col) = parse_whitespace(stream, (file, 0, 0, 0))
-    
-    tokens = []
-    while len(stream) > char:
-        if stream[char] in "([{)]}~|`'.,&":
-            tokens.append(common.ForpObject(stream[char], row=row, col=col))
-            char += 1; col += 1
-        elif stream[char:char+2] == "->":
-            tokens.append(common.ForpObject("->", row=row, col=col))
-            char += 2; col += 2
-        elif stream[char:char+2] == "<-":
-            tokens.append(common.ForpObject("<-", row=row, col=col))
-            char += 2; col += 2
-        elif stream[char] == "\n":
-            tokens.append(common.ForpObject("\n", row=row, col=col))
-            
-            while len(stream) > char and stream[char] == "\n":
-                row += 1; char += 1; col = 1
-                _, (_, char2, _, _) = parse_whitespace(stream, (file, char, row, col))
-                if len(stream) > char2 and stream[char2] != "\n":
-                    break
+
+    symbols = {} # Symbols are immutable, so each name is only built once
+    while char < end:
+        m = match(stream, char)
+        kind = m and m.lastgroup
+
+        if kind == "symbol":
+            text = m.group(kind)
+            val = symbols.get(text)
+            if val is None:
+                val = symbols[text] = common.Symbol(tuple(text.split(":")))
+            yield ForpObject(val, row=row, col=col)
+        elif kind == "punct" or kind == "arrow":
+            yield ForpObject(m.group(kind), row=row, col=col)
+        elif kind == "int":
+            yield ForpObject(common.Integer(int(m.group(kind))), row=row, col=col)
+        elif kind == "indent":
+            # Make sure the blank lines and the whole next line are read
+            while more and stream.find("\n", m.end()) == -1:
+                dropped = stream[:char]
+                if "\n" in dropped:
+                    dropped_col = len(dropped) - dropped.rfind("\n") - 1
                 else:
-                    char = char2
-                   
-            indent = char2 - char
+                    dropped_col += len(dropped)
+                dropped_rows += dropped.count("\n")
+                stream = stream[char:]
+                char = 0
+                try:
+                    stream += next(chunks)
+                except StopIteration:
+                    more = False
+                end = len(stream)
+                m = match(stream, char)
+
+            yield ForpObject("\n", row=row, col=col)
+            indent = len(m.group("indent"))
+            row += m.group("newline").count("\n"); col = 1
+            linestart = m.start("indent")
+
+            if m.end() == end:
+                indent = 0
+            elif stream[m.end()] == "\t":
+                raise SyntaxError("Tabs not allowed in Forp code", (file, row, col + indent, "\t"))
+
             if indent > indent_stack[-1]:
-                tokens.append(common.ForpObject("INDENT", row=row, col=col))
+                yield ForpObject("INDENT", row=row, col=col)
                 indent_stack.append(indent)
             else:
                 while indent < indent_stack[-1]:
-                    tokens.append(common.ForpObject("DEDENT", row=row, col=col))
+                    yield ForpObject("DEDENT", row=row, col=col)
                     indent_stack.pop()
-                 
+
                 if indent != indent_stack[-1]: # Indent not in stack
-                    raise SyntaxError("Invalid indentation", (file, row, col, stream[char]))
+                    raise SyntaxError("Invalid indentation", (file, row, col, stream[linestart]))
+            col += m.end() - linestart
+            char = m.end()
+            continue
+        elif kind == "string":
+            yield ForpObject(common.String(m.group("body"), m.group("prefix")), row=row, col=col)
+        elif kind == "float":
+            yield ForpObject(common.Float(float("%s%d.%de%s%d" % (m.group("sign") or "+",
+                int(m.group("whole") or 0), int(m.group("frac") or 0),
+                m.group("esign") == "-" and "-" or "+", int(m.group("exp") or 0)))), row=row, col=col)
+        elif kind == "special":
+            yield ForpObject(SPECIALS[m.group(kind)], row=row, col=col)
         else:
+            # A string broken by a newline is reported with the character
+            # after the newline, which may not have been read yet
+            newline = stream.find("\n", char)
+            while more and newline != -1 and newline + 1 >= end:
+                try:
+                    stream += next(chunks)
+                except StopIteration:
+                    more = False
+                end = len(stream)
+
             val, (file, char2, row2, col2) = parse_num_sym(stream, (file, char, row, col))
-            tokens.append(common.ForpObject(val, row=row, col=col))
-            char = char2; row = row2; col = col2
-        _, (file, char, row, col) = parse_whitespace(stream, (file, char, row, col))
-    
-    finalrow = stream.count("\n")+1
-    finalcol = len(stream) - stream.rfind("\n")
-    return tokens + [common.ForpObject("DEDENT", row=finalrow, col=finalcol)] * (len(indent_stack) - 1) + [common.ForpObject("EOF", row=finalrow, col=finalcol)]
+            yield ForpObject(val, row=row, col=col)
+            _, (file, char, row, col) = parse_whitespace(stream, (file, char2, row2, col2))
+            continue
+
+        col += m.end() - char
+        char = m.end()
+        if char < end and stream[char] == "\t":
+            raise SyntaxError("Tabs not allowed in Forp code", (file, row, col, "\t"))
+
+    finalrow = dropped_rows + stream.count("\n") + 1
+    if "\n" in stream:
+        finalcol = len(stream) - stream.rfind("\n")
+    else:
+        finalcol = dropped_col + len(stream) + 1
+    for i in range(len(indent_stack) - 1):
+        yield ForpObject("DEDENT", row=finalrow, col=finalcol)
+    yield ForpObject("EOF", row=finalrow, col=finalcol)
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,278 @@
+"""
+Bytecode optimizations, run by `compiler.Compiler.compile` after code
+generation
+
+Optimization levels:
+
+  0. No optimization
+  1. Jump threading (including replacing jumps to `HALT` by `HALT`),
+     removal of jumps to the next instruction and dead-code removal
+  2. Everything in level 1, plus constant folding of calls to pure stdlib
+     operators (unless compiling incrementally) and of conditional jumps
+     on constants
+
+Passes work on a copy of the code in which jump operands are absolute
+instruction indices; deleted instructions are set to `None` and squeezed
+out, and jumps re-relativized, at the end. They are also given the
+compilation's constant pool, which `PUSH` operands index.
+"""
+
+import stdlib
+import vm
+
+# Opcodes whose first operand is a pc-relative jump
+JUMPS = set(["GOTO", "IFT", "IFF", "IFQ", "CLSR", "PUSHCC", "PUSHEC"])
+BRANCHES = {
+    "IFT": lambda top: bool(top and top != vm.Q),
+    "IFF": lambda top: bool(not top and top != vm.Q),
+    "IFQ": lambda top: top == vm.Q,
+}
+
+# Stdlib operators that may be evaluated at compile time
+PURE = set(["+", "-", "*", "/", "="])
+OPERATORS = set(vm.ARITH.values())
+STDLIB = stdlib.stdlib.keys()
+
+def to_absolute(insts):
+    code = []
+    for pc, inst in enumerate(insts):
+        inst = list(inst)
+        if inst[0] in JUMPS:
+            inst[1] = pc + inst[1]
+        code.append(inst)
+    return code
+
+def to_relative(code):
+    """
+    Drop deleted instructions and turn jump targets back into offsets
+    """
+
+    # A deleted instruction's index maps to the next surviving instruction
+    remap = [0] * (len(code) + 1)
+    n = 0
+    for pc, inst in enumerate(code):
+        remap[pc] = n
+        if inst is not None:
+            n += 1
+    remap[len(code)] = n
+
+    insts = []
+    for inst in code:
+        if inst is None:
+            continue
+        inst = list(inst)
+        if inst[0] in JUMPS:
+            inst[1] = remap[inst[1]] - len(insts)
+        insts.append(tuple(inst))
+    return insts
+
+def targets(code):
+    return set(inst[1] for inst in code if inst is not None and inst[0] in JUMPS)
+
+def successors(code, pc):
+    inst = code[pc]
+    if inst[0] == "HALT":
+        return []
+    elif inst[0] == "GOTO":
+        return [inst[1]]
+    elif inst[0] in JUMPS:
+        return [pc + 1, inst[1]]
+    else:
+        return [pc + 1]
+
+def next_live(code, pc):
+    pc += 1
+    while pc < len(code) and code[pc] is None:
+        pc += 1
+    return pc
+
+def depths(code):
+    """
+    Map each reachable pc to its closure nesting depth, or to `None` if it
+    can be reached at more than one depth. Unreachable pcs are absent.
+    """
+
+    depth = {}
+    work = [(0, 0)]
+    while work:
+        pc, d = work.pop()
+        if pc < len(code) and code[pc] is None:
+            pc = next_live(code, pc)
+        if pc >= len(code):
+            continue
+        if pc in depth:
+            if depth[pc] != d and depth[pc] is not None:
+                depth[pc] = None
+                work.append((pc, None))
+            continue
+        depth[pc] = d
+        for succ in successors(code, pc):
+            if code[pc][0] == "CLSR" and succ == code[pc][1]:
+                work.append((succ, None if d is None else d + 1))
+            else:
+                work.append((succ, d))
+    return depth
+
+def remove_dead(code, consts):
+    live = depths(code)
+    changed = False
+    for pc, inst in enumerate(code):
+        if inst is not None and pc not in live:
+            code[pc] = None
+            changed = True
+    return changed
+
+def thread_jumps(code, consts):
+    changed = False
+    for inst in code:
+        if inst is None or inst[0] not in ("GOTO", "IFT", "IFF", "IFQ"):
+            continue
+        seen = set()
+        target = inst[1]
+        while target < len(code):
+            if code[target] is None:
+                target = next_live(code, target)
+            elif code[target][0] == "GOTO" and target not in seen:
+                seen.add(target)
+                target = code[target][1]
+            else:
+                break
+        if inst[0] == "GOTO" and target < len(code) and code[target][0] == "HALT":
+            inst[:] = ["HALT"]
+            changed = True
+        elif target != inst[1]:
+            inst[1] = target
+            changed = True
+    return changed
+
+def remove_jumps_to_next(code, consts):
+    changed = False
+    for pc, inst in enumerate(code):
+        if inst is not None and inst[0] == "GOTO" and inst[1] == next_live(code, pc):
+            code[pc] = None
+            changed = True
+    return changed
+
+def fold_branches(code, consts):
+    """
+    Turn `PUSH c; DUP` into `PUSH c; PUSH c`, and `PUSH c; IFx` into a
+    `GOTO` or nothing, depending on `c`
+    """
+
+    changed = False
+    jumped_to = targets(code)
+    for pc, inst in enumerate(code):
+        if inst is None or inst[0] != "PUSH":
+            continue
+        nxt = next_live(code, pc)
+        if nxt >= len(code) or nxt in jumped_to:
+            continue
+        if code[nxt][0] == "DUP" and code[nxt][1] == 1:
+            code[nxt] = list(inst)
+            changed = True
+        elif code[nxt][0] in BRANCHES:
+            if BRANCHES[code[nxt][0]](consts[inst[1]]):
+                code[pc] = ["GOTO", code[nxt][1]]
+            else:
+                code[pc] = None
+            code[nxt] = None
+            changed = True
+    return changed
+
+def is_number(obj):
+    return isinstance(obj, (int, long, float)) and not isinstance(obj, bool)
+
+def fold_constants(code, consts):
+    """
+    Evaluate `PUSH`es of numbers followed by a call of a pure stdlib
+    operator, or by one of the operator opcodes, that is never `set!`
+    """
+
+    redefined = set(inst[1] for inst in code
+                    if inst is not None and inst[0] == "SETG" and inst[2] == 0)
+    jumped_to = targets(code)
+    changed = False
+
+    for pc, inst in enumerate(code):
+        if inst is None:
+            continue
+        elif inst[0] in ("CALL", "CALLPOP"):
+            n, callee = inst[1], 1
+        elif inst[0] in OPERATORS:
+            n, callee = 2, 0
+        else:
+            continue
+
+        # Walk back over the callee, if any, and the arguments
+        pcs = [pc]
+        prev = pc - 1
+        while len(pcs) < n + callee + 1 and prev >= 0:
+            if code[prev] is not None:
+                pcs.append(prev)
+            prev -= 1
+        if len(pcs) < n + callee + 1 or any(p in jumped_to for p in pcs[:-1]):
+            continue
+        args = [code[p] for p in pcs[callee + 1:]]
+
+        if callee:
+            get = code[pcs[1]]
+            if get[0] != "GETG" or get[2] != 0:
+                continue
+            slot = get[1]
+        else:
+            slot = inst[1]
+        if slot in redefined or not 0 <= slot < len(STDLIB) or STDLIB[slot] not in PURE:
+            continue
+        if any(arg[0] != "PUSH" or not is_number(consts[arg[1]]) for arg in args):
+            continue
+
+        try:
+            value = stdlib.stdlib[STDLIB[slot]](*[consts[arg[1]] for arg in args])
+        except Exception:
+            continue # Leave the error for run time
+
+        for p in pcs[1:]:
+            code[p] = None
+        code[pcs[-1]] = ["PUSH", consts.add(value)]
+        code[pc] = ["HALT"] if inst[0] == "CALLPOP" else None
+        changed = True
+    return changed
+
+PASSES = [
+    [],
+    [thread_jumps, remove_jumps_to_next, remove_dead],
+    [fold_constants, fold_branches, thread_jumps, remove_jumps_to_next, remove_dead],
+]
+
+def optimize(insts, consts, level=1, incremental=False):
+    """
+    Optimize the instruction tuples `insts` at the given level. `PUSH`
+    operands index `consts`, a `compiler.Pool`, which folded constants are
+    added to. With `incremental`, code compiled later, as in the REPL, may
+    `set!` any operator, so calls of operators are not folded.
+    """
+
+    passes = PASSES[min(level, len(PASSES) - 1)]
+    if incremental:
+        passes = [opt for opt in passes if opt is not fold_constants]
+    if not passes:
+        return insts
+
+    code = to_absolute(insts)
+    changed = True
+    while changed:
+        changed = False
+        for opt in passes:
+            changed = opt(code, consts) or changed
+    return to_relative(code)
+
+if __name__ == "__main__":
+    import sys
+    import compiler
+    import parser
+
+    print "%-30s" % "file", " ".join("-O%d" % level for level in range(len(PASSES)))
+    for file in sys.argv[1:]:
+        ast = parser.from_file(file)
+        counts = [len(compiler.Compiler(file, level=level).compile(ast)) for level in range(len(PASSES))]
+        print "%-30s" % file, " ".join("%3d" % count for count in counts)
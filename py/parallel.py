@@ -0,0 +1,130 @@
+"""
+Running Forp functions over collections on a pool of worker processes
+
+`pmap fn coll` and `preduce fn init coll` split `coll` into chunks, a few
+per worker so uneven chunks even out, and hand them to worker processes.
+The workers are forked from the running program at the call, so they
+start with its code, variables and the collection as they are then; only
+the results travel back, pickled with `dumps`.
+
+`dumps` and `loads` pickle Forp values: closures together with the
+contexts they capture, continuations, and the data structures in
+`datastructs`. Stdlib functions are pickled by name, so they unpickle to
+the receiving process's own. A closure is only meaningful in a process
+running the same program, since it refers to its code by pc.
+
+Without `fork`, in a worker, or with a single CPU, the functions run
+serially in the calling process. So they do, again, if any results
+cannot be pickled, such as streams or `pygen` closures.
+"""
+
+import cPickle
+import cStringIO
+import multiprocessing
+import os
+import sys
+
+import stdlib
+
+WORKERS = multiprocessing.cpu_count()
+CHUNKS_PER_WORKER = 4
+
+# The function and the values a pool is forked to work on
+task = None
+in_worker = False
+# Stdlib names by the `id` of their function, as in `stdlib`
+NAMES = {}
+
+def persistent_id(obj):
+    return NAMES.get(id(obj))
+
+def persistent_load(name):
+    return stdlib.stdlib[name]
+
+def dumps(obj):
+    if not NAMES:
+        NAMES.update((id(fn), name) for name, fn in stdlib.stdlib.items())
+    buf = cStringIO.StringIO()
+    pickler = cPickle.Pickler(buf, 2)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    return buf.getvalue()
+
+def loads(data):
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+def chunks(n, count):
+    """
+    Split `range(n)` into `count` nearly equal `(start, end)` ranges
+    """
+
+    return [(n * i // count, n * (i + 1) // count) for i in range(count)]
+
+def work(bounds):
+    """
+    Run the task on the values in `bounds`, in a worker; returns the
+    pickled results, or `None` if they cannot be pickled
+    """
+
+    global in_worker
+    in_worker = True
+    kind, fn, values = task
+    start, end = bounds
+    if kind == "map":
+        result = stdlib.each(fn, values[start:end])
+    else:
+        result = reduce(stdlib.native(fn), values[start:end])
+    sys.stdout.flush() # Workers exit without flushing
+    try:
+        return dumps(result)
+    except (cPickle.PicklingError, TypeError):
+        return None
+
+def run(kind, fn, values):
+    """
+    Run `fn` over chunks of the list `values` on a pool of workers;
+    returns the list of each chunk's results, or `None` if it cannot be
+    run in parallel
+    """
+
+    global task
+    count = min(len(values), WORKERS * CHUNKS_PER_WORKER)
+    if in_worker or WORKERS < 2 or count < 2 or not hasattr(os, "fork"):
+        return None
+
+    sys.stdout.flush() # Or the workers inherit and repeat pending output
+    task = kind, fn, values
+    pool = multiprocessing.Pool(min(WORKERS, count))
+    try:
+        parts = pool.map(work, chunks(len(values), count), 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        task = None
+        pool.join()
+    if None in parts:
+        return None
+    return map(loads, parts)
+
+def pmap(fn, coll):
+    values = list(coll)
+    parts = run("map", fn, values)
+    if parts is None:
+        return stdlib.each(fn, values)
+    return [value for part in parts for value in part]
+
+def preduce(fn, init, coll):
+    """
+    Reduce `coll` with `fn`, starting from `init`, by reducing each chunk
+    in a worker and then the chunks' results; `fn` must be associative
+    """
+
+    values = list(coll)
+    parts = run("reduce", fn, values)
+    if parts is None:
+        parts = values
+    return reduce(stdlib.native(fn), parts, init)
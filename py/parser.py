@@ -182,6 +182,49 @@ def parse(tokens, file):
 
     return commands
 
+class Tokens(object):
+    """
+    A sequence of tokens read lazily from an iterator, such as
+    `lexer.iter_tokens`, and indexable like the list `lexer.tokenize`
+    returns. Tokens before a `release`d index are forgotten.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+        self.buf = []
+        self.offset = 0
+
+    def __getitem__(self, i):
+        i -= self.offset
+        if i < 0:
+            raise IndexError("Token %d already released" % (i + self.offset))
+        try:
+            while i >= len(self.buf):
+                self.buf.append(next(self.tokens))
+        except StopIteration:
+            raise IndexError("Token %d past end of input" % (i + self.offset))
+        return self.buf[i]
+
+    def release(self, upto):
+        del self.buf[:upto - self.offset]
+        self.offset = upto
+
+def iter_commands(stream, file=None):
+    """
+    Parse Forp source from the file object `stream`, yielding each
+    top-level command as soon as it is complete
+    """
+
+    if file is None:
+        file = getattr(stream, "name", "#?")
+
+    tokens = Tokens(lexer.iter_tokens(stream, file))
+    ptr = 0
+    while tokens[ptr].obj != "EOF":
+        cmd, ptr = parse_command(tokens, (ptr, file))
+        tokens.release(ptr - 1) # `|` looks one token back
+        yield cmd
+
 def from_str(str, file="#?"):
     tokens = lexer.tokenize(str, file)
     return parse(tokens, file)
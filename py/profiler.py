@@ -0,0 +1,285 @@
+"""
+Opcode- and function-level profiler for the VM
+
+Pass a `Profile` to `vm.run` to profile that one run; `vm.run` without one
+takes its usual loop, so a disabled profiler costs nothing. A `Profile`
+collects
+
+  - per-opcode instruction counts and time,
+  - per-function call counts and inclusive and exclusive time, and
+  - execution counts for each `pc`,
+
+and can print a text report or write collapsed stacks (one
+`outer;inner time` line per call path, in microseconds), the input format
+of flamegraph tools.
+
+Functions are named by the pc of their first instruction: `fn@12` for a
+closure, `top@0` for top-level code. Direct recursion is folded into one
+stack entry, so deep recursion does not produce deep stacks.
+"""
+
+import sys
+import timeit
+
+from datastructs import Cons
+import stdlib
+import vm
+
+CALL, CALLPOP, HALT, CLSR, PUSHCC, PUSHEC = [vm.OPS[name] for name in ("CALL", "CALLPOP", "HALT", "CLSR", "PUSHCC", "PUSHEC")]
+JUMPS = set(vm.OPS[name] for name in ("GOTO", "IFT", "IFF", "IFQ"))
+# The call instructions, specialized or not, by the kind of call they make
+CALLS = dict((vm.OPS[name], vm.OPS[generic]) for name, generic in vm.SPECIALIZED.items())
+CALLS.update({CALL: CALL, CALLPOP: CALLPOP})
+OPERATORS = set(vm.OPS[name] for name in vm.ARITH.values())
+
+def owners(code, entries):
+    """
+    Map each pc to the entry pc of the function containing it, following
+    control flow from each entry without descending into nested closures
+    """
+
+    owner = [None] * len(code)
+    entries = sorted(set(entries) | set(pc + a for pc, (op, a, b) in enumerate(code) if op == CLSR))
+    for entry in entries:
+        work = [entry]
+        while work:
+            pc = work.pop()
+            if pc >= len(code) or owner[pc] is not None:
+                continue
+            owner[pc] = entry
+            op, a, b = code[pc]
+            if op == HALT:
+                continue
+            elif op == vm.OPS["GOTO"]:
+                work.append(pc + a)
+                continue
+            elif op in JUMPS or op == PUSHCC or op == PUSHEC:
+                work.append(pc + a)
+            work.append(pc + 1)
+    return owner
+
+def bottom(frames):
+    while frames.cdr is not None:
+        frames = frames.cdr
+    return frames.car
+
+class Node(object):
+    """
+    One call path: a function called from its `parent` path
+    """
+
+    __slots__ = ["entry", "parent", "children", "time"]
+    def __init__(self, entry, parent):
+        self.entry = entry
+        self.parent = parent
+        self.children = {}
+        self.time = 0.0
+
+    def child(self, entry):
+        if entry == self.entry:
+            return self
+        if entry not in self.children:
+            self.children[entry] = Node(entry, self)
+        return self.children[entry]
+
+    def path(self):
+        node, path = self, []
+        while node.entry is not None:
+            path.append(node.entry)
+            node = node.parent
+        return path[::-1]
+
+class Profile(object):
+    def __init__(self):
+        self.counts = [0] * len(vm.OPCODES)
+        self.times = [0.0] * len(vm.OPCODES)
+        self.pcs = {}
+        self.calls = {}
+        self.tops = set()
+        self.root = Node(None, None)
+        self.code, self.consts = [], []
+        self.conts = {}
+
+    def run(self, machine, state):
+        """
+        Run `state` on `machine` to completion, like `vm.run`, recording
+        into this profile
+        """
+
+        code, table = machine.code, machine.table
+        counts, times, pcs, calls = self.counts, self.times, self.pcs, self.calls
+        self.code, self.consts = code, machine.consts
+        self.tops.add(state.car.pc)
+        owner = owners(code, self.tops)
+        conts = self.conts
+        clock = timeit.default_timer
+
+        path = Cons(self.root.child(owner[state.car.pc]), None)
+        # The call paths of switched-out fibers, by their bottom frame
+        paths = {}
+        with stdlib.invoked_by(machine.apply):
+            while True:
+                try:
+                    if state is None:
+                        state, path = self.switch(None, machine.next_fiber(), None, paths)
+                    while True:
+                        for i in xrange(vm.BUDGET):
+                            frame = state.car
+                            pc = frame.pc
+                            op, a, b = code[pc]
+                            kind = CALLS.get(op)
+                            if kind is not None:
+                                callee = machine.peek(frame)
+                            elif op in OPERATORS:
+                                # Calls a closure if the operator has been `set!` to one
+                                kind, callee = CALL, machine.scopes[0][a]
+                            else:
+                                callee = None
+                            t = clock()
+                            state = table[op](frame, state, a, b)
+                            dt = clock() - t
+
+                            counts[op] += 1
+                            times[op] += dt
+                            pcs[pc] = pcs.get(pc, 0) + 1
+                            path.car.time += dt
+
+                            if callee is not None and isinstance(callee, vm.Func):
+                                if callee.continuation is not None:
+                                    path = conts.get(callee, path)
+                                else:
+                                    entry = callee.frame.pc
+                                    calls[entry] = calls.get(entry, 0) + 1
+                                    if kind == CALL:
+                                        path = Cons(path.car.child(entry), path)
+                                    else:
+                                        parent = path.cdr.car if path.cdr is not None else self.root
+                                        path = Cons(parent.child(entry), path.cdr)
+                            elif kind == CALLPOP or op == HALT:
+                                path = path.cdr
+                            elif op == PUSHCC or op == PUSHEC:
+                                conts[machine.peek(state.car)] = path
+                        machine.resumed()
+                        if machine.fibers:
+                            machine.fibers.append(state)
+                            state, path = self.switch(state, machine.fibers.popleft(), path, paths)
+                except vm.Switch as e:
+                    counts[op] += 1
+                    pcs[pc] = pcs.get(pc, 0) + 1
+                    state, path = self.switch(state, e.args[0], path, paths)
+                except vm.Idle:
+                    if state is not None:
+                        counts[op] += 1
+                        pcs[pc] = pcs.get(pc, 0) + 1
+                        paths[bottom(state)] = path
+                    state, path = self.switch(None, machine.wait(), None, paths)
+                except vm.HALT as e:
+                    counts[op] += 1
+                    pcs[pc] = pcs.get(pc, 0) + 1
+                    if not machine.finished(e.args[0]):
+                        return e.args[0]
+                    # The fiber has ended, so its path is not kept
+                    state = None
+
+    def switch(self, old, new, path, paths):
+        """
+        Save the call path of the fiber at `old`, if any, and return `new`
+        with the path of the fiber it belongs to; a new fiber starts at the
+        entry of the function it calls
+        """
+
+        if old is not None:
+            paths[bottom(old)] = path
+        saved = paths.pop(bottom(new), None)
+        if saved is None:
+            saved = Cons(self.root.child(new.car.pc), None)
+        return new, saved
+
+    def name(self, entry):
+        return ("top@%d" if entry in self.tops else "fn@%d") % entry
+
+    def functions(self):
+        """
+        Return `{entry: (calls, inclusive, exclusive)}`; time spent in a
+        function that is already on the stack counts once toward its
+        inclusive time
+        """
+
+        exclusive, inclusive = {}, {}
+        totals = {}
+        # Children come after their parents, so walk backwards to sum subtrees
+        order, work = [], [self.root]
+        while work:
+            node = work.pop()
+            order.append(node)
+            work.extend(node.children.values())
+        for node in reversed(order):
+            totals[node] = node.time + sum(totals[child] for child in node.children.values())
+
+        work = [(self.root, frozenset())]
+        while work:
+            node, above = work.pop()
+            if node.entry is not None:
+                exclusive[node.entry] = exclusive.get(node.entry, 0.0) + node.time
+                if node.entry not in above:
+                    inclusive[node.entry] = inclusive.get(node.entry, 0.0) + totals[node]
+                above = above | frozenset([node.entry])
+            work.extend((child, above) for child in node.children.values())
+
+        return dict((entry, (self.calls.get(entry, 0), inclusive[entry], exclusive[entry]))
+                    for entry in exclusive)
+
+    def report(self, stream=sys.stdout, top=10):
+        total = sum(self.times)
+        print >>stream, "%d instructions in %.3fs" % (sum(self.counts), total)
+
+        print >>stream
+        print >>stream, "%-10s %12s %10s %8s %10s" % ("opcode", "count", "time", "%", "ns/inst")
+        for op in sorted(range(len(vm.OPCODES)), key=lambda op: -self.times[op]):
+            if self.counts[op]:
+                print >>stream, "%-10s %12d %9.3fs %7.1f%% %10.0f" % (
+                    vm.OPCODES[op], self.counts[op], self.times[op],
+                    100 * self.times[op] / (total or 1), 1e9 * self.times[op] / self.counts[op])
+
+        print >>stream
+        print >>stream, "%-10s %10s %10s %10s" % ("function", "calls", "inclusive", "exclusive")
+        functions = self.functions()
+        for entry in sorted(functions, key=lambda entry: -functions[entry][1]):
+            calls, inclusive, exclusive = functions[entry]
+            print >>stream, "%-10s %10d %9.3fs %9.3fs" % (self.name(entry), calls, inclusive, exclusive)
+
+        print >>stream
+        print >>stream, "%-6s %12s  %s" % ("pc", "count", "instruction")
+        for pc in sorted(self.pcs, key=lambda pc: -self.pcs[pc])[:top]:
+            op, a, b = self.code[pc]
+            args = [repr(self.consts[a])] if op == vm.PUSH else [str(arg) for arg in (a, b) if arg is not None]
+            print >>stream, "%-6d %12d  %s" % (pc, self.pcs[pc], " ".join([vm.OPCODES[op]] + args))
+
+    def write_collapsed(self, stream):
+        """
+        Write one `name;name;... microseconds` line per call path
+        """
+
+        work = [self.root]
+        while work:
+            node = work.pop()
+            work.extend(node.children.values())
+            if node.entry is not None and node.time > 0:
+                stack = ";".join(self.name(entry) for entry in node.path())
+                print >>stream, "%s %d" % (stack, round(node.time * 1e6))
+
+if __name__ == "__main__":
+    import cache
+
+    if len(sys.argv) < 2:
+        print "Usage: python profiler.py file.forp [collapsed-stacks-file]"
+        sys.exit(1)
+
+    n, bytecodes, consts = cache.load(sys.argv[1])
+    machine = vm.VM(bytecodes, consts)
+    profile = Profile()
+    vm.run(machine, machine.mk_state(n), profile)
+    profile.report(sys.stderr)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as f:
+            profile.write_collapsed(f)
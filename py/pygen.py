@@ -0,0 +1,364 @@
+"""
+Python code generation backend
+
+Translates a parsed Forp program into the source of a Python function and
+runs that instead of bytecode. Variables are resolved with the same
+scoping rules as `compiler.Compiler`: every scope keeps its variables in a
+context list (`c1` for the top level, `c2`, `c3`, ... for nested `fn`s),
+and each `fn` becomes a nested Python function, so enclosing contexts are
+reached as ordinary Python closure variables.
+
+Tail calls return a `Tail` and are run by a trampoline loop at the
+non-tail call site that made the outer call. Calls to stdlib functions
+that the program never `set!`s are made directly, and the arithmetic and
+comparison operators become the Python operators themselves.
+
+`@:call/cc`, the fiber primitives (see `vm.FIBERS`) and asynchronous
+stdlib functions have no Python equivalent here, so a program that uses
+any of them anywhere runs on the bytecode VM as a whole. This is
+deliberate: running only the `fn`s that use them on the VM would mean
+passing frames and contexts between two representations. Programs too
+deeply nested for the Python compiler run on the VM too.
+"""
+
+import sys
+import threading
+
+import common
+import compiler
+import datastructs
+import stdlib
+import vm
+
+class Tail(object):
+    """
+    A pending tail call, returned to the nearest trampoline
+    """
+
+    __slots__ = ["fn", "args"]
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+# Stdlib operators written inline when called with two arguments
+OPERATORS = {"+": "+", "-": "-", "*": "*", "/": "/", "=": "=="}
+STDLIB = stdlib.stdlib.keys()
+
+# Names only the VM implements
+VM_ONLY = set(["call/cc"]) | set(vm.FIBERS) | set(name for name, fn in stdlib.stdlib.items() if id(fn) in stdlib.ASYNCHRONOUS)
+
+def needs_vm(ast):
+    if isinstance(ast, common.Form):
+        return any(needs_vm(x) for x in ast.l) or any(needs_vm(x) for x in ast.d.values())
+    elif isinstance(ast, list):
+        return any(needs_vm(x) for x in ast)
+    return isinstance(ast, common.ForpObject) and isinstance(ast.obj, common.Symbol) and ast.obj.s[-1] in VM_ONLY
+
+class Generator(compiler.Compiler):
+    """
+    Generates Python source for a program, reusing the compiler's name
+    resolution. `generate` returns the source of a function
+    `program(S, K, Tail, Q)` taking the stdlib values, the table of
+    constants, the `Tail` class and the value of `#?`.
+    """
+
+    # `@:call/cc` never reaches the generator; see `needs_vm`
+    special_forms = dict((name, form) for name, form in compiler.Compiler.special_forms.items() if form != "callcc")
+
+    def __init__(self, file):
+        compiler.Compiler.__init__(self, file, level=0)
+        self.lines = []
+        self.indent = 1
+        self.consts = []
+        self.count = 0
+        # Expressions whose value cannot change once computed
+        self.stable = set(["None"])
+
+    def fresh(self, prefix):
+        self.count += 1
+        name = "%s%d" % (prefix, self.count)
+        self.stable.add(name)
+        return name
+
+    def line(self, text):
+        self.lines.append("    " * self.indent + text)
+
+    def const(self, value):
+        if isinstance(value, (int, long, float, str)) and not isinstance(value, bool):
+            expr = repr(value)
+        else:
+            self.consts.append(value)
+            expr = "K[%d]" % (len(self.consts) - 1)
+        self.stable.add(expr)
+        return expr
+
+    def temp(self, expr):
+        name = self.fresh("t")
+        self.line("%s = %s" % (name, expr))
+        return name
+
+    def var(self, ast):
+        n, scope = self.lookup(ast)
+        if scope.level == 0:
+            return "S[%d]" % n
+        return "c%d[%d]" % (scope.level, n)
+
+    def builtin(self, ast):
+        """
+        The stdlib name `ast` calls directly, if it is one the program
+        never redefines
+        """
+
+        if not isinstance(ast.obj, common.Symbol) or len(ast.obj.s) != 1:
+            return None
+        n, scope = self.lookup(ast)
+        if scope.level == 0 and STDLIB[n] not in self.redefined:
+            return STDLIB[n]
+
+    def special(self, ast):
+        if isinstance(ast, common.Form) and ast.l:
+            name = self.is_native(ast.l[0])
+            if name in self.special_forms:
+                return self.special_forms[name]
+
+    def expr(self, ast):
+        """
+        Emit the statements computing `ast`, returning a Python expression
+        for its value
+        """
+
+        if isinstance(ast, common.Form):
+            form = self.special(ast)
+            if form is not None:
+                return getattr(self, "gen_" + form)(ast, False)
+            return self.call(ast, False)
+        elif ast.obj.__class__ in compiler.SCALARS:
+            return self.const(compiler.quoted(ast))
+        elif ast.obj is None:
+            return "None"
+        elif isinstance(ast.obj, common.Symbol):
+            return self.var(ast)
+        elif isinstance(ast.obj, common.Array):
+            values = self.operands(ast.obj.a[::-1])[::-1]
+            return self.temp("%s(%s)" % (self.const(datastructs.vector), ", ".join(values)))
+        elif isinstance(ast.obj, common.Hash):
+            items = [item for key, value in ast.obj.d.items() for item in (key, value)]
+            values = self.operands(items[::-1])[::-1]
+            return self.temp("%s(%s)" % (self.const(datastructs.hashmap), ", ".join(values)))
+        else:
+            raise Exception(ast)
+
+    def tail(self, ast):
+        """
+        Emit `ast` in tail position: its value is returned
+        """
+
+        form = self.special(ast)
+        if form is not None:
+            value = getattr(self, "gen_" + form)(ast, True)
+            if value is not None:
+                self.line("return " + value)
+        elif isinstance(ast, common.Form):
+            self.call(ast, True)
+        else:
+            self.line("return " + self.expr(ast))
+
+    def operands(self, items):
+        """
+        Emit `items` in order, returning an expression for each; a value
+        read early is saved if a later form may change it
+        """
+
+        values = []
+        for i, item in enumerate(items):
+            value = self.expr(item)
+            if value not in self.stable and any(isinstance(later, common.Form) for later in items[i + 1:]):
+                value = self.temp(value)
+            values.append(value)
+        return values
+
+    def call(self, ast, tail):
+        # The VM evaluates the arguments right to left, then the callee
+        values = self.operands(ast.l[:0:-1] + ast.l[:1])
+        fn, args = values[-1], values[-2::-1]
+
+        name = self.builtin(ast.l[0])
+        inline = False
+        if name in OPERATORS and len(args) == 2:
+            result, inline = "(%s %s %s)" % (args[0], OPERATORS[name], args[1]), True
+        elif name == "just" and len(args) == 1:
+            result, inline = args[0], True
+        elif name is not None:
+            result = "B_%s(%s)" % (STDLIB.index(name), ", ".join(args))
+        elif tail:
+            self.line("return Tail(%s, (%s))" % (fn, "".join(arg + ", " for arg in args)))
+            return
+        else:
+            result = self.temp("%s(%s)" % (fn, ", ".join(args)))
+            self.line("while %s.__class__ is Tail:" % result)
+            self.line("    %s = %s.fn(*%s.args)" % (result, result, result))
+            return result
+
+        if tail:
+            self.line("return " + result)
+        elif inline:
+            return result
+        else:
+            return self.temp(result)
+
+    def gen_set(self, ast, tail):
+        if len(ast.l) != 3:
+            raise SyntaxError("`set!` takes two arguments", (self.file, ast.meta["row"], ast.meta["col"], "set!"))
+        value = self.expr(ast.l[2])
+        self.line("%s = %s" % (self.var(ast.l[1]), value))
+        return "None"
+
+    def gen_declare(self, ast, tail):
+        self.compile_declare(ast)
+        return "None"
+
+    def gen_quote(self, ast, tail):
+        return self.const(compiler.quoted(ast.l[1]))
+
+    def gen_fn(self, ast, tail):
+        assert len(ast) > 2, "At least 3 arguments to `fn` required"
+        if any(not isinstance(arg.obj, common.Symbol) for arg in ast.l[1].l):
+            raise NotImplementedError("Destructuring parameter lists not yet supported", (self.file, ast.l[1].meta["row"], ast.l[1].meta["col"], ""))
+
+        self.push_scope(symbol.obj.s[0] for symbol in ast.l[1].l)
+        level = self.symbol_table[0].level
+        name = self.fresh("f")
+        lines, self.lines = self.lines, []
+        indent, self.indent = self.indent, 1
+        for expr in ast.l[2:-1]:
+            self.expr(expr)
+        self.tail(ast.l[-1])
+        body, self.lines, self.indent = self.lines, lines, indent
+        scope = self.pop_scope()
+
+        self.line("def %s(*a):" % name)
+        self.line("    c%d = list(a) + [None] * (%d - len(a))" % (level, len(scope)))
+        self.lines.extend("    " * self.indent + line for line in body)
+        return name
+
+    def gen_if(self, ast, tail):
+        if len(ast.l) < 3 or len(ast.l) > 5:
+            raise SyntaxError("`if` statement requires at least three arguments and at most five", (self.file, ast.meta["row"], ast.meta["col"], "if"))
+        test = self.expr(ast.l[1])
+        if test not in self.stable:
+            test = self.temp(test)
+        result = None if tail else self.fresh("t")
+
+        tests = ["if %s and %s != Q:", "elif not %s and %s != Q:", "elif %s == Q:"]
+        for check, clause in zip(tests, ast.l[2:]):
+            self.line(check % ((test,) * check.count("%s")))
+            self.indent += 1
+            if tail:
+                self.tail(clause)
+            else:
+                self.line("%s = %s" % (result, self.expr(clause)))
+            self.indent -= 1
+        self.line("else:")
+        self.line("    %s None" % ("return" if tail else result + " ="))
+        return result
+
+    def generate(self, ast):
+        self.redefined = set(compiler.assignments(ast))
+        for cmd in ast:
+            self.expr(cmd)
+        body = self.lines
+
+        self.lines = []
+        self.line("c1 = [None] * %d" % len(self.symbol_table[0]))
+        for i, name in enumerate(STDLIB):
+            self.line("B_%d = S[%d]" % (i, i))
+        return "\n".join(["def program(S, K, Tail, Q):"] + self.lines + body + ["    return c1", ""])
+
+def invoke(fn, args):
+    """
+    Call `fn` on `args` for a stdlib function, running any tail calls it
+    returns
+    """
+
+    result = fn(*args)
+    while result.__class__ is Tail:
+        result = result.fn(*result.args)
+    return result
+
+def load(ast, file="#?"):
+    """
+    Compile `ast` to a Python function of no arguments that runs it, or
+    return `None` if it is nested too deeply for the Python compiler
+    """
+
+    g = Generator(file)
+    source = g.generate(ast)
+    try:
+        code = compile(source, "<pygen %s>" % file, "exec", 0, True)
+    except (SyntaxError, RuntimeError, MemoryError):
+        return None
+    namespace = {}
+    exec code in namespace
+    program = namespace["program"]
+    def main():
+        with stdlib.invoked_by(invoke):
+            return program(list(stdlib.stdlib.values()), g.consts, Tail, vm.Q)
+    return main
+
+def in_thread(fn, stack_size=256 * 1024 * 1024, recursion_limit=1000000):
+    """
+    Call `fn` on a thread with a large stack, so deeply recursive Forp
+    code does not overflow the C stack. An exception `fn` raises is raised
+    again here.
+    """
+
+    result, error = [], []
+    def target():
+        try:
+            result.append(fn())
+        except BaseException:
+            error.append(sys.exc_info())
+
+    old_size, old_limit = threading.stack_size(), sys.getrecursionlimit()
+    threading.stack_size(stack_size)
+    sys.setrecursionlimit(recursion_limit)
+    try:
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+    finally:
+        threading.stack_size(old_size)
+        sys.setrecursionlimit(old_limit)
+    if error:
+        raise error[0][0], error[0][1], error[0][2]
+    return result[0]
+
+def run(ast, file="#?"):
+    """
+    Run `ast` as Python if possible, otherwise on the VM; returns whether
+    it ran as Python
+    """
+
+    program = None if needs_vm(ast) else load(ast, file)
+    if program is not None:
+        in_thread(program)
+        return True
+
+    c = compiler.Compiler(file)
+    insts = c.compile(ast)
+    machine = vm.VM(insts, c.consts)
+    vm.run(machine, machine.mk_state(len(c.symbol_table[0])))
+    return False
+
+if __name__ == "__main__":
+    import parser
+
+    if len(sys.argv) < 2:
+        print "Usage: python pygen.py [-S] file.forp"
+        sys.exit(1)
+
+    ast = parser.from_file(sys.argv[-1])
+    if sys.argv[1] == "-S":
+        print Generator(sys.argv[-1]).generate(ast)
+    else:
+        run(ast, sys.argv[-1])
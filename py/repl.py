@@ -11,14 +11,17 @@ def read():
     return raw_input("forp> ")
 
 def eval(str, compiler, _vm, frames):
-    insts = compiler.compile(parser.from_str(str))
+    return eval_ast(parser.from_str(str), compiler, _vm, frames)
+
+def eval_ast(ast, compiler, _vm, frames):
+    insts = compiler.compile(ast)
     n = len(compiler.symbol_table[0])
 
     newlen = n - len(frames.car.context)
 
     frames.car.context.extend([None] * newlen)
-    newframes = vm.Cons(vm.Frame(None, frames.car.fn, len(_vm.code), frames.car.context, frames.car.pcontext), frames.cdr)
-    _vm.code.extend(insts)
+    start = _vm.load(insts, compiler.consts)
+    newframes = vm.Cons(vm.Frame(None, frames.car.fn, start, frames.car.context, frames.car.captured), frames.cdr)
 
     return vm.run(_vm, newframes) # frames
 
@@ -28,7 +31,7 @@ def output(frames):
     return frames
 
 def loop():
-    comp = compiler.Compiler(file="#?")
+    comp = compiler.Compiler(file="#?", incremental=True)
     _vm = vm.VM([])
     frames = _vm.mk_state(0)
 
@@ -39,5 +42,69 @@ def loop():
             return
         frames = output(eval(s, comp, _vm, frames))
 
+# Opcodes whose values refer to the code they are in
+REFERS = set(vm.OPS[name] for name in ("CLSR", "PUSHCC", "PUSHEC"))
+
+def releasable(_vm, start):
+    """
+    Whether nothing can refer to the code `_vm` holds from `start` on, now
+    that it has run: it made no closures or continuations, no fibers are
+    left, and it does not hold the `HALT` that `apply` returns to
+    """
+
+    if _vm.fibers or _vm.awaiting or (_vm.done is not None and _vm.done >= start):
+        return False
+    return not any(op in REFERS for op, a, b in _vm.code[start:])
+
+def run_stream(stream, file=None):
+    """
+    Run the Forp program read from the file object `stream` one top-level
+    command at a time, so each command runs as soon as it has been read.
+    The code and constants of a command are released once it has run,
+    unless it made closures, which may still be called; memory then grows
+    with the functions a program defines, not with its length.
+
+    As in the REPL, a continuation captured by a top-level command only
+    extends to the end of that command.
+
+    Otherwise a program runs as it does compiled whole, though the
+    incremental compiler makes escape continuations of fewer `@:call/cc`s:
+
+    >>> import os
+    >>> path = os.path.join(os.path.dirname(__file__), "test", "escapes.forp")
+    >>> c = compiler.Compiler(path)
+    >>> machine = vm.VM(c.compile(parser.from_file(path)), c.consts)
+    >>> _ = vm.run(machine, machine.mk_state(len(c.symbol_table[0])))
+    11
+    21
+    100
+    8
+    32
+    >>> _ = run_stream(open(path))
+    11
+    21
+    100
+    8
+    32
+    """
+
+    if file is None:
+        file = getattr(stream, "name", "#?")
+
+    comp = compiler.Compiler(file=file, incremental=True)
+    _vm = vm.VM([])
+    frames = _vm.mk_state(0)
+    for cmd in parser.iter_commands(stream, file):
+        start, consts = len(_vm.code), len(_vm.consts)
+        frames = eval_ast([cmd], comp, _vm, frames)
+        if releasable(_vm, start):
+            del _vm.code[start:]
+            del _vm.consts[consts:]
+    return frames
+
 if __name__ == "__main__":
-    loop()
+    import sys
+    if len(sys.argv) > 1:
+        run_stream(open(sys.argv[1]))
+    else:
+        loop()
@@ -1,6 +1,13 @@
+import contextlib
+import itertools
 import operator
 import sys
 
+import aio
+import datastructs
+import kernels
+import parallel
+
 try:
     from collections import OrderedDict
 except ImportError:
@@ -10,6 +17,128 @@ def opprint(*args):
     sys.stdout.write(" ".join(str(i) for i in args) + "\n")
     return args[0]
 
+def invoke(fn, args):
+    """
+    Call `fn`, a function passed to a stdlib function, on `args`. While a
+    backend runs a program, this is its own function that can also run
+    Forp functions (see `invoked_by`).
+    """
+
+    return fn(*args)
+
+@contextlib.contextmanager
+def invoked_by(call):
+    """
+    Make `call`, such as a VM's `apply`, the `invoke` of the block, and
+    restore the one before after it; a runner's loop runs in one, so two
+    VMs never call each other's functions
+    """
+
+    global invoke
+    saved, invoke = invoke, call
+    try:
+        yield
+    finally:
+        invoke = saved
+
+# The value of `#?`: `vm.Q`, which cannot be imported here
+MAYBE = "#q"
+
+def truthy(value):
+    """
+    Whether `value` is true as `if` tests it, where `#?` is not
+    """
+
+    return bool(value) and value != MAYBE
+
+def predicate(pred):
+    """
+    `pred` as a Python function telling whether it is `truthy` of a value
+    """
+
+    fn = native(pred)
+    return lambda value: truthy(fn(value))
+
+def native(fn):
+    """
+    `fn` as a Python callable: itself if it is a stdlib primitive,
+    otherwise a function calling it through the `invoke` of the moment,
+    so a lazy stream runs it on the VM that made the stream
+    """
+
+    if id(fn) in PRIMITIVES:
+        return fn
+    call = invoke
+    return lambda *args: call(fn, args)
+
+def each(fn, values):
+    """
+    `fn` called on each of the list `values`; a stdlib primitive is called
+    directly, or through its kernel (see `kernels`), rather than through
+    `invoke`
+    """
+
+    kernel = VECTORIZED.get(id(fn))
+    if kernel is not None:
+        results = kernels.apply(kernel, values)
+        if results is not None:
+            return results
+    if id(fn) in PRIMITIVES:
+        return map(fn, values)
+    return [invoke(fn, (value,)) for value in values]
+
+def opmap(fn, coll):
+    if isinstance(coll, datastructs.Stream):
+        return datastructs.fuse(coll, itertools.imap, native(fn))
+    return datastructs.vector(*each(fn, list(coll)))
+
+def opfilter(pred, coll):
+    if isinstance(coll, datastructs.Stream):
+        return datastructs.fuse(coll, itertools.ifilter, predicate(pred))
+    values = list(coll)
+    return datastructs.vector(*itertools.compress(values, map(truthy, each(pred, values))))
+
+def opreduce(fn, init, coll):
+    if id(fn) in PRIMITIVES:
+        return reduce(fn, coll, init)
+    return reduce(lambda acc, value: invoke(fn, (acc, value)), coll, init)
+
+def optakewhile(pred, coll):
+    if isinstance(coll, datastructs.Stream):
+        return datastructs.fuse(coll, itertools.takewhile, predicate(pred))
+    return datastructs.vector(*itertools.takewhile(predicate(pred), coll))
+
+def islice(n, it):
+    return itertools.islice(it, n)
+
+def optake(n, coll):
+    if isinstance(coll, datastructs.Stream):
+        return datastructs.fuse(coll, islice, n)
+    return datastructs.vector(*islice(n, coll))
+
+# `id`s of the functions that may return a future, which the compiler
+# calls with `AWAIT` (see `vm`)
+ASYNCHRONOUS = set()
+
+def asynchronous(fn):
+    """
+    Mark the stdlib function `fn` as one that may return a future, which
+    the calling fiber then waits on; returns `fn`
+    """
+
+    ASYNCHRONOUS.add(id(fn))
+    return fn
+
+def fiber(name):
+    """
+    The stdlib value of the fiber primitive `name`, for when it is called
+    in a way the compiler cannot make its opcode (see `vm.FIBERS`)
+    """
+
+    def primitive(*args):
+        raise TypeError("`%s` can only be called by its name, with the arguments it takes" % name)
+    return primitive
+
 stdlib = OrderedDict([
     ("+", operator.add),
     ("-", operator.sub),
@@ -18,5 +147,46 @@ stdlib = OrderedDict([
     ("=", operator.eq),
     ("print", opprint),
     ("true?", bool),
-    ("just", lambda x: x)])
+    ("just", lambda x: x),
+    # Arrays and hashes are `datastructs.Vector`s and `HashMap`s
+    ("push", lambda coll, value: coll.conj(value)),
+    ("assoc", lambda coll, key, value: coll.assoc(key, value)),
+    ("dissoc", lambda coll, key: coll.dissoc(key)),
+    # Never returns for an infinite stream
+    ("length", len),
+    # Collection functions take any array, hash (its keys) or other
+    # iterable and return arrays, except that `map`, `filter`, `take` and
+    # `take/while` of a stream are lazy streams (see `datastructs.Stream`)
+    ("range", lambda *args: datastructs.vector(*xrange(*args))),
+    ("map", opmap),
+    ("filter", opfilter),
+    ("reduce", opreduce),
+    ("sum", lambda coll: sum(coll, 0)),
+    ("take/while", optakewhile),
+    ("even?", lambda n: n % 2 == 0),
+    ("odd?", lambda n: n % 2 != 0),
+    ("<", operator.lt),
+    (">", operator.gt),
+    ("stream", lambda head, rest: datastructs.Stream(head, native(rest))),
+    ("iterate", lambda fn, x: datastructs.Pipeline(datastructs.Iterate(native(fn), x), [])),
+    ("head", lambda coll: coll.car),
+    ("tail", lambda coll: coll.cdr),
+    ("take", optake),
+    # `map` and `reduce` on a pool of worker processes (see `parallel`)
+    ("pmap", lambda fn, coll: datastructs.vector(*parallel.pmap(fn, coll))),
+    ("preduce", lambda fn, init, coll: parallel.preduce(fn, init, coll)),
+    # Fibers and the channels between them (see `vm.FIBERS`)
+    ("chan", lambda capacity=0: datastructs.Channel(capacity)),
+    ("spawn", fiber("spawn")),
+    ("yield", fiber("yield")),
+    ("send", fiber("send")),
+    ("recv", fiber("recv")),
+    # I/O that only holds up the calling fiber, finishing on the `aio` loop
+    ("sleep", asynchronous(lambda seconds: aio.sleep(seconds))),
+    ("read-file", asynchronous(lambda path: aio.read_file(path)))])
+
+# Keyed by `id`, since arrays and hashes are callable too, and hashing one
+# means hashing all its elements
+PRIMITIVES = set(id(fn) for fn in stdlib.values())
+VECTORIZED = dict((id(stdlib[name]), kernel) for name, kernel in kernels.UNARY.items())
           
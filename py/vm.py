@@ -1,88 +1,476 @@
-DEBUG = True
+DEBUG = False
 
-from datastructs import Cons
+import collections
+import operator
+import re
+import sys
+
+from datastructs import Cons, Vector, HashMap, vector, hashmap, unlist
 T, F, Q = "#t", "#f", "#q"
 
 class HALT(Exception): pass
+# Raised by an instruction to switch fibers; the argument is the state to
+# run next
+class Switch(Exception): pass
+# Raised when no fiber can run until a future one waits on completes
+class Idle(Exception): pass
 class Frame(object):
-    __slots__ = ["stack", "fn", "pc", "context", "pcontext"]
-    def __init__(self, stack, fn, pc, context, pcontext):
+    __slots__ = ["stack", "fn", "pc", "context", "captured", "shared"]
+    def __init__(self, stack, fn, pc, context, captured):
         self.stack = stack; self.fn = fn; self.pc = pc
-        self.context = context; self.pcontext = pcontext
+        self.context = context; self.captured = captured
+        self.shared = False
+    def copy(self):
+        return Frame(self.stack, self.fn, self.pc, self.context, self.captured)
+    # Pickled as state, set after the frame exists, since closures in its
+    # context may refer back to it
+    def __getstate__(self):
+        return self.stack, self.fn, self.pc, self.context, self.captured
+    def __setstate__(self, state):
+        self.stack, self.fn, self.pc, self.context, self.captured = state
+        self.shared = False
     def __repr__(self):
         return "%s{%s, %s}" % (self.fn, self.stack, self.context)
 
 class Func(object):
-    __slots__ = ["frame", "continuation"]
-    def __init__(self, frame, continuation):
+    __slots__ = ["frame", "continuation", "escape"]
+    def __init__(self, frame, continuation, escape=False):
         self.frame = frame
         self.continuation = continuation
+        # An escape continuation is only called while the frames it
+        # continues are still live, so capturing it need not mark them shared
+        self.escape = escape
+    def __getstate__(self):
+        return self.frame, self.continuation, self.escape
+    def __setstate__(self, state):
+        self.frame, self.continuation, self.escape = state
     def __repr__(self):
         if self.continuation is not None:
             return "<cont>"
         else:
             return "<fn>"
 
+import common
 import stdlib
+
+OPCODES = ["NOOP", "POP", "PUSH", "ROT", "DUP", "GETL", "SETL", "GET", "SET",
+           "GETG", "SETG", "CALL", "CALLPOP", "GOTO", "IFT", "IFF", "IFQ",
+           "CLSR", "CAPL", "CAPT", "HALT", "PUSHCC",
+           "ADD", "SUB", "MUL", "DIV", "EQ",
+           "CALLN", "CALLF", "CALLPOPN", "CALLPOPF", "PUSHEC", "ARRAY", "HASH",
+           "SPAWN", "YIELD", "SEND", "RECV", "AWAIT"]
+OPS = dict((name, i) for i, name in enumerate(OPCODES))
+PUSH = OPS["PUSH"]
+CALL, CALLPOP = OPS["CALL"], OPS["CALLPOP"]
+
+# Opcodes the compiler emits for two-argument calls of these stdlib
+# operators. The operand is the operator's stdlib slot: the handlers check
+# that the slot still holds the operator, and call whatever it holds if not.
+ARITH = {"+": "ADD", "-": "SUB", "*": "MUL", "/": "DIV", "=": "EQ"}
+
+# Fibers are lightweight threads of Forp code, each a state of its own:
+# `spawn fn` queues a new one calling the closure `fn`, returning to the
+# `HALT` at `done` when it ends. `run` switches between the runnable ones
+# every `BUDGET` instructions, and when one `yield`s or blocks on a
+# `datastructs.Channel`. A blocked fiber is parked on the channel as it is
+# at its `SEND` or `RECV`, and queued again, to retry that, once another
+# fiber has received from or sent to the channel.
+#
+# A stdlib function can only return a value, not switch fibers, so calls of
+# these with this many arguments compile to opcodes, taking the stdlib slot
+# like the `ARITH` ones; the stdlib functions themselves only raise.
+FIBERS = {"spawn": ("SPAWN", 1), "yield": ("YIELD", 0), "send": ("SEND", 2), "recv": ("RECV", 1)}
+BUDGET = 1000
+
+# A stdlib function marked `stdlib.asynchronous` may return a future, with
+# `add_done_callback` and `result` methods as in `aio`, `asyncio` or
+# `concurrent.futures`, to stand for a result it does not have yet. Direct
+# calls of one compile to `AWAIT slot argc`, which parks the calling fiber
+# until the future completes and then continues it with the result. The
+# other fibers run meanwhile; when none can, `run` waits (see `VM.wait`),
+# and `aio.Task` returns to its event loop.
+
+# `CALL` and `CALLPOP` rewrite themselves, on first execution, into one of
+# these, specialized to the kind of callee they saw: a Python function
+# (`N`) or a closure (`F`). A specialized call that sees another kind of
+# callee turns back into the generic instruction, with its second operand
+# set so it is not specialized again.
+SPECIALIZED = {"CALLN": "CALL", "CALLF": "CALL", "CALLPOPN": "CALLPOP", "CALLPOPF": "CALLPOP"}
+
+def pop(stack, n):
+    """
+    Pop `n` call arguments off `stack`; returns them and the rest of it
+    """
+
+    if n == 1:
+        return [stack.car], stack.cdr
+    elif n == 2:
+        return [stack.car, stack.cdr.car], stack.cdr.cdr
+    args = []
+    for i in range(n):
+        args.append(stack.car)
+        stack = stack.cdr
+    return args, stack
+
+NAMED = {"#0": None, "#t": True, "#f": False}
+
+def encode(inst):
+    """
+    Encode one named instruction into an `(opcode, a, b)` triple, with the
+    opcode an index into `OPCODES`
+    """
+
+    name, args = inst[0], inst[1:]
+    if name not in OPS:
+        raise Exception("Unknown bytecode %s" % name)
+    args = map(int, args) + [None] * (2 - len(args))
+    return (OPS[name], args[0], args[1])
+
+# The tokens of a constant in a text listing: a string, a bracket, or a
+# name or number
+LITERAL = re.compile(r'\s*(u?"(?:[^"\\]|\\.)*"|[][(){}]|[^][(){}\s"]+)')
+CLOSING = {"(": ")", "[": "]", "{": "}"}
+
+def literal(obj):
+    """
+    Convert a `PUSH` operand read from a text listing, as `unliteral`
+    writes it, into the constant it stands for
+    """
+
+    obj = obj.strip()
+    tokens, pos = [], 0
+    while pos < len(obj):
+        match = LITERAL.match(obj, pos)
+        if match is None:
+            raise ValueError("Invalid constant `%s` in listing" % obj)
+        tokens.append(match.group(1))
+        pos = match.end()
+    tokens.reverse()
+    value = read_literal(tokens, obj)
+    if tokens:
+        raise ValueError("Invalid constant `%s` in listing" % obj)
+    return value
+
+def read_literal(tokens, obj):
+    """
+    Read one constant off the reversed `tokens` of the operand `obj`
+    """
+
+    if not tokens:
+        raise ValueError("Invalid constant `%s` in listing" % obj)
+    token = tokens.pop()
+    if token in CLOSING:
+        items = []
+        while tokens and tokens[-1] != CLOSING[token]:
+            items.append(read_literal(tokens, obj))
+        if not tokens:
+            raise ValueError("Unclosed `%s` in listing constant `%s`" % (token, obj))
+        tokens.pop()
+        if token == "(":
+            return unlist(items)
+        return vector(*items) if token == "[" else hashmap(*items)
+    elif token[0] == '"':
+        return intern(token[1:-1].decode("string_escape"))
+    elif token[:2] == 'u"':
+        return token[2:-1].decode("unicode_escape")
+    elif token[0] == "'":
+        return common.Symbol(tuple(token[1:].split(":")))
+    elif token == "#?":
+        return Q
+    elif token in NAMED:
+        return NAMED[token]
+    for parse in (int, float):
+        try:
+            return parse(token)
+        except ValueError:
+            pass
+    raise ValueError("Invalid constant `%s` in listing" % obj)
+
+def unliteral(value):
+    """
+    The text listing form of the constant `value`, which `literal` reads
+    back: strings are quoted and escaped, symbols quoted with `'`, and
+    quoted lists, arrays and hashes written in `()`, `[]` and `{}`
+
+    >>> print unliteral(vector("Two equals 2!", common.Symbol(("a", "b")), 0.1, Q))
+    ["Two equals 2!" 'a:b 0.1 #?]
+    >>> literal(unliteral('say "hi"\\n'))
+    'say "hi"\\n'
+    """
+
+    if value is Q:
+        return "#?"
+    for name, named in NAMED.items():
+        if value is named:
+            return name
+    if isinstance(value, str):
+        return '"%s"' % value.encode("string_escape").replace('"', '\\"')
+    elif isinstance(value, unicode):
+        return 'u"%s"' % value.encode("unicode_escape").replace('"', '\\"')
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, common.Symbol):
+        return "'" + ":".join(value.s)
+    elif isinstance(value, Cons):
+        return "(%s)" % " ".join(map(unliteral, value.__list__()))
+    elif isinstance(value, Vector):
+        return "[%s]" % " ".join(map(unliteral, value))
+    elif isinstance(value, HashMap):
+        return "{%s}" % " ".join(unliteral(item) for pair in value.items() for item in pair)
+    return str(value)
+
 class VM(object):
-    def __init__(self, bytecode):
-        self.code = bytecode
+    def __init__(self, bytecode, consts=None):
+        self.code = []
+        self.consts = []
+        self.table = [getattr(self, "h" + name) for name in OPCODES]
+        # The pc of a `HALT` that `apply` and fibers return to, once it has one
+        self.done = None
+        # Runnable fibers other than the running one
+        self.fibers = collections.deque()
+        # How many fibers wait on futures, and those whose future has
+        # completed, as `(frames, future)`; `waker` is called, from any
+        # thread, when one completes
+        self.awaiting = 0
+        self.completed = collections.deque()
+        self.waker = None
+        self.load(bytecode, consts)
+
+    def load(self, bytecode, consts=None):
+        """
+        Append `bytecode` to the program; returns its starting pc
+
+        `bytecode` is a list of named instruction tuples, as produced by
+        `compiler`, or of `(opcode, a, b)` triples, as read by `forpc.load`.
+        With `consts`, the constant pool of the compilation, `PUSH` operands
+        index into it; without, they are literals from a text listing (see
+        `read`).
+        """
+
+        start = len(self.code)
+        if consts is None:
+            self.code.extend(map(self.decode, bytecode))
+            return start
+
+        base = len(self.consts)
+        self.consts.extend(consts)
+        if bytecode and isinstance(bytecode[0][0], str):
+            bytecode = map(encode, bytecode)
+        if base:
+            bytecode = [(op, a + base, b) if op == PUSH else (op, a, b) for op, a, b in bytecode]
+        self.code.extend(bytecode)
+        return start
+
+    def decode(self, inst):
+        """
+        Decode one instruction of a text listing; its `PUSH` operand is
+        converted and moved into the constant pool
+        """
+
+        if inst[0] == "PUSH":
+            self.consts.append(literal(inst[1]))
+            inst = ("PUSH", len(self.consts) - 1)
+        return encode(inst)
 
     def mk_state(self, n):
         # stdlibframe has None as the pc to catch errors early
         stdlibframe = Frame("<stdlibframe>", None, None, stdlib.stdlib.values(), None)
-        return Cons(Frame(None, None, 0, [None]*n, stdlibframe), Cons(stdlibframe, None))
-    
+        top = Frame(None, None, 0, [None]*n, [])
+        # Contexts every function can reach without capturing them
+        self.scopes = [stdlibframe.context, top.context]
+        return Cons(top, Cons(stdlibframe, None))
+
+    def new_stack(self):
+        return None
+
+    def apply(self, fn, args):
+        """
+        Call `fn` on `args` for a stdlib function and return the result,
+        running a closure on this VM until it returns. If the closure
+        jumps out through a continuation, the rest of the program runs
+        from here, and the call only ends, with `HALT`, when it does.
+        """
+
+        if fn.__class__ is not Func:
+            return fn(*args)
+        elif fn.continuation is not None:
+            raise TypeError("Continuations cannot be passed to stdlib functions")
+
+        if self.done is None:
+            self.done = len(self.code)
+            self.code.append((OPS["HALT"], None, None))
+        # Run until the closure returns into this frame
+        caller = Frame(self.new_stack(), None, self.done, [], [])
+        fn = fn.frame
+        frames = Cons(Frame(self.new_stack(), fn.fn, fn.pc, list(args) + fn.context[len(args):], fn.captured), Cons(caller, None))
+
+        code, table, done = self.code, self.table, self.done
+        while frames.car.pc != done:
+            op, a, b = code[frames.car.pc]
+            frames = table[op](frames.car, frames, a, b)
+        return self.peek(frames.car)
+
+    def spawned(self, fn):
+        """
+        The state of a new fiber calling the closure `fn`, which returns
+        into a frame at the `HALT` at `done`
+        """
+
+        if self.done is None:
+            self.done = len(self.code)
+            self.code.append((OPS["HALT"], None, None))
+        caller = Frame(self.new_stack(), None, self.done, [], [])
+        fn = fn.frame
+        return Cons(Frame(self.new_stack(), fn.fn, fn.pc, list(fn.context), fn.captured), Cons(caller, None))
+
+    def finished(self, frames):
+        """
+        Whether `frames`, which has halted, is a fiber that has ended, not
+        the top-level code
+        """
+
+        return frames.car.pc == self.done
+
+    def nested(self):
+        """
+        Whether this is running inside `apply`, whose Python caller a fiber
+        cannot be switched out of. Found from the Python stack, so `apply`
+        itself pays nothing for it.
+        """
+
+        frame = sys._getframe(1)
+        while frame is not None:
+            if frame.f_code is APPLY:
+                return True
+            frame = frame.f_back
+        return False
+
+    def next_fiber(self):
+        if not self.fibers:
+            if self.awaiting:
+                raise Idle
+            raise RuntimeError("Deadlock: every fiber is blocked on a channel")
+        return self.fibers.popleft()
+
+    def resumed(self):
+        """
+        Queue the fibers whose futures have completed, continuing each
+        with its future's result
+        """
+
+        while self.completed:
+            frames, future = self.completed.popleft()
+            self.awaiting -= 1
+            argc = self.code[frames.car.pc][2]
+            self.fibers.append(self.result(frames.car, frames, argc, future.result()))
+
+    def wait(self):
+        """
+        Block until a future a fiber waits on completes, running the
+        default `aio` loop meanwhile, which completes the stdlib's own
+        futures; returns the state to go on with
+        """
+
+        import aio
+        loop = aio.get_loop()
+        waker, self.waker = self.waker, lambda: loop.call_soon_threadsafe(lambda: None)
+        try:
+            while not self.completed:
+                loop.run_once()
+        finally:
+            self.waker = waker
+        self.resumed()
+        return self.fibers.popleft()
+
+    def peek(self, frame):
+        """
+        The value on top of `frame`'s operand stack
+        """
+
+        return frame.stack.car
+
     def step(self, frames):
         frame = frames.car
-        inst = self.code[frame.pc][0]
+        op, a, b = self.code[frame.pc]
         if DEBUG:
             #print "\t", " :: ".join(map(str, [(frame.stack, frame.pc) for frame in frames.__list__()]))
-            print "% 3d" % frame.pc + "  " * (len(frames) - 2), ":".join(map(str, self.code[frame.pc])), frame.context, frame.stack
+            args = [self.consts[a]] if op == PUSH else [arg for arg in (a, b) if arg is not None]
+            print "% 3d" % frame.pc + "  " * (len(frames) - 2), ":".join(map(str, [OPCODES[op]] + args)), frame.context, frame.stack
 
-        if hasattr(self, "h" + inst):
-            return getattr(self, "h" + inst)(frame, frames, *self.code[frame.pc][1:])
-        else:
-            raise Exception("Unknown bytecode %s" % inst)
+        return self.table[op](frame, frames, a, b)
 
-    def hNOOP(self, frame, frames):
-        return Cons(Frame(frame.stack, frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+    def hNOOP(self, frame, frames, _=None, __=None):
+        return Cons(Frame(frame.stack, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
 
-    def hPOP(self, frame, frames):
-        return Cons(Frame(frame.stack.cdr, frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+    def hPOP(self, frame, frames, _=None, __=None):
+        return Cons(Frame(frame.stack.cdr, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
 
-    def hPUSH(self, frame, frames, obj):
-        # TODO Properly parse `obj`
-        obj = int(obj)
-        return Cons(Frame(Cons(obj, frame.stack), frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+    def hPUSH(self, frame, frames, i, _=None):
+        return Cons(Frame(Cons(self.consts[i], frame.stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
 
-    def hROT(self, frame, frames):
+    def hROT(self, frame, frames, _=None, __=None):
         fst = frame.stack.car
         snd = frame.stack.cdr.car
-        return Cons(Frame(Cons(snd, Cons(fst, frame.stack.cdr.cdr)), frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+        return Cons(Frame(Cons(snd, Cons(fst, frame.stack.cdr.cdr)), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
 
-    def hDUP(self, frame, frames, n):
-        n = int(n)
+    def hDUP(self, frame, frames, n, _=None):
         assert n == 1, "n > 1 not supported"
-        return Cons(Frame(Cons(frame.stack.car, frame.stack), frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
-
-    def hGET(self, frame, frames, n, d):
-        n, d = int(n), int(d)
-        cframe = frame
-        for i in range(d):
-            cframe = cframe.pcontext
-        return Cons(Frame(Cons(cframe.context[n], frame.stack), frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
-
-    def hSET(self, frame, frames, n, d):
-        n, d = int(n), int(d)
-        cframe = frame
-        for i in range(d):
-            cframe = cframe.pcontext
-        cframe.context[n] = frame.stack.car
-        return Cons(Frame(frame.stack.cdr, frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
-
-    def hCALL(self, frame, frames, n):
-        n = int(n)
+        return Cons(Frame(Cons(frame.stack.car, frame.stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hGETL(self, frame, frames, n, _=None):
+        return Cons(Frame(Cons(frame.context[n], frame.stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hSETL(self, frame, frames, n, _=None):
+        frame.context[n] = frame.stack.car
+        return Cons(Frame(frame.stack.cdr, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hGET(self, frame, frames, n, k):
+        return Cons(Frame(Cons(frame.captured[k][n], frame.stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hSET(self, frame, frames, n, k):
+        frame.captured[k][n] = frame.stack.car
+        return Cons(Frame(frame.stack.cdr, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hGETG(self, frame, frames, n, s):
+        return Cons(Frame(Cons(self.scopes[s][n], frame.stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hSETG(self, frame, frames, n, s):
+        self.scopes[s][n] = frame.stack.car
+        return Cons(Frame(frame.stack.cdr, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hCALL(self, frame, frames, n, generic=None):
+        if not generic:
+            self.specialize(frame, n, "CALL")
+        return self.call(frame, frames, n)
+
+    def hCALLPOP(self, frame, frames, n, generic=None):
+        if not generic:
+            self.specialize(frame, n, "CALLPOP")
+        return self.callpop(frame, frames, n)
+
+    def specialize(self, frame, n, name):
+        """
+        Rewrite the call instruction `name` at `frame.pc` for the kind of
+        callee on the stack (see `SPECIALIZED`)
+        """
+
+        fn = self.peek(frame)
+        if fn.__class__ is Func:
+            kind = "F" if fn.continuation is None else None
+        else:
+            kind = "N" if callable(fn) else None
+        self.code[frame.pc] = (OPS[name + kind], n, None) if kind else (OPS[name], n, 1)
+
+    def miss(self, frame, frames, n, op):
+        """
+        A specialized call saw another kind of callee: make it the generic
+        `op` for good, and run that
+        """
+
+        self.code[frame.pc] = (op, n, 1)
+        return self.table[op](frame, frames, n, 1)
+
+    def call(self, frame, frames, n):
         fn = frame.stack.car
         stack = frame.stack.cdr
         args = []
@@ -91,20 +479,17 @@ class VM(object):
             stack = stack.cdr
 
         if callable(fn):
-            return Cons(Frame(Cons(fn(*args), stack), frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+            return Cons(Frame(Cons(fn(*args), stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
         elif isinstance(fn, Func) and fn.continuation is None:
             fn = fn.frame
-            return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[len(args):], fn.pcontext), Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr))
+            return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[len(args):], fn.captured), Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr))
         elif isinstance(fn, Func) and fn.continuation is not None:
-            tail = fn.continuation
-            fn = fn.frame
             assert len(args) == 1, "Calling continuation with multiple arguments is illegal!"
-            return Cons(Frame(Cons(args[0], fn.stack), fn.fn, fn.pc, fn.context, fn.pcontext), Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.pcontext), tail))
+            return self.unwind(fn, args[0])
         else:
             print "ERR", fn
 
-    def hCALLPOP(self, frame, frames, n):
-        n = int(n)
+    def callpop(self, frame, frames, n):
         fn = frame.stack.car
         stack = frame.stack.cdr
         args = []
@@ -114,89 +499,965 @@ class VM(object):
 
         if callable(fn):
             frame2 = frames[1]
-            return Cons(Frame(Cons(fn(*args), frame2.stack), frame2.fn, frame2.pc, frame2.context, frame2.pcontext), frames.cdr.cdr)
+            return Cons(Frame(Cons(fn(*args), frame2.stack), frame2.fn, frame2.pc, frame2.context, frame2.captured), frames.cdr.cdr)
         elif isinstance(fn, Func) and fn.continuation is None:
             fn = fn.frame
             frame2 = frames[1]
-            return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[len(args):], fn.pcontext), Cons(Frame(stack, frame2.fn, frame2.pc, frame2.context, frame2.pcontext), frames.cdr.cdr))
+            return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[len(args):], fn.captured), Cons(Frame(stack, frame2.fn, frame2.pc, frame2.context, frame2.captured), frames.cdr.cdr))
         elif isinstance(fn, Func) and fn.continuation is not None:
-            tail = fn.continuation
-            fn = fn.frame
             assert len(args) == 1, "Calling continuation with multiple arguments is illegal!"
-            return Cons(Frame(Cons(args[0], fn.stack), fn.fn, fn.pc, fn.context, fn.pcontext), Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.pcontext), tail))
+            return self.unwind(fn, args[0])
         else:
             print "ERR: Not a function:", fn
 
-    def hGOTO(self, frame, frames, delta):
-        delta = int(delta)
-        return Cons(Frame(frame.stack, frame.fn, frame.pc+delta, frame.context, frame.pcontext), frames.cdr)
+    def unwind(self, fn, value):
+        """
+        Call the continuation `fn` with `value`: the frames it continues
+        replace the caller's, which are dropped
+        """
 
-    def hIFT(self, frame, frames, delta):
-        delta = int(delta)
+        cc = fn.frame
+        return Cons(Frame(Cons(value, cc.stack), cc.fn, cc.pc, cc.context, cc.captured), fn.continuation)
+
+    def hCALLN(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        if fn.__class__ is Func:
+            return self.miss(frame, frames, n, CALL)
+        args, stack = pop(frame.stack.cdr, n)
+        return Cons(Frame(Cons(fn(*args), stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hCALLF(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        if fn.__class__ is not Func or fn.continuation is not None:
+            return self.miss(frame, frames, n, CALL)
+        args, stack = pop(frame.stack.cdr, n)
+        fn = fn.frame
+        return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[n:], fn.captured), Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr))
+
+    def hCALLPOPN(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        if fn.__class__ is Func:
+            return self.miss(frame, frames, n, CALLPOP)
+        args, stack = pop(frame.stack.cdr, n)
+        frame2 = frames.cdr.car
+        return Cons(Frame(Cons(fn(*args), frame2.stack), frame2.fn, frame2.pc, frame2.context, frame2.captured), frames.cdr.cdr)
+
+    def hCALLPOPF(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        if fn.__class__ is not Func or fn.continuation is not None:
+            return self.miss(frame, frames, n, CALLPOP)
+        args, stack = pop(frame.stack.cdr, n)
+        fn = fn.frame
+        frame2 = frames.cdr.car
+        return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[n:], fn.captured), Cons(Frame(stack, frame2.fn, frame2.pc, frame2.context, frame2.captured), frames.cdr.cdr))
+
+    def redefined(self, frame, frames, n, argc=2):
+        """
+        The stdlib operator in slot `n` has been `set!`: call what the slot
+        holds now
+        """
+
+        return self.call(Frame(Cons(self.scopes[0][n], frame.stack), frame.fn, frame.pc, frame.context, frame.captured), frames, argc)
+
+    def hADD(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.add:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        return Cons(Frame(Cons(stack.car + stack.cdr.car, stack.cdr.cdr), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hSUB(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.sub:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        return Cons(Frame(Cons(stack.car - stack.cdr.car, stack.cdr.cdr), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hMUL(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.mul:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        return Cons(Frame(Cons(stack.car * stack.cdr.car, stack.cdr.cdr), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hDIV(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.div:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        return Cons(Frame(Cons(stack.car / stack.cdr.car, stack.cdr.cdr), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hEQ(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.eq:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        return Cons(Frame(Cons(stack.car == stack.cdr.car, stack.cdr.cdr), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hGOTO(self, frame, frames, delta, _=None):
+        return Cons(Frame(frame.stack, frame.fn, frame.pc+delta, frame.context, frame.captured), frames.cdr)
+
+    def hIFT(self, frame, frames, delta, _=None):
         top = frame.stack.car
         stack = frame.stack.cdr
 
         if top and top != Q:
-            return Cons(Frame(stack, frame.fn, frame.pc+delta, frame.context, frame.pcontext), frames.cdr)
+            return Cons(Frame(stack, frame.fn, frame.pc+delta, frame.context, frame.captured), frames.cdr)
         else:
-            return Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+            return Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
         
-    def hIFF(self, frame, frames, delta):
-        delta = int(delta)
+    def hIFF(self, frame, frames, delta, _=None):
         top = frame.stack.car
         stack = frame.stack.cdr
 
         if not top and top != Q:
-            return Cons(Frame(stack, frame.fn, frame.pc+delta, frame.context, frame.pcontext), frames.cdr)
+            return Cons(Frame(stack, frame.fn, frame.pc+delta, frame.context, frame.captured), frames.cdr)
         else:
-            return Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+            return Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
 
-    def hIFQ(self, frame, frames, delta):
-        delta = int(delta)
+    def hIFQ(self, frame, frames, delta, _=None):
         top = frame.stack.car
         stack = frame.stack.cdr
 
         if top == Q:
-            return Cons(Frame(stack, frame.fn, frame.pc+delta, frame.context, frame.pcontext), frames.cdr)
+            return Cons(Frame(stack, frame.fn, frame.pc+delta, frame.context, frame.captured), frames.cdr)
         else:
-            return Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+            return Cons(Frame(stack, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
 
     def hCLSR(self, frame, frames, delta, n):
-        n = int(n)
-        delta = int(delta)
-
         nctx = [None] * n
-        newframe = Func(Frame(None, "", frame.pc + delta, nctx, frame), None)
+        newframe = Func(Frame(None, "", frame.pc + delta, nctx, []), None)
         # Error, replace fn with the frame we're making. Can't figure out how.
-        return Cons(Frame(Cons(newframe, frame.stack), frame.fn, frame.pc+1, frame.context, frame.pcontext), frames.cdr)
+        return Cons(Frame(Cons(newframe, frame.stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hCAPL(self, frame, frames, _=None, __=None):
+        frame.stack.car.frame.captured.append(frame.context)
+        return Cons(Frame(frame.stack, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hCAPT(self, frame, frames, k, _=None):
+        frame.stack.car.frame.captured.append(frame.captured[k])
+        return Cons(Frame(frame.stack, frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
 
-    def hHALT(self, frame, frames):
+    def hHALT(self, frame, frames, _=None, __=None):
         if frames.car.fn is not None:
             top = frame.stack.car
             f = frames.cdr.car
-            return Cons(Frame(Cons(top, f.stack), f.fn, f.pc, f.context, f.pcontext), frames.cdr.cdr)
+            return Cons(Frame(Cons(top, f.stack), f.fn, f.pc, f.context, f.captured), frames.cdr.cdr)
+        else:
+            raise HALT, frames
+
+    def hPUSHCC(self, frame, frames, n, _=None):
+        newframe = Func(Frame(frame.stack, frame.fn, frame.pc + n, frame.context, frame.captured), frames.cdr)
+        return Cons(Frame(Cons(newframe, frame.stack), frame.fn, frame.pc + 1, frame.context, frame.captured), frames.cdr)
+
+    def hPUSHEC(self, frame, frames, n, _=None):
+        newframe = Func(Frame(frame.stack, frame.fn, frame.pc + n, frame.context, frame.captured), frames.cdr, True)
+        return Cons(Frame(Cons(newframe, frame.stack), frame.fn, frame.pc + 1, frame.context, frame.captured), frames.cdr)
+
+    def hARRAY(self, frame, frames, n, _=None):
+        values, stack = pop(frame.stack, n)
+        return Cons(Frame(Cons(vector(*values), stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def hHASH(self, frame, frames, n, _=None):
+        items, stack = pop(frame.stack, 2 * n)
+        return Cons(Frame(Cons(hashmap(*items), stack), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def operands(self, frame, n):
+        """
+        The top `n` values on `frame`'s operand stack, the top first
+        """
+
+        return pop(frame.stack, n)[0]
+
+    def result(self, frame, frames, n, value):
+        """
+        Replace the top `n` operands by `value`, moving to the next
+        instruction
+        """
+
+        return Cons(Frame(Cons(value, pop(frame.stack, n)[1]), frame.fn, frame.pc+1, frame.context, frame.captured), frames.cdr)
+
+    def ready(self, fiber, frames):
+        """
+        Queue the runnable `fiber`, going on with `frames`; if no fiber was
+        queued, `run` is told to start switching between them
+        """
+
+        idle = not self.fibers
+        self.fibers.append(fiber)
+        if idle and not self.nested():
+            raise Switch, frames
+        return frames
+
+    def park(self, queue, frames):
+        """
+        Block the running fiber, at `frames`, on a channel's `queue`, and
+        switch to the next runnable one
+        """
+
+        if self.nested():
+            raise RuntimeError("Cannot block on a channel inside a function called by a stdlib function")
+        queue.append(frames)
+        raise Switch, self.next_fiber()
+
+    def hAWAIT(self, frame, frames, n, argc):
+        fn = self.scopes[0][n]
+        if fn.__class__ is Func:
+            return self.redefined(frame, frames, n, argc)
+        value = fn(*self.operands(frame, argc))
+        if not hasattr(value, "add_done_callback"):
+            return self.result(frame, frames, argc, value)
+        if self.nested():
+            raise RuntimeError("Cannot wait on a future inside a function called by a stdlib function")
+
+        def done(future):
+            self.completed.append((frames, future))
+            if self.waker is not None:
+                self.waker()
+        self.awaiting += 1
+        value.add_done_callback(done)
+        self.resumed()
+        raise Switch, self.next_fiber()
+
+    def hSPAWN(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not stdlib.stdlib["spawn"]:
+            return self.redefined(frame, frames, n, 1)
+        fn = self.peek(frame)
+        if fn.__class__ is not Func or fn.continuation is not None:
+            raise TypeError("`spawn` takes a function of no arguments")
+        return self.ready(self.spawned(fn), self.result(frame, frames, 1, None))
+
+    def hYIELD(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not stdlib.stdlib["yield"]:
+            return self.redefined(frame, frames, n, 0)
+        frames = self.result(frame, frames, 0, None)
+        if not self.fibers or self.nested():
+            return frames
+        self.fibers.append(frames)
+        raise Switch, self.fibers.popleft()
+
+    def hSEND(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not stdlib.stdlib["send"]:
+            return self.redefined(frame, frames, n, 2)
+        chan, value = self.operands(frame, 2)
+        if not chan.receivers and len(chan.buffer) >= chan.capacity:
+            return self.park(chan.senders, frames)
+        chan.buffer.append(value)
+        frames = self.result(frame, frames, 2, None)
+        if chan.receivers:
+            return self.ready(chan.receivers.popleft(), frames)
+        return frames
+
+    def hRECV(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not stdlib.stdlib["recv"]:
+            return self.redefined(frame, frames, n, 1)
+        chan = self.peek(frame)
+        if not chan.buffer:
+            # A parked sender may now hand its value over
+            if chan.senders:
+                self.fibers.append(chan.senders.popleft())
+            return self.park(chan.receivers, frames)
+        frames = self.result(frame, frames, 1, chan.buffer.popleft())
+        if chan.senders:
+            return self.ready(chan.senders.popleft(), frames)
+        return frames
+
+APPLY = VM.apply.im_func.func_code
+
+class MutableVM(VM):
+    """
+    A VM that updates the running frame in place instead of allocating a new
+    `Frame` and `Cons` on every step.
+
+    The frame on top of the stack is never shared. `PUSHCC` marks every frame
+    below it `shared`, since the continuation it builds holds on to them;
+    a shared frame is copied before it next becomes the running frame. A
+    frame below a shared frame is always shared, so marking stops at the
+    first frame that already is.
+    """
+
+    def unshare(self, frames):
+        if frames.car.shared:
+            return Cons(frames.car.copy(), frames.cdr)
+        return frames
+
+    def hNOOP(self, frame, frames, _=None, __=None):
+        frame.pc += 1
+        return frames
+
+    def hPOP(self, frame, frames, _=None, __=None):
+        frame.stack = frame.stack.cdr
+        frame.pc += 1
+        return frames
+
+    def hPUSH(self, frame, frames, i, _=None):
+        frame.stack = Cons(self.consts[i], frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hROT(self, frame, frames, _=None, __=None):
+        fst = frame.stack.car
+        snd = frame.stack.cdr.car
+        frame.stack = Cons(snd, Cons(fst, frame.stack.cdr.cdr))
+        frame.pc += 1
+        return frames
+
+    def hDUP(self, frame, frames, n, _=None):
+        assert n == 1, "n > 1 not supported"
+        frame.stack = Cons(frame.stack.car, frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hGETL(self, frame, frames, n, _=None):
+        frame.stack = Cons(frame.context[n], frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hSETL(self, frame, frames, n, _=None):
+        frame.context[n] = frame.stack.car
+        frame.stack = frame.stack.cdr
+        frame.pc += 1
+        return frames
+
+    def hGET(self, frame, frames, n, k):
+        frame.stack = Cons(frame.captured[k][n], frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hSET(self, frame, frames, n, k):
+        frame.captured[k][n] = frame.stack.car
+        frame.stack = frame.stack.cdr
+        frame.pc += 1
+        return frames
+
+    def hGETG(self, frame, frames, n, s):
+        frame.stack = Cons(self.scopes[s][n], frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hSETG(self, frame, frames, n, s):
+        self.scopes[s][n] = frame.stack.car
+        frame.stack = frame.stack.cdr
+        frame.pc += 1
+        return frames
+
+    def call(self, frame, frames, n):
+        fn = frame.stack.car
+        stack = frame.stack.cdr
+        args = []
+        for i in range(n):
+            args.append(stack.car)
+            stack = stack.cdr
+
+        if callable(fn):
+            frame.stack = Cons(fn(*args), stack)
+            frame.pc += 1
+            return frames
+        elif isinstance(fn, Func) and fn.continuation is None:
+            frame.stack = stack
+            frame.pc += 1
+            fn = fn.frame
+            return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[len(args):], fn.captured), frames)
+        elif isinstance(fn, Func) and fn.continuation is not None:
+            assert len(args) == 1, "Calling continuation with multiple arguments is illegal!"
+            return self.unwind(fn, args[0])
+        else:
+            print "ERR", fn
+
+    def callpop(self, frame, frames, n):
+        fn = frame.stack.car
+        stack = frame.stack.cdr
+        args = []
+        for i in range(n):
+            args.append(stack.car)
+            stack = stack.cdr
+
+        if callable(fn):
+            rest = self.unshare(frames.cdr)
+            rest.car.stack = Cons(fn(*args), rest.car.stack)
+            return rest
+        elif isinstance(fn, Func) and fn.continuation is None:
+            rest = self.unshare(frames.cdr)
+            rest.car.stack = stack
+            fn = fn.frame
+            return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[len(args):], fn.captured), rest)
+        elif isinstance(fn, Func) and fn.continuation is not None:
+            assert len(args) == 1, "Calling continuation with multiple arguments is illegal!"
+            return self.unwind(fn, args[0])
+        else:
+            print "ERR: Not a function:", fn
+
+    def hCALLN(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        if fn.__class__ is Func:
+            return self.miss(frame, frames, n, CALL)
+        args, frame.stack = pop(frame.stack.cdr, n)
+        frame.stack = Cons(fn(*args), frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hCALLF(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        if fn.__class__ is not Func or fn.continuation is not None:
+            return self.miss(frame, frames, n, CALL)
+        args, frame.stack = pop(frame.stack.cdr, n)
+        frame.pc += 1
+        fn = fn.frame
+        return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[n:], fn.captured), frames)
+
+    def hCALLPOPN(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        if fn.__class__ is Func:
+            return self.miss(frame, frames, n, CALLPOP)
+        args = pop(frame.stack.cdr, n)[0]
+        rest = self.unshare(frames.cdr)
+        rest.car.stack = Cons(fn(*args), rest.car.stack)
+        return rest
+
+    def hCALLPOPF(self, frame, frames, n, _=None):
+        fn = frame.stack.car
+        if fn.__class__ is not Func or fn.continuation is not None:
+            return self.miss(frame, frames, n, CALLPOP)
+        args, stack = pop(frame.stack.cdr, n)
+        rest = self.unshare(frames.cdr)
+        rest.car.stack = stack
+        fn = fn.frame
+        return Cons(Frame(fn.stack, fn.fn, fn.pc, args + fn.context[n:], fn.captured), rest)
+
+    def redefined(self, frame, frames, n, argc=2):
+        frame.stack = Cons(self.scopes[0][n], frame.stack)
+        return self.call(frame, frames, argc)
+
+    def hADD(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.add:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        frame.stack = Cons(stack.car + stack.cdr.car, stack.cdr.cdr)
+        frame.pc += 1
+        return frames
+
+    def hSUB(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.sub:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        frame.stack = Cons(stack.car - stack.cdr.car, stack.cdr.cdr)
+        frame.pc += 1
+        return frames
+
+    def hMUL(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.mul:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        frame.stack = Cons(stack.car * stack.cdr.car, stack.cdr.cdr)
+        frame.pc += 1
+        return frames
+
+    def hDIV(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.div:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        frame.stack = Cons(stack.car / stack.cdr.car, stack.cdr.cdr)
+        frame.pc += 1
+        return frames
+
+    def hEQ(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.eq:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        frame.stack = Cons(stack.car == stack.cdr.car, stack.cdr.cdr)
+        frame.pc += 1
+        return frames
+
+    def hGOTO(self, frame, frames, delta, _=None):
+        frame.pc += delta
+        return frames
+
+    def hIFT(self, frame, frames, delta, _=None):
+        top = frame.stack.car
+        frame.stack = frame.stack.cdr
+        frame.pc += delta if top and top != Q else 1
+        return frames
+
+    def hIFF(self, frame, frames, delta, _=None):
+        top = frame.stack.car
+        frame.stack = frame.stack.cdr
+        frame.pc += delta if not top and top != Q else 1
+        return frames
+
+    def hIFQ(self, frame, frames, delta, _=None):
+        top = frame.stack.car
+        frame.stack = frame.stack.cdr
+        frame.pc += delta if top == Q else 1
+        return frames
+
+    def hCLSR(self, frame, frames, delta, n):
+        nctx = [None] * n
+        newframe = Func(Frame(None, "", frame.pc + delta, nctx, []), None)
+        frame.stack = Cons(newframe, frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hCAPL(self, frame, frames, _=None, __=None):
+        frame.stack.car.frame.captured.append(frame.context)
+        frame.pc += 1
+        return frames
+
+    def hCAPT(self, frame, frames, k, _=None):
+        frame.stack.car.frame.captured.append(frame.captured[k])
+        frame.pc += 1
+        return frames
+
+    def hHALT(self, frame, frames, _=None, __=None):
+        if frame.fn is not None:
+            rest = self.unshare(frames.cdr)
+            rest.car.stack = Cons(frame.stack.car, rest.car.stack)
+            return rest
         else:
             raise HALT, frames
 
-    def hPUSHCC(self, frame, frames, n):
-        n = int(n)
-        newframe = Func(Frame(frame.stack, frame.fn, frame.pc + n, frame.context, frame.pcontext), frames.cdr)
-        return Cons(Frame(Cons(newframe, frame.stack), frame.fn, frame.pc + 1, frame.context, frame.pcontext), frames.cdr)
+    def hPUSHCC(self, frame, frames, n, _=None):
+        cell = frames.cdr
+        while cell is not None and not cell.car.shared:
+            cell.car.shared = True
+            cell = cell.cdr
+        newframe = Func(Frame(frame.stack, frame.fn, frame.pc + n, frame.context, frame.captured), frames.cdr)
+        frame.stack = Cons(newframe, frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hPUSHEC(self, frame, frames, n, _=None):
+        # The frames below stay suspended, and unchanged, for as long as an
+        # escape continuation can be called, so they need not be marked shared
+        newframe = Func(Frame(frame.stack, frame.fn, frame.pc + n, frame.context, frame.captured), frames.cdr, True)
+        frame.stack = Cons(newframe, frame.stack)
+        frame.pc += 1
+        return frames
+
+    def hARRAY(self, frame, frames, n, _=None):
+        values, stack = pop(frame.stack, n)
+        frame.stack = Cons(vector(*values), stack)
+        frame.pc += 1
+        return frames
+
+    def hHASH(self, frame, frames, n, _=None):
+        items, stack = pop(frame.stack, 2 * n)
+        frame.stack = Cons(hashmap(*items), stack)
+        frame.pc += 1
+        return frames
+
+    def result(self, frame, frames, n, value):
+        frame.stack = Cons(value, pop(frame.stack, n)[1])
+        frame.pc += 1
+        return frames
+
+class ArrayVM(MutableVM):
+    """
+    A `MutableVM` whose operand stacks are Python lists, top last, instead
+    of `Cons` lists, so pushing and popping allocate nothing.
+
+    The stack is segmented by frame: each frame owns the list holding its
+    own operands, and the frames themselves stay a `Cons` list. Frames
+    marked `shared` by `PUSHCC` are copied, list included, before they
+    next run, as in `MutableVM`; a continuation keeps a copy of the running
+    frame's list, which is only as long as that one frame's operands.
+    """
+
+    def mk_state(self, n):
+        frames = MutableVM.mk_state(self, n)
+        frames.car.stack = []
+        return frames
+
+    def new_stack(self):
+        return []
+
+    def peek(self, frame):
+        return frame.stack[-1]
+
+    def unshare(self, frames):
+        if frames.car.shared:
+            f = frames.car
+            return Cons(Frame(list(f.stack), f.fn, f.pc, f.context, f.captured), frames.cdr)
+        return frames
+
+    def hPOP(self, frame, frames, _=None, __=None):
+        frame.stack.pop()
+        frame.pc += 1
+        return frames
 
-def read(stream): # TODO: Properly parse PUSH instructions
+    def hPUSH(self, frame, frames, i, _=None):
+        frame.stack.append(self.consts[i])
+        frame.pc += 1
+        return frames
+
+    def hROT(self, frame, frames, _=None, __=None):
+        stack = frame.stack
+        stack[-1], stack[-2] = stack[-2], stack[-1]
+        frame.pc += 1
+        return frames
+
+    def hDUP(self, frame, frames, n, _=None):
+        assert n == 1, "n > 1 not supported"
+        frame.stack.append(frame.stack[-1])
+        frame.pc += 1
+        return frames
+
+    def hGETL(self, frame, frames, n, _=None):
+        frame.stack.append(frame.context[n])
+        frame.pc += 1
+        return frames
+
+    def hSETL(self, frame, frames, n, _=None):
+        frame.context[n] = frame.stack.pop()
+        frame.pc += 1
+        return frames
+
+    def hGET(self, frame, frames, n, k):
+        frame.stack.append(frame.captured[k][n])
+        frame.pc += 1
+        return frames
+
+    def hSET(self, frame, frames, n, k):
+        frame.captured[k][n] = frame.stack.pop()
+        frame.pc += 1
+        return frames
+
+    def hGETG(self, frame, frames, n, s):
+        frame.stack.append(self.scopes[s][n])
+        frame.pc += 1
+        return frames
+
+    def hSETG(self, frame, frames, n, s):
+        self.scopes[s][n] = frame.stack.pop()
+        frame.pc += 1
+        return frames
+
+    def unwind(self, fn, value):
+        cc = fn.frame
+        return Cons(Frame(cc.stack + [value], cc.fn, cc.pc, cc.context, cc.captured), fn.continuation)
+
+    def call(self, frame, frames, n):
+        stack = frame.stack
+        fn = stack.pop()
+        args = stack[:-n - 1:-1]
+        del stack[len(stack) - n:]
+
+        if callable(fn):
+            stack.append(fn(*args))
+            frame.pc += 1
+            return frames
+        elif isinstance(fn, Func) and fn.continuation is None:
+            frame.pc += 1
+            fn = fn.frame
+            return Cons(Frame([], fn.fn, fn.pc, args + fn.context[n:], fn.captured), frames)
+        elif isinstance(fn, Func) and fn.continuation is not None:
+            assert len(args) == 1, "Calling continuation with multiple arguments is illegal!"
+            return self.unwind(fn, args[0])
+        else:
+            print "ERR", fn
+
+    def callpop(self, frame, frames, n):
+        stack = frame.stack
+        fn = stack.pop()
+        args = stack[:-n - 1:-1]
+        del stack[len(stack) - n:]
+
+        if callable(fn):
+            rest = self.unshare(frames.cdr)
+            rest.car.stack.append(fn(*args))
+            return rest
+        elif isinstance(fn, Func) and fn.continuation is None:
+            rest = self.unshare(frames.cdr)
+            rest.car.stack = stack
+            fn = fn.frame
+            return Cons(Frame([], fn.fn, fn.pc, args + fn.context[n:], fn.captured), rest)
+        elif isinstance(fn, Func) and fn.continuation is not None:
+            assert len(args) == 1, "Calling continuation with multiple arguments is illegal!"
+            return self.unwind(fn, args[0])
+        else:
+            print "ERR: Not a function:", fn
+
+    def hCALLN(self, frame, frames, n, _=None):
+        stack = frame.stack
+        fn = stack[-1]
+        if fn.__class__ is Func:
+            return self.miss(frame, frames, n, CALL)
+        args = stack[-2:-n - 2:-1]
+        del stack[len(stack) - n - 1:]
+        stack.append(fn(*args))
+        frame.pc += 1
+        return frames
+
+    def hCALLF(self, frame, frames, n, _=None):
+        stack = frame.stack
+        fn = stack[-1]
+        if fn.__class__ is not Func or fn.continuation is not None:
+            return self.miss(frame, frames, n, CALL)
+        args = stack[-2:-n - 2:-1]
+        del stack[len(stack) - n - 1:]
+        frame.pc += 1
+        fn = fn.frame
+        return Cons(Frame([], fn.fn, fn.pc, args + fn.context[n:], fn.captured), frames)
+
+    def hCALLPOPN(self, frame, frames, n, _=None):
+        stack = frame.stack
+        fn = stack[-1]
+        if fn.__class__ is Func:
+            return self.miss(frame, frames, n, CALLPOP)
+        rest = self.unshare(frames.cdr)
+        rest.car.stack.append(fn(*stack[-2:-n - 2:-1]))
+        return rest
+
+    def hCALLPOPF(self, frame, frames, n, _=None):
+        stack = frame.stack
+        fn = stack[-1]
+        if fn.__class__ is not Func or fn.continuation is not None:
+            return self.miss(frame, frames, n, CALLPOP)
+        args = stack[-2:-n - 2:-1]
+        del stack[len(stack) - n - 1:]
+        rest = self.unshare(frames.cdr)
+        rest.car.stack = stack
+        fn = fn.frame
+        return Cons(Frame([], fn.fn, fn.pc, args + fn.context[n:], fn.captured), rest)
+
+    def redefined(self, frame, frames, n, argc=2):
+        frame.stack.append(self.scopes[0][n])
+        return self.call(frame, frames, argc)
+
+    def hADD(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.add:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        a = stack.pop()
+        stack[-1] = a + stack[-1]
+        frame.pc += 1
+        return frames
+
+    def hSUB(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.sub:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        a = stack.pop()
+        stack[-1] = a - stack[-1]
+        frame.pc += 1
+        return frames
+
+    def hMUL(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.mul:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        a = stack.pop()
+        stack[-1] = a * stack[-1]
+        frame.pc += 1
+        return frames
+
+    def hDIV(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.div:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        a = stack.pop()
+        stack[-1] = a / stack[-1]
+        frame.pc += 1
+        return frames
+
+    def hEQ(self, frame, frames, n, _=None):
+        if self.scopes[0][n] is not operator.eq:
+            return self.redefined(frame, frames, n)
+        stack = frame.stack
+        a = stack.pop()
+        stack[-1] = a == stack[-1]
+        frame.pc += 1
+        return frames
+
+    def hIFT(self, frame, frames, delta, _=None):
+        top = frame.stack.pop()
+        frame.pc += delta if top and top != Q else 1
+        return frames
+
+    def hIFF(self, frame, frames, delta, _=None):
+        top = frame.stack.pop()
+        frame.pc += delta if not top and top != Q else 1
+        return frames
+
+    def hIFQ(self, frame, frames, delta, _=None):
+        top = frame.stack.pop()
+        frame.pc += delta if top == Q else 1
+        return frames
+
+    def hCLSR(self, frame, frames, delta, n):
+        nctx = [None] * n
+        frame.stack.append(Func(Frame(None, "", frame.pc + delta, nctx, []), None))
+        frame.pc += 1
+        return frames
+
+    def hCAPL(self, frame, frames, _=None, __=None):
+        frame.stack[-1].frame.captured.append(frame.context)
+        frame.pc += 1
+        return frames
+
+    def hCAPT(self, frame, frames, k, _=None):
+        frame.stack[-1].frame.captured.append(frame.captured[k])
+        frame.pc += 1
+        return frames
+
+    def hHALT(self, frame, frames, _=None, __=None):
+        if frame.fn is not None:
+            rest = self.unshare(frames.cdr)
+            rest.car.stack.append(frame.stack[-1])
+            return rest
+        else:
+            raise HALT, frames
+
+    def hPUSHCC(self, frame, frames, n, _=None):
+        cell = frames.cdr
+        while cell is not None and not cell.car.shared:
+            cell.car.shared = True
+            cell = cell.cdr
+        newframe = Func(Frame(list(frame.stack), frame.fn, frame.pc + n, frame.context, frame.captured), frames.cdr)
+        frame.stack.append(newframe)
+        frame.pc += 1
+        return frames
+
+    def hPUSHEC(self, frame, frames, n, _=None):
+        newframe = Func(Frame(list(frame.stack), frame.fn, frame.pc + n, frame.context, frame.captured), frames.cdr, True)
+        frame.stack.append(newframe)
+        frame.pc += 1
+        return frames
+
+    def hARRAY(self, frame, frames, n, _=None):
+        stack = frame.stack
+        values = stack[:-n - 1:-1]
+        del stack[len(stack) - n:]
+        stack.append(vector(*values))
+        frame.pc += 1
+        return frames
+
+    def hHASH(self, frame, frames, n, _=None):
+        stack = frame.stack
+        items = stack[:-2 * n - 1:-1]
+        del stack[len(stack) - 2 * n:]
+        stack.append(hashmap(*items))
+        frame.pc += 1
+        return frames
+
+    def operands(self, frame, n):
+        return frame.stack[:-n - 1:-1]
+
+    def result(self, frame, frames, n, value):
+        stack = frame.stack
+        del stack[len(stack) - n:]
+        stack.append(value)
+        frame.pc += 1
+        return frames
+
+def read(stream):
     n = int(stream.readline().strip())
-    bytecodes = [line.strip().split() for line in stream]
+    bytecodes = []
+    for line in stream:
+        name, _, operands = line.strip().partition(" ")
+        # A `PUSH` operand is one constant, which may contain spaces
+        bytecodes.append([name, operands] if name == "PUSH" else [name] + operands.split())
     return n, bytecodes
 
-def run(vm, state):
-    while True:
-        try:
-            state = vm.step(state)
-        except HALT as e:
-            return e.args[0]
+def run(vm, state, profile=None):
+    """
+    Run `state` until the top-level code halts; returns the final frames.
+    With a `profiler.Profile`, the run is recorded into it.
+
+    While other fibers are runnable, or wait on futures, the running one is
+    switched out every `BUDGET` instructions; until then the loop has
+    nothing to count. Fibers left when the top-level code halts stay queued
+    on `vm`.
+    """
+
+    if profile is not None:
+        return profile.run(vm, state)
+    code, table, fibers = vm.code, vm.table, vm.fibers
+    with stdlib.invoked_by(vm.apply):
+        while True:
+            try:
+                if state is None:
+                    state = vm.next_fiber()
+                if not fibers and not vm.awaiting:
+                    while True:
+                        op, a, b = code[state.car.pc]
+                        state = table[op](state.car, state, a, b)
+                for i in xrange(BUDGET):
+                    op, a, b = code[state.car.pc]
+                    state = table[op](state.car, state, a, b)
+                vm.resumed()
+                fibers.append(state)
+                state = fibers.popleft()
+            except Switch as e:
+                state = e.args[0]
+            except Idle:
+                state = vm.wait()
+            except HALT as e:
+                if not vm.finished(e.args[0]):
+                    return e.args[0]
+                state = None
+
+def run_slice(vm, state, count):
+    """
+    Run `state` for at most `count` instructions, switching fibers as `run`
+    does; returns the state to go on with, `None` for the next fiber.
+    Raises `HALT` when the top-level code halts, and `Idle` when no fiber
+    can run yet.
+    """
+
+    code, table, fibers = vm.code, vm.table, vm.fibers
+    with stdlib.invoked_by(vm.apply):
+        while count > 0:
+            n = min(count, BUDGET)
+            count -= n
+            try:
+                if state is None:
+                    state = vm.next_fiber()
+                for i in xrange(n):
+                    op, a, b = code[state.car.pc]
+                    state = table[op](state.car, state, a, b)
+                vm.resumed()
+                if fibers:
+                    fibers.append(state)
+                    state = fibers.popleft()
+            except Switch as e:
+                state = e.args[0]
+            except HALT as e:
+                if not vm.finished(e.args[0]):
+                    raise
+                state = None
+        return state
+
+def trace(vm, state):
+    """
+    Like `run`, but goes through `VM.step`, so it honors `DEBUG`
+    """
+
+    with stdlib.invoked_by(vm.apply):
+        while True:
+            try:
+                if state is None:
+                    state = vm.next_fiber()
+                while True:
+                    for i in xrange(BUDGET):
+                        state = vm.step(state)
+                    vm.resumed()
+                    if vm.fibers:
+                        vm.fibers.append(state)
+                        state = vm.fibers.popleft()
+            except Switch as e:
+                state = e.args[0]
+            except Idle:
+                state = vm.wait()
+            except HALT as e:
+                if not vm.finished(e.args[0]):
+                    return e.args[0]
+                state = None
 
 if __name__ == "__main__":
-    import sys
-    n, bytecodes = read(sys.stdin)
-    vm = VM(bytecodes)
-    run(vm, vm.mk_state(n))
+    if len(sys.argv) > 1 and sys.argv[1].endswith(".forp"):
+        import cache
+        n, bytecodes, consts = cache.load(sys.argv[1])
+        vm = VM(bytecodes, consts)
+    elif len(sys.argv) > 1:
+        import forpc
+        n, bytecodes, consts = forpc.load(sys.argv[1])
+        vm = VM(bytecodes, consts)
+    else:
+        n, bytecodes = read(sys.stdin)
+        vm = VM(bytecodes)
+    (trace if DEBUG else run)(vm, vm.mk_state(n))